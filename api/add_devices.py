@@ -1,7 +1,19 @@
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
 from pathlib import Path
-from models.devicemodels import S7CommDeviceServiceConfig, DeviceService, USBMicrophoneDevice
+from models.devicemodels import S7CommDeviceServiceConfig, DeviceService, USBMicrophoneDevice, BulkDeviceServices
 from ruamel.yaml import YAML
+from api.docker_jobs import run_docker, submit_job
+from api.container_state import container_cache
+from api.services import DEVICE_HOST, FETCH_COMMAND
+from common.metrics import METRICS_PORT
+import api.log_stream as log_stream
+import asyncio
+import functools
+import json
+import re
+import shutil
+import time
 import docker
 from docker.errors import ImageNotFound, APIError, ContainerError
 import logging
@@ -83,6 +95,76 @@ except docker.errors.APIError as e:
 host_platform = os.getenv("HOST_PLATFORM", "").lower()
 host_arch = os.getenv("HOST_ARCH", "").lower()
 
+# Bounds how many containers of a bulk provisioning request are started at the same time,
+# so that a large request does not occupy every worker of the docker executor
+provisioning_slots = asyncio.Semaphore(int(os.getenv("PROVISIONING_WORKERS", "4")))
+
+def start_S7_container(device_id, configfile_path):
+    return client.containers.run(
+        name=f"{device_id}",
+        image="jeppeotte/s7comm_device_service:latest",
+        volumes={
+            host_mounted_dir: {"bind": "/mounted_dir", "mode": "rw"},
+        },
+        command=[
+            "--device_service_config_path", f"{configfile_path}"
+        ],
+        extra_hosts={"localhost": "host-gateway"},
+        detach=True,
+        restart_policy={"Name": "unless-stopped"}
+    )
+
+def start_device_host_container():
+    # The device host runs the device services of metadata.yaml in one container, see devices/host/device_host.py
+    return client.containers.run(
+        name=DEVICE_HOST,
+        image="jeppeotte/device_host:latest",
+        volumes={
+            host_mounted_dir: {"bind": "/mounted_dir", "mode": "rw"},
+        },
+        extra_hosts={"localhost": "host-gateway"},
+        devices=["/dev/snd"] if host_platform == "linux" else None,
+        detach=True,
+        restart_policy={"Name": "unless-stopped"}
+    )
+
+def ensure_device_host():
+    # Starts the device host unless it runs. A running host starts the devices which are added to metadata.yaml
+    # by itself.
+    try:
+        container = container_cache.get_container(DEVICE_HOST)
+    except docker.errors.NotFound:
+        return start_device_host_container()
+    if container.status != "running":
+        container.start()
+    return container
+
+def device_mode(metadata):
+    # Whether the device services run in a container each or together in the device host
+    return metadata.get("device_mode") or "container"
+
+def read_device_mode():
+    yaml = YAML()
+    with open(mounted_dir.joinpath("core/metadata.yaml"), 'r') as f:
+        return device_mode(yaml.load(f) or {})
+
+def start_USB_microphone_container(device_id, configfile_path, backend_ip):
+    return client.containers.run(
+        name=f"{device_id}",
+        image="jeppeotte/usb_microphone_service:latest",
+        volumes={
+            host_mounted_dir: {"bind": "/mounted_dir", "mode": "rw"},
+        },
+        command=[
+            "--device_service_config_path", f"{configfile_path}",
+            "--backend_ip", f"{backend_ip}"
+        ],
+        extra_hosts={"localhost": "host-gateway"},
+        devices=["/dev/snd"],
+        detach=True,
+        restart_policy={"Name": "unless-stopped"}
+    )
+
 @router.post("/add_S7_device")
 async def add_S7_device(serviceconfig: S7CommDeviceServiceConfig):
     if host_arch not in ["x86_64", "arm64", "amd64"]:
@@ -125,7 +207,8 @@ async def add_S7_device(serviceconfig: S7CommDeviceServiceConfig):
                           protocol_type= serviceconfig.device.protocol_type,
                           config= configfile_path,
                           tested= False,
-                          activated= True)
+                          activated= True,
+                          driver= "S7Comm")
 
             # If there is nothing under device_services, make it a list to that entries can be appended
             if metadata["services"]["device_services"] is None:
@@ -137,21 +220,13 @@ async def add_S7_device(serviceconfig: S7CommDeviceServiceConfig):
             with open(metadata_path, 'w') as f:
                 yaml.dump(metadata, f)
 
-            # Start the container
+            # Start the container, or the device host which starts the device from metadata.yaml
             try:
-                container = client.containers.run(
-                    name=f"{serviceconfig.device.device_id}",
-                    image="jeppeotte/s7comm_device_service:latest",
-                    volumes={
-                        host_mounted_dir: {"bind": "/mounted_dir", "mode": "rw"},
-                    },
-                    command=[
-                        "--device_service_config_path", f"{configfile_path}"
-                    ],
-                    extra_hosts={"localhost": "host-gateway"},
-                    detach=True,
-                    restart_policy={"Name": "unless-stopped"}
-                )
+                if device_mode(metadata) == "host":
+                    container = await run_docker("run", ensure_device_host)
+                else:
+                    container = await run_docker("run", start_S7_container,
+                                                 serviceconfig.device.device_id, configfile_path)
 
             except Exception as e:
                 raise HTTPException(status_code=500, detail=str(e))
@@ -246,7 +321,8 @@ async def add_USB_microphone(serviceconfig: USBMicrophoneDevice):
                           protocol_type= serviceconfig.device.protocol_type,
                           config= configfile_path,
                           tested= False,
-                          activated= True)
+                          activated= True,
+                          driver= "USB_microphone")
 
             # If there is nothing under device_services, make it a list to that entries can be appended
             if metadata["services"]["device_services"] is None:
@@ -271,23 +347,13 @@ async def add_USB_microphone(serviceconfig: USBMicrophoneDevice):
 
             backend_ip = mqtt_config["broker"].get("ip","")
 
-            # Start the container
+            # Start the container, or the device host which starts the device from metadata.yaml
             try:
-                container = client.containers.run(
-                    name=f"{serviceconfig.device.device_id}",
-                    image="jeppeotte/usb_microphone_service:latest",
-                    volumes={
-                        host_mounted_dir: {"bind": "/mounted_dir", "mode": "rw"},
-                    },
-                    command=[
-                        "--device_service_config_path", f"{configfile_path}",
-                        "--backend_ip", f"{backend_ip}"
-                    ],
-                    extra_hosts={"localhost": "host-gateway"},
-                    devices=["/dev/snd"],
-                    detach=True,
-                    restart_policy={"Name": "unless-stopped"}
-                )
+                if device_mode(metadata) == "host":
+                    container = await run_docker("run", ensure_device_host)
+                else:
+                    container = await run_docker("run", start_USB_microphone_container,
+                                                 serviceconfig.device.device_id, configfile_path, backend_ip)
             except ContainerError as e:
                 raise HTTPException(status_code=500, detail=f"Failed to start container: {str(e)}")
             except APIError as e:
@@ -306,6 +372,174 @@ async def add_USB_microphone(serviceconfig: USBMicrophoneDevice):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def stage_yaml_file(path, data, yaml):
+    # Write the content next to the target file, so that it can be moved in place once everything is written
+    staged_path = path.with_name(f"{path.name}.tmp")
+    with open(staged_path, 'w') as f:
+        yaml.dump(data, f)
+    return staged_path
+
+def backup_file(path):
+    # Copies a file which is about to be replaced, so that it can be restored when the transaction is rolled back
+    if not path.exists():
+        return None
+    backup_path = path.with_name(f"{path.name}.backup")
+    shutil.copy2(path, backup_path)
+    return backup_path
+
+async def start_bulk_container(device_id, start_container):
+    start_time = time.time()
+    try:
+        async with provisioning_slots:
+            container = await run_docker("run", start_container)
+        logger.info(f"Started container for device service: {device_id}")
+        return {"device_id": device_id,
+                "status": "started",
+                "container_id": container.short_id,
+                "elapsed": round(time.time() - start_time, 3)}
+    except Exception as e:
+        logger.error(f"Failed to start container for device service {device_id}: {e}")
+        return {"device_id": device_id,
+                "status": "failed",
+                "detail": str(e),
+                "elapsed": round(time.time() - start_time, 3)}
+
+@router.post("/bulk")
+async def add_devices_bulk(serviceconfigs: BulkDeviceServices):
+    if host_arch not in ["x86_64", "arm64", "amd64"]:
+        raise HTTPException(status_code=400, detail=f"Unsupported host architecture: {host_arch}")
+
+    if serviceconfigs.usb_microphones and host_platform != "linux":
+        raise HTTPException(status_code=400, detail="USB microphone services only work on gateways using Linux.")
+
+    serviceconfig_list = serviceconfigs.s7_devices + serviceconfigs.usb_microphones
+    if not serviceconfig_list:
+        raise HTTPException(status_code=400, detail="No device services were provided.")
+
+    # The device_id is used as container name, so it has to be unique
+    device_ids = [serviceconfig.device.device_id for serviceconfig in serviceconfig_list]
+    duplicates = sorted({device_id for device_id in device_ids if device_ids.count(device_id) > 1})
+    if duplicates:
+        raise HTTPException(status_code=400, detail=f"Duplicate device_id in request: {duplicates}")
+
+    yaml = YAML()
+    yaml.preserve_quotes = True
+    yaml.indent(mapping=2, sequence=4, offset=2)
+
+    # Define the path to the metadata.yaml files to add the services inside of that
+    metadata_path = mounted_dir.joinpath("core/metadata.yaml")
+
+    if not metadata_path.exists():
+        raise HTTPException(status_code=500,
+                            detail=f"metadata.yaml does not exist in the following path {metadata_path}")
+
+    try:
+        with open(metadata_path, 'r') as f:
+            metadata = yaml.load(f)
+
+        # If there is nothing under device_services, make it a list to that entries can be appended
+        if metadata["services"]["device_services"] is None:
+            metadata["services"]["device_services"] = []
+
+        backend_ip = None
+        if serviceconfigs.usb_microphones:
+            # The USB microphone services need to know where the backend for sending data is
+            mqtt_path = mounted_dir.joinpath("applications/MQTT/MQTT_config.yaml")
+
+            if not mqtt_path.exists():
+                raise HTTPException(status_code=500,
+                                    detail=f"MQTT config file does not exist in the following path {mqtt_path}")
+
+            with open(mqtt_path, 'r') as f:
+                mqtt_config = yaml.load(f)
+
+            backend_ip = mqtt_config["broker"].get("ip", "")
+
+    except HTTPException:
+        raise
+
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+    existing_device_ids = {device.get("device_id") for device in metadata["services"]["device_services"]}
+    conflicts = sorted(existing_device_ids.intersection(device_ids))
+    if conflicts:
+        raise HTTPException(status_code=409, detail=f"Device services already exist: {conflicts}")
+
+    # Write all config files and the metadata as one transaction. Everything is staged first and only moved
+    # in place when all files have been written, metadata.yaml last, so that a failure leaves no partial setup.
+    # A config file which already exists, e.g. of a device removed from metadata.yaml, is backed up and restored.
+    staged_files = []
+    committed_files = []  # (path, backup_path or None)
+    container_starts = []
+    try:
+        for serviceconfig in serviceconfig_list:
+            device_id = serviceconfig.device.device_id
+            configfile_path = f"devices/{serviceconfig.device.protocol_type}/{device_id}.yaml"
+            full_configfile_path = mounted_dir.joinpath(configfile_path)
+            full_configfile_path.parent.mkdir(parents=True, exist_ok=True)
+            staged_files.append((stage_yaml_file(full_configfile_path, serviceconfig.model_dump(), yaml),
+                                 full_configfile_path))
+
+            device_info = DeviceService(device_id=device_id,
+                                        protocol_type=serviceconfig.device.protocol_type,
+                                        config=configfile_path,
+                                        tested=False,
+                                        activated=True,
+                                        driver="USB_microphone" if isinstance(serviceconfig, USBMicrophoneDevice)
+                                        else "S7Comm")
+            metadata["services"]["device_services"].append(device_info.model_dump())
+
+            if isinstance(serviceconfig, USBMicrophoneDevice):
+                container_starts.append((device_id, functools.partial(
+                    start_USB_microphone_container, device_id, configfile_path, backend_ip)))
+            else:
+                container_starts.append((device_id, functools.partial(
+                    start_S7_container, device_id, configfile_path)))
+
+        staged_files.append((stage_yaml_file(metadata_path, metadata, yaml), metadata_path))
+
+        for staged_path, path in staged_files:
+            backup_path = backup_file(path) if path != metadata_path else None
+            os.replace(staged_path, path)
+            committed_files.append((path, backup_path))
+
+    except Exception as e:
+        logger.error(f"Bulk provisioning failed, rolling back: {e}")
+        for staged_path, path in staged_files:
+            staged_path.unlink(missing_ok=True)
+        for path, backup_path in committed_files:
+            if path == metadata_path:
+                continue
+            if backup_path is not None:
+                os.replace(backup_path, path)
+            else:
+                path.unlink(missing_ok=True)
+        raise HTTPException(status_code=500, detail=f"Bulk provisioning failed: {str(e)}")
+
+    for _, backup_path in committed_files:
+        if backup_path is not None:
+            backup_path.unlink(missing_ok=True)
+
+    if device_mode(metadata) == "host":
+        # The device host starts the devices from metadata.yaml, only the host itself is started here
+        container_starts = [(DEVICE_HOST, ensure_device_host)]
+
+    logger.info(f"Provisioned {len(serviceconfig_list)} device services, starting {len(container_starts)} containers")
+
+    async def provisioning_results():
+        # Results are streamed as newline delimited JSON in the order the containers finish starting
+        summary = {"started": 0, "failed": 0}
+        for next_result in asyncio.as_completed([start_bulk_container(device_id, start_container)
+                                                 for device_id, start_container in container_starts]):
+            result = await next_result
+            summary[result["status"]] += 1
+            yield json.dumps(result) + "\n"
+        yield json.dumps({"summary": summary}) + "\n"
+
+    return StreamingResponse(provisioning_results(), media_type="application/x-ndjson")
+
 @router.post("/test_service")
 async def test_device_service(device_id: str):
     # Find the information about the device_service so that it can be tested:
@@ -375,25 +609,158 @@ async def start_device_service(device_id: str):
         raise HTTPException(status_code=500, detail=str(e))
     return
 
-@router.post("/restart_service")
-async def restart_service(device_id: str):
-    try:
-        container = client.containers.get(device_id)
+def restart_hosted_device(device_id):
+    # Restarts a device in the device host through its metrics endpoint
+    container = container_cache.get_container(DEVICE_HOST)
+    url = f"http://127.0.0.1:{METRICS_PORT}/devices/restart?device_id={device_id}"
+    exit_code, output = container.exec_run(["python", "-c", FETCH_COMMAND, url, "10"])
+    status, _, body = output.partition(b"\n")
+    if exit_code != 0 or status != b"202":
+        raise HTTPException(status_code=502, detail=f"The device host could not restart '{device_id}': "
+                                                    f"{body.decode('utf-8', errors='replace')}")
+    return {"message": f"Device '{device_id}' is restarting in the device host."}
 
-        container.restart(timeout=5)
+def restart_container(device_id):
+    if read_device_mode() == "host":
+        return restart_hosted_device(device_id)
 
-        # Refresh state and check if running
-        container.reload()
-        if container.status == "running":
-            return {"message": f"Container '{device_id}' successfully restarted."}
-        else:
-            raise HTTPException(status_code=500, detail=f"Container '{device_id}' not running after restart.")
+    container = container_cache.get_container(device_id)
+
+    container.restart(timeout=5)
+
+    # Refresh state and check if running
+    container.reload()
+    if container.status == "running":
+        return {"message": f"Container '{device_id}' successfully restarted."}
+    else:
+        raise HTTPException(status_code=500, detail=f"Container '{device_id}' not running after restart.")
+
+@router.post("/restart_service")
+async def restart_service(device_id: str, background: bool = False):
+    # In the background the restart is followed through the job API instead of waiting for it
+    if background:
+        return {"job_id": submit_job("restart", device_id, restart_container, device_id)}
+
+    try:
+        return await run_docker("restart", restart_container, device_id)
 
+    except HTTPException:
+        raise
     except docker.errors.NotFound:
         raise HTTPException(status_code=404, detail=f"Container '{device_id}' not found.")
+    except TimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to restart container: {str(e)}")
 
+@router.post("/restart_services")
+async def restart_services(device_ids: list[str] | None = None):
+    # Restart several device services as background jobs, all device services when none are given
+    if device_ids is None:
+        try:
+            yaml = YAML()
+            metadata_path = mounted_dir.joinpath("core/metadata.yaml")
+
+            with open(metadata_path, 'r') as f:
+                metadata = yaml.load(f)
+
+            device_ids = [device.get("device_id") for device in metadata["services"].get("device_services") or []]
+
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+    return {"jobs": {device_id: submit_job("restart", device_id, restart_container, device_id)
+                     for device_id in device_ids}}
+
+def remove_container(name):
+    try:
+        container_cache.get_container(name).remove(force=True)
+    except docker.errors.NotFound:
+        pass
+
+@router.post("/device_mode")
+async def set_device_mode(mode: str):
+    # Switch between a container per device service ("container") and one device host for all of them ("host").
+    # The activated device services are moved over, the old containers are removed before the new ones start so
+    # that a device is never sampled twice.
+    if mode not in ("container", "host"):
+        raise HTTPException(status_code=400, detail=f"Unknown device mode '{mode}', use container or host")
+
+    yaml = YAML()
+    yaml.preserve_quotes = True
+    yaml.indent(mapping=2, sequence=4, offset=2)
+    metadata_path = mounted_dir.joinpath("core/metadata.yaml")
+
+    try:
+        with open(metadata_path, 'r') as f:
+            metadata = yaml.load(f)
+
+        metadata["device_mode"] = mode
+        os.replace(stage_yaml_file(metadata_path, metadata, yaml), metadata_path)
+
+        device_services = [DeviceService(**device) for device in metadata["services"].get("device_services") or []
+                           if device.get("activated")]
+        backend_ip = None
+        if mode == "container" and any((device.driver or device.protocol_type) != "S7Comm"
+                                       for device in device_services):
+            # The USB microphone services need to know where the backend for sending data is
+            with open(mounted_dir.joinpath("applications/MQTT/MQTT_config.yaml"), 'r') as f:
+                backend_ip = yaml.load(f)["broker"].get("ip", "")
+
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+    results = {}
+    try:
+        if mode == "host":
+            for device in device_services:
+                await run_docker("remove", remove_container, device.device_id)
+            await run_docker("run", ensure_device_host)
+            results = {device.device_id: "hosted" for device in device_services}
+        else:
+            await run_docker("remove", remove_container, DEVICE_HOST)
+            for device in device_services:
+                driver = device.driver or device.protocol_type
+                if driver == "S7Comm":
+                    await run_docker("run", start_S7_container, device.device_id, device.config)
+                elif driver in ("USB_microphone", "USB"):
+                    await run_docker("run", start_USB_microphone_container, device.device_id, device.config,
+                                     backend_ip)
+                else:
+                    results[device.device_id] = "unsupported"
+                    continue
+                results[device.device_id] = "started"
+
+    except Exception as e:
+        logger.error(f"Could not switch the device services to the {mode} mode: {e}")
+        raise HTTPException(status_code=500, detail=f"Could not switch to the {mode} mode after {results}: {str(e)}")
+
+    logger.info(f"Switched the device services to the {mode} mode")
+    return {"device_mode": mode, "device_services": results}
+
+@router.post("/update_S7_device")
+async def update_S7_device(serviceconfig: S7CommDeviceServiceConfig):
+    # Replace the config file of an S7 device service. The running service reloads it without a restart, and
+    # only reconnects to the PLC when the connection parameters have changed
+    device_id = serviceconfig.device.device_id
+    configfile_path = mounted_dir.joinpath(f"devices/{serviceconfig.device.protocol_type}/{device_id}.yaml")
+    if not configfile_path.exists():
+        raise HTTPException(status_code=404, detail=f"No config file for the device service '{device_id}' "
+                                                    f"at {configfile_path}")
+
+    yaml = YAML()
+    yaml.preserve_quotes = True
+    yaml.indent(mapping=2, sequence=4, offset=2)
+
+    try:
+        # The file is replaced at once, so that the service never reads a partly written config
+        os.replace(stage_yaml_file(configfile_path, serviceconfig.model_dump(), yaml), configfile_path)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to update the config file: {str(e)}")
+
+    return {"configfile_path": f"devices/{serviceconfig.device.protocol_type}/{device_id}.yaml"}
+
 @router.post("/delete_device_service")
 async def delete_device_service(device_id: str):
     # Find the information about the device_service so that it can be tested:
@@ -424,6 +791,8 @@ async def delete_device_service(device_id: str):
             if config_file_path.exists():
                 try:
                     config_file_path.unlink()
+                    # The cache of the config, which the device service writes next to it, see common/startup.py
+                    config_file_path.with_name(f".{config_file_path.name}.cache").unlink(missing_ok=True)
                     print(f"Deleted config file: {config_file_path}")
                 except Exception as e:
                     print(f"Error deleting config file: {e}")
@@ -449,8 +818,8 @@ async def delete_device_service(device_id: str):
 
 
     try:
-        container = client.containers.get(device_id)
-        container.remove(force=True)  # force=True will stop it if it's running
+        container = await run_docker("get", container_cache.get_container, device_id)
+        await run_docker("remove", container.remove, force=True)  # force=True will stop it if it's running
         logger.info(f"The following device has been removed: {device_id}")
         return {"message": f"Device service '{device_id}' was successfully removed ."}
 
@@ -458,19 +827,24 @@ async def delete_device_service(device_id: str):
         return {"message": f"Device service '{device_id}' was successfully removed. Container was not running"}
     except docker.errors.APIError as e:
         raise HTTPException(status_code=500, detail=str(e))
+    except TimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
 
 @router.post("/get_container_logs")
 async def get_container_logs(device_id:str):
     try:
         # Get the device service container
-        container = client.containers.get(device_id)
-        logs = container.logs(tail=10).decode('utf-8')
+        container = await run_docker("get", container_cache.get_container, device_id)
+        logs = (await run_docker("logs", container.logs, tail=10)).decode('utf-8')
         return {"logs": logs}
 
     except docker.errors.NotFound:
         logger.warning(f"Container '{device_id}' not found.")
         raise HTTPException(status_code=404, detail=f"Container '{device_id}' not found.")
 
+    except TimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
+
     except docker.errors.APIError as e:
         logger.error(f"Docker API error: {e}")
         raise HTTPException(status_code=500, detail="Docker API error while retrieving logs.")
@@ -478,3 +852,45 @@ async def get_container_logs(device_id:str):
     except Exception as e:
         logger.exception(f"Unexpected error while retrieving logs: {e}")
         raise HTTPException(status_code=500, detail="Unexpected error while retrieving logs.")
+
+@router.get("/stream_container_logs")
+async def stream_container_logs(device_id: str,
+                                follow: bool = True,
+                                tail: int | None = 10,
+                                since: float | None = None,
+                                until: float | None = None,
+                                pattern: str | None = None,
+                                level: str | None = None):
+    # Streams the logs of the device service as Server-Sent Events, since and until are unix timestamps
+    if level is not None and level.upper() not in log_stream.LOG_LEVELS:
+        raise HTTPException(status_code=400,
+                            detail=f"Unknown log level '{level}', use one of {list(log_stream.LOG_LEVELS)}")
+
+    try:
+        line_filter = log_stream.make_line_filter(pattern, level)
+    except re.error as e:
+        raise HTTPException(status_code=400, detail=f"Invalid pattern: {str(e)}")
+
+    try:
+        container = await run_docker("get", container_cache.get_container, device_id)
+
+    except docker.errors.NotFound:
+        logger.warning(f"Container '{device_id}' not found.")
+        raise HTTPException(status_code=404, detail=f"Container '{device_id}' not found.")
+
+    except TimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
+
+    log_options = {"follow": follow, "tail": "all" if tail is None else tail}
+    if since is not None:
+        log_options["since"] = since
+    if until is not None:
+        log_options["until"] = until
+
+    # The slot is taken here, without awaiting anything until the response is returned, and released by the stream
+    slot = log_stream.reserve_stream()
+    if slot is None:
+        raise HTTPException(status_code=429, detail="Too many log streams are open, try again later.")
+    return StreamingResponse(log_stream.open_log_events(container, log_options, line_filter, slot),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
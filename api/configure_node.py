@@ -2,6 +2,9 @@ from fastapi import APIRouter, HTTPException
 from ruamel.yaml import YAML
 from pathlib import Path
 from pydantic import BaseModel
+from api.docker_jobs import run_docker
+from api.container_state import container_cache
+from common.timeseries import DEFAULT_RAW_RETENTION_HOURS, DEFAULT_ROLLUP_RETENTION_DAYS
 import docker
 import os
 import logging
@@ -26,6 +29,10 @@ class NodeConfig(BaseModel):
 class MQTTConfig(BaseModel):
     ip: str
 
+class HistorianConfig(BaseModel):
+    raw_hours: int = DEFAULT_RAW_RETENTION_HOURS
+    rollup_days: int = DEFAULT_ROLLUP_RETENTION_DAYS
+
 router = APIRouter(prefix="/api/configure_node")
 
 #Directory for docker container
@@ -217,15 +224,19 @@ async def configure_and_start_mqtt(mqtt_config: MQTTConfig):
 
     # First ensure that there is no MQTT container running
     try:
-        container = client.containers.get("MQTT")
-        container.remove(force=True)
+        container = await run_docker("get", container_cache.get_container, "MQTT")
+        await run_docker("remove", container.remove, force=True)
         logger.info(f"Stopped and removed an already running MQTT container")
     except docker.errors.NotFound:
         logger.info(f"No MQTT container found will proceed as planned")
+    except TimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
 
         #Start the mqtt_publisher application
     try:
-        container = client.containers.run(
+        container = await run_docker(
+            "run",
+            client.containers.run,
             name="MQTT",
             image="jeppeotte/mqtt_publisher:latest",
             volumes={
@@ -239,6 +250,62 @@ async def configure_and_start_mqtt(mqtt_config: MQTTConfig):
     except docker.errors.DockerException as e:
         logger.error(f"There was an error with launching the MQTT docker container {e}")
         raise HTTPException(status_code=500, detail=f"Docker error: {str(e)}")
+    except TimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
+
+@router.post("/Historian")
+async def configure_and_start_historian(historian_config: HistorianConfig):
+    # Store the data of the device services on the gateway, in /mounted_dir/data/timeseries
+    if host_arch not in ["x86_64", "arm64", "amd64"]:
+        raise HTTPException(status_code=400, detail=f"Unsupported host architecture: {host_arch}")
+    if historian_config.raw_hours < 1 or historian_config.rollup_days < 1:
+        raise HTTPException(status_code=400, detail="The retention must be at least 1 hour and 1 day")
+
+    try:
+        config_path = mounted_dir.joinpath("applications/Historian/Historian_config.yaml")
+        config_path.parent.mkdir(parents=True, exist_ok=True)
+
+        yaml = YAML()
+        yaml.indent(mapping=2, sequence=4, offset=2)
+        with open(config_path, 'w') as f:
+            yaml.dump({"retention": {"raw_hours": historian_config.raw_hours,
+                                     "rollup_days": historian_config.rollup_days}}, f)
+
+    except Exception as e:
+        logger.error(f"Error updating Historian config: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Historian configuration failed: {str(e)}")
+
+    # First ensure that there is no Historian container running
+    try:
+        container = await run_docker("get", container_cache.get_container, "Historian")
+        await run_docker("remove", container.remove, force=True)
+        logger.info(f"Stopped and removed an already running Historian container")
+    except docker.errors.NotFound:
+        logger.info(f"No Historian container found will proceed as planned")
+    except TimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
+
+    try:
+        await run_docker(
+            "run",
+            client.containers.run,
+            name="Historian",
+            image="jeppeotte/historian:latest",
+            volumes={
+                host_mounted_dir: {"bind": "/mounted_dir", "mode": "rw"},
+            },
+            extra_hosts={"localhost": "host-gateway"},
+            detach=True,
+            restart_policy={"Name": "unless-stopped"}
+        )
+        return "Historian application has been launched"
+    except docker.errors.DockerException as e:
+        logger.error(f"There was an error with launching the Historian docker container {e}")
+        raise HTTPException(status_code=500, detail=f"Docker error: {str(e)}")
+    except TimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
 
 @router.post("/delete_node")
 async def delete_node():
@@ -260,13 +327,15 @@ async def delete_node():
                 service = application.get("service")
                 # Stop and remove container
                 try:
-                    container = client.containers.get(service)
-                    container.remove(force=True)
+                    container = await run_docker("get", container_cache.get_container, service)
+                    await run_docker("remove", container.remove, force=True)
                     print(f"Stopped and removed container: {service}")
                 except docker.errors.NotFound:
                     print(f"Container {service} not found.")
                 except docker.errors.APIError as e:
                     print(f"Error removing container {service}: {e.explanation}")
+                except TimeoutError as e:
+                    print(f"Error removing container {service}: {e}")
 
         # Loop over all device services
         if device_services:
@@ -276,19 +345,23 @@ async def delete_node():
 
                 # Stop and remove container
                 try:
-                    container = client.containers.get(device_id)
-                    container.remove(force=True)
+                    container = await run_docker("get", container_cache.get_container, device_id)
+                    await run_docker("remove", container.remove, force=True)
                     print(f"Stopped and removed container: {device_id}")
                 except docker.errors.NotFound:
                     print(f"Container {device_id} not found.")
                 except docker.errors.APIError as e:
                     print(f"Error removing container {device_id}: {e.explanation}")
+                except TimeoutError as e:
+                    print(f"Error removing container {device_id}: {e}")
 
                 # Delete config file
                 if config_file_path:
                     if config_file_path.exists():
                         try:
                             config_file_path.unlink()
+                            # The cache of the config, which the device service writes next to it
+                            config_file_path.with_name(f".{config_file_path.name}.cache").unlink(missing_ok=True)
                             print(f"Deleted config file: {config_file_path}")
                         except Exception as e:
                             print(f"Error deleting config file {config_file_path}: {e}")
@@ -0,0 +1,173 @@
+import docker
+import logging
+import sys
+import threading
+import time
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+logger = logging.getLogger(__name__)
+
+# Container state after each lifecycle event, events which are not listed here do not change the state
+EVENT_STATES = {
+    "create": "created",
+    "start": "running",
+    "restart": "running",
+    "unpause": "running",
+    "pause": "paused",
+    "die": "exited",
+    "stop": "exited",
+}
+
+# Events after which the container is inspected again, as the name, image or network settings may have changed
+REFRESH_EVENTS = {"create", "start", "restart", "rename"}
+
+class ContainerStateCache:
+    """In-memory view of all containers on the gateway, kept up to date by the docker events stream.
+
+    The full container list is only read from the docker socket at startup and after the event stream
+    has been lost, afterwards every lookup is served from memory.
+    """
+    def __init__(self, client, reconnect_delay=5):
+        self.client = client
+        self.reconnect_delay = reconnect_delay
+        self.containers = {}  # Container name -> state
+        self.lock = threading.Lock()
+        self.synced = threading.Event()
+        self.stop_event = threading.Event()
+        self.events = None
+        self.thread = None
+
+    @staticmethod
+    def container_state(container, updated):
+        attrs = container.attrs
+        state = attrs.get("State", {})
+        network_settings = attrs.get("NetworkSettings") or {}
+        # Containers on user defined networks only have an address inside of Networks
+        ip = network_settings.get("IPAddress") or next(
+            (network.get("IPAddress") for network in (network_settings.get("Networks") or {}).values()
+             if network.get("IPAddress")), None)
+        return {
+            "id": container.id,
+            "name": container.name,
+            "image": attrs.get("Config", {}).get("Image"),
+            "status": state.get("Status", container.status),
+            "exit_code": state.get("ExitCode"),
+            "health": state.get("Health", {}).get("Status"),
+            "started_at": state.get("StartedAt"),
+            "ip": ip,
+            "updated": updated,
+        }
+
+    def synchronize(self):
+        # Replace the whole view with the current container list
+        updated = time.time_ns()
+        containers = {container.name: self.container_state(container, updated)
+                      for container in self.client.containers.list(all=True)}
+        with self.lock:
+            self.containers = containers
+        self.synced.set()
+        logger.info(f"Container state cache synchronized with {len(containers)} containers")
+
+    def refresh(self, container_id, updated):
+        try:
+            container = self.client.containers.get(container_id)
+        except docker.errors.NotFound:
+            return
+        state = self.container_state(container, updated)
+        with self.lock:
+            # A rename leaves the old name behind
+            for name, cached in list(self.containers.items()):
+                if cached["id"] == state["id"] and name != state["name"]:
+                    del self.containers[name]
+            self.containers[state["name"]] = state
+
+    def apply_event(self, event):
+        action = event.get("Action") or event.get("status") or ""
+        actor = event.get("Actor", {})
+        container_id = actor.get("ID") or event.get("id")
+        attributes = actor.get("Attributes", {})
+        name = attributes.get("name")
+        updated = event.get("timeNano") or int(event.get("time", time.time()) * 1e9)
+
+        with self.lock:
+            cached = self.containers.get(name)
+            # Events from before the last synchronization are already part of the view
+            if cached is not None and cached["updated"] > updated:
+                return
+
+            if action == "destroy":
+                self.containers.pop(name, None)
+                return
+
+            if cached is not None:
+                if action in EVENT_STATES:
+                    cached["status"] = EVENT_STATES[action]
+                    cached["updated"] = updated
+                if action == "die":
+                    exit_code = attributes.get("exitCode")
+                    cached["exit_code"] = int(exit_code) if exit_code is not None else None
+                elif action.startswith("health_status"):
+                    cached["health"] = action.split(":", 1)[1].strip()
+                    cached["updated"] = updated
+
+        if action in REFRESH_EVENTS or (cached is None and action in EVENT_STATES):
+            self.refresh(container_id, updated)
+
+    def watch_events(self):
+        while not self.stop_event.is_set():
+            try:
+                # Subscribe before reading the container list, so that no event is missed in between
+                self.events = self.client.events(decode=True, filters={"type": "container"})
+                self.synchronize()
+                for event in self.events:
+                    self.apply_event(event)
+                    if self.stop_event.is_set():
+                        break
+
+            except Exception as e:
+                if self.stop_event.is_set():
+                    break
+                logger.error(f"Lost the docker event stream: {e}")
+
+            # The view can not be trusted until it has been synchronized again
+            self.synced.clear()
+            if not self.stop_event.is_set():
+                logger.info(f"Resubscribing to the docker event stream in {self.reconnect_delay} seconds")
+                self.stop_event.wait(self.reconnect_delay)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.watch_events, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.events is not None:
+            self.events.close()
+
+    def get_state(self, name):
+        with self.lock:
+            state = self.containers.get(name)
+            return dict(state) if state else None
+
+    def get_states(self):
+        with self.lock:
+            return {name: dict(state) for name, state in self.containers.items()}
+
+    def get_container(self, name):
+        """Get a container object without inspecting it, raises docker.errors.NotFound like containers.get"""
+        if not self.synced.is_set():
+            return self.client.containers.get(name)
+
+        state = self.get_state(name)
+        if state is None:
+            raise docker.errors.NotFound(f"No such container: {name}")
+        return self.client.containers.prepare_model({"Id": state["id"],
+                                                     "Name": f"/{state['name']}",
+                                                     "State": {"Status": state["status"]}})
+
+container_cache = ContainerStateCache(docker.from_env())
@@ -0,0 +1,126 @@
+from fastapi import APIRouter, HTTPException
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import asyncio
+import functools
+import logging
+import os
+import sys
+import time
+import uuid
+from common.metrics import registry
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(prefix="/api/jobs")
+
+# Dedicated pool for the blocking docker-py calls, so that they never run on the event loop.
+# docker-py keeps at most 10 connections to the socket, so there is no gain in going above that.
+docker_executor = ThreadPoolExecutor(max_workers=int(os.getenv("DOCKER_WORKERS", "8")),
+                                     thread_name_prefix="docker")
+
+# Timeout in seconds for each kind of docker operation
+DOCKER_TIMEOUTS = {
+    "get": 10,
+    "list": 10,
+    "logs": 15,
+    "run": 120,
+    "restart": 60,
+    "remove": 60,
+    "exec": 90,
+}
+
+# Finished jobs are kept for the status API until this many jobs exist
+MAX_JOBS = 500
+
+jobs = OrderedDict()
+running_tasks = set()
+
+docker_operation_seconds = registry.histogram("docker_operation_seconds", "Duration of the docker operations",
+                                              ["operation"])
+docker_operation_timeouts = registry.counter("docker_operation_timeouts", "Docker operations which timed out",
+                                             ["operation"])
+
+async def run_docker(operation, func, *args, **kwargs):
+    """Run a blocking docker call in the docker executor with the timeout of the operation.
+
+    Raises TimeoutError when the operation takes too long. The call itself cannot be cancelled,
+    so it keeps running in the background, but the request handler is released.
+    """
+    loop = asyncio.get_running_loop()
+    timeout = DOCKER_TIMEOUTS[operation]
+    try:
+        with docker_operation_seconds.labels(operation).time():
+            return await asyncio.wait_for(
+                loop.run_in_executor(docker_executor, functools.partial(func, *args, **kwargs)), timeout)
+    except TimeoutError:
+        docker_operation_timeouts.labels(operation).inc()
+        logger.error(f"Docker operation '{operation}' timed out after {timeout}s")
+        raise TimeoutError(f"Docker operation '{operation}' timed out after {timeout}s")
+
+async def run_job(job, func, args, kwargs):
+    job["status"] = "running"
+    job["started"] = time.time()
+    try:
+        job["result"] = await run_docker(job["operation"], func, *args, **kwargs)
+        job["status"] = "succeeded"
+    except TimeoutError as e:
+        job["status"] = "timed_out"
+        job["detail"] = str(e)
+    except HTTPException as e:
+        job["status"] = "failed"
+        job["detail"] = e.detail
+    except asyncio.CancelledError:
+        job["status"] = "cancelled"
+        raise
+    except Exception as e:
+        logger.error(f"Job {job['job_id']} ({job['operation']} {job['target']}) failed: {e}")
+        job["status"] = "failed"
+        job["detail"] = str(e)
+    finally:
+        job["finished"] = time.time()
+
+def submit_job(operation, target, func, *args, **kwargs):
+    """Start a docker operation in the background and return the id used to follow it in the job API"""
+    job_id = uuid.uuid4().hex
+    jobs[job_id] = {
+        "job_id": job_id,
+        "operation": operation,
+        "target": target,
+        "status": "pending",
+        "created": time.time(),
+        "started": None,
+        "finished": None,
+        "result": None,
+        "detail": None,
+    }
+
+    # Forget the oldest finished jobs
+    for old_job_id in list(jobs):
+        if len(jobs) <= MAX_JOBS:
+            break
+        if jobs[old_job_id]["finished"] is not None:
+            del jobs[old_job_id]
+
+    task = asyncio.get_running_loop().create_task(run_job(jobs[job_id], func, args, kwargs))
+    # Keep a reference to the task until it is done, otherwise it can be garbage collected
+    running_tasks.add(task)
+    task.add_done_callback(running_tasks.discard)
+    return job_id
+
+@router.get("")
+async def list_jobs(status: str | None = None):
+    return [job for job in jobs.values() if status is None or job["status"] == status]
+
+@router.get("/{job_id}")
+async def get_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job '{job_id}' not found.")
+    return job
@@ -0,0 +1,153 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from concurrent.futures import ThreadPoolExecutor
+import docker
+from docker.errors import ImageNotFound, APIError
+import logging
+import os
+import sys
+import threading
+import time
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(prefix="/api/images")
+
+# List of images to pre-pull
+images_to_pull = [
+    ("jeppeotte/usb_microphone_service", "latest"),
+    ("jeppeotte/s7comm_device_service", "latest"),
+    ("jeppeotte/device_host", "latest"),
+    ("jeppeotte/mqtt_publisher", "latest"),
+    ("jeppeotte/historian", "latest")
+]
+
+# States after which nothing more happens to the image, and the ones where a usable image exists locally
+FINISHED_STATES = {"up_to_date", "pulled", "offline", "failed"}
+AVAILABLE_STATES = {"up_to_date", "pulled", "offline"}
+
+class ImagePrePuller:
+    """Pulls the service images in the background, skipping images whose local digest matches the registry"""
+    def __init__(self, client, images, max_workers=3):
+        self.client = client
+        self.images = images
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.status = {f"{image}:{tag}": {"state": "pending",
+                                          "local_image": False,
+                                          "digest": None,
+                                          "progress": None,
+                                          "detail": None,
+                                          "started": None,
+                                          "finished": None}
+                       for image, tag in images}
+        self.executor = None
+
+    def update(self, reference, **changes):
+        with self.lock:
+            self.status[reference].update(changes)
+
+    def local_digests(self, reference):
+        try:
+            image = self.client.images.get(reference)
+        except ImageNotFound:
+            return None
+        return [repo_digest.split("@", 1)[1] for repo_digest in image.attrs.get("RepoDigests", [])]
+
+    def pull(self, image, tag, reference):
+        # Pull through the low level API to follow the download of each layer
+        layers = {}
+        self.update(reference, state="pulling", progress={"current": 0, "total": 0, "percent": 0.0})
+        for message in self.client.api.pull(image, tag=tag, stream=True, decode=True):
+            if "error" in message:
+                raise APIError(message["error"], explanation=message["error"])
+
+            detail = message.get("progressDetail") or {}
+            if message.get("id") and detail.get("total"):
+                layers[message["id"]] = (detail.get("current", 0), detail["total"])
+            elif message.get("id") and message.get("status") in ("Download complete", "Pull complete", "Already exists"):
+                if message["id"] in layers:
+                    layers[message["id"]] = (layers[message["id"]][1], layers[message["id"]][1])
+
+            current = sum(layer[0] for layer in layers.values())
+            total = sum(layer[1] for layer in layers.values())
+            self.update(reference, progress={"current": current,
+                                             "total": total,
+                                             "percent": round(100 * current / total, 1) if total else 0.0})
+
+    def prepare_image(self, image, tag):
+        reference = f"{image}:{tag}"
+        self.update(reference, state="checking", started=time.time())
+        local_digests = self.local_digests(reference)
+        self.update(reference, local_image=local_digests is not None)
+
+        try:
+            remote_digest = self.client.images.get_registry_data(reference).id
+            self.update(reference, digest=remote_digest)
+        except Exception as e:
+            # Without a connection to the registry the local image is used as it is
+            if local_digests is not None:
+                logger.warning(f"Could not reach the registry for {reference}, using the local image: {e}")
+                self.update(reference, state="offline", detail=str(e), finished=time.time())
+            else:
+                logger.error(f"Could not reach the registry for {reference} and there is no local image: {e}")
+                self.update(reference, state="failed", detail=str(e), finished=time.time())
+            return
+
+        if local_digests and remote_digest in local_digests:
+            logger.info(f"{reference} is up to date, skipping the pull")
+            self.update(reference, state="up_to_date", finished=time.time())
+            return
+
+        try:
+            logger.info(f"Pulling {reference}...")
+            self.pull(image, tag, reference)
+            logger.info(f"Pulled {reference}")
+            self.update(reference, state="pulled", local_image=True, finished=time.time())
+        except ImageNotFound:
+            logger.error(f"Image not found: {reference}")
+            self.update(reference, state="failed", detail="Image not found", finished=time.time())
+        except APIError as e:
+            logger.error(f"Docker API error for {reference}")
+            if "no matching manifest for" in str(e.explanation).lower():
+                detail = "Incompatible image for this machine's architecture (e.g., x86_64 vs ARM)."
+            else:
+                detail = f"Error: {str(e)}"
+            logger.error(detail)
+            self.update(reference, state="failed", detail=detail, finished=time.time())
+        except Exception as e:
+            logger.error(f"Failed to pull {reference}: {e}")
+            self.update(reference, state="failed", detail=str(e), finished=time.time())
+
+    def start(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="image_prepull")
+        for image, tag in self.images:
+            self.executor.submit(self.prepare_image, image, tag)
+
+    def stop(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def get_status(self):
+        with self.lock:
+            return {reference: dict(status) for reference, status in self.status.items()}
+
+# The timeout also bounds how long a registry lookup can take when the gateway is offline
+image_prepuller = ImagePrePuller(docker.from_env(timeout=int(os.getenv("REGISTRY_TIMEOUT", "30"))),
+                                 images_to_pull)
+
+@router.get("/ready")
+async def get_image_readiness():
+    # Answers 503 until every image has been checked or pulled
+    images = image_prepuller.get_status()
+    finished = all(status["state"] in FINISHED_STATES for status in images.values())
+    content = {"finished": finished,
+               "ready": all(status["state"] in AVAILABLE_STATES for status in images.values()),
+               "images": images}
+    return JSONResponse(status_code=200 if finished else 503, content=content)
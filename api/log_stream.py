@@ -0,0 +1,159 @@
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import asyncio
+import logging
+import os
+import re
+import sys
+import threading
+import weakref
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+logger = logging.getLogger(__name__)
+
+# The services log with the format "%(asctime)s - %(levelname)s - %(message)s"
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40, "CRITICAL": 50}
+LEVEL_PATTERN = re.compile(r" - (DEBUG|INFO|WARNING|ERROR|CRITICAL) - ")
+
+# Every followed log holds a thread for as long as the client is connected, so the number of streams is limited
+MAX_LOG_STREAMS = int(os.getenv("MAX_LOG_STREAMS", "4"))
+# Lines buffered per stream before reading from the docker socket is paused
+LOG_QUEUE_SIZE = 256
+# Seconds without a line before a keep-alive comment is sent
+KEEPALIVE_INTERVAL = 15
+
+active_streams = 0
+streams_lock = threading.Lock()
+
+class StreamSlot:
+    """One of the MAX_LOG_STREAMS slots, which is released once"""
+    def __init__(self):
+        self.released = False
+
+    def release(self):
+        global active_streams
+        with streams_lock:
+            if not self.released:
+                self.released = True
+                active_streams -= 1
+
+def reserve_stream():
+    """Take a slot for a log stream, None when all are in use. The check and the increment are done together, so
+    concurrent requests can not open more than MAX_LOG_STREAMS streams"""
+    global active_streams
+    with streams_lock:
+        if active_streams >= MAX_LOG_STREAMS:
+            return None
+        active_streams += 1
+    return StreamSlot()
+
+def make_line_filter(pattern=None, level=None):
+    """Build the server-side filter for log lines, pattern is a regex and level the minimum log level"""
+    regex = re.compile(pattern) if pattern else None
+    min_level = LOG_LEVELS[level.upper()] if level else None
+
+    def line_filter(line):
+        if regex is not None and not regex.search(line):
+            return False
+        if min_level is not None:
+            match = LEVEL_PATTERN.search(line)
+            # Lines without a level, e.g. tracebacks, are kept so that errors are not cut in half
+            if match and LOG_LEVELS[match.group(1)] < min_level:
+                return False
+        return True
+
+    return line_filter
+
+def put_line(queue, loop, closed, text):
+    # Waits while the queue is full, so the docker socket is only read as fast as the client reads. Returns False
+    # when the stream was closed meanwhile.
+    future = asyncio.run_coroutine_threadsafe(queue.put(("line", text)), loop)
+    while True:
+        try:
+            future.result(timeout=0.5)
+            return True
+        except FutureTimeoutError:
+            if closed.is_set():
+                future.cancel()
+                return False
+
+def read_log_lines(container, log_options, line_filter, queue, loop, closed, holder):
+    # Runs in its own thread as the docker log stream is blocking
+    try:
+        stream = container.logs(stream=True, timestamps=True, **log_options)
+        holder["stream"] = stream
+        if closed.is_set():
+            stream.close()
+            return
+        pending = b""
+        for chunk in stream:
+            if closed.is_set():
+                break
+            pending += chunk
+            *lines, pending = pending.split(b"\n")
+            for line in lines:
+                text = line.decode("utf-8", errors="replace").rstrip("\r")
+                if not line_filter(text):
+                    continue
+                if not put_line(queue, loop, closed, text):
+                    return
+        # The last line, without a newline, is queued before the end of the stream
+        text = pending.decode("utf-8", errors="replace")
+        if pending and line_filter(text) and not closed.is_set():
+            put_line(queue, loop, closed, text)
+
+    except Exception as e:
+        if not closed.is_set():
+            logger.error(f"Error while streaming container logs: {e}")
+            asyncio.run_coroutine_threadsafe(queue.put(("error", str(e))), loop)
+
+    finally:
+        if not closed.is_set():
+            asyncio.run_coroutine_threadsafe(queue.put(("end", "")), loop)
+
+def open_log_events(container, log_options, line_filter, slot):
+    """The events of log_events, which release the slot when they end"""
+    events = log_events(container, log_options, line_filter, slot)
+    # A generator which is never iterated, e.g. when the client leaves before the response starts, does not run
+    # its finally, so the slot is also released when the generator is collected
+    weakref.finalize(events, slot.release)
+    return events
+
+async def log_events(container, log_options, line_filter, slot):
+    """Server-Sent Events with the log lines of a container"""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+    closed = threading.Event()
+    holder = {}
+
+    reader = threading.Thread(target=read_log_lines,
+                              args=(container, log_options, line_filter, queue, loop, closed, holder),
+                              daemon=True)
+    reader.start()
+    try:
+        while True:
+            try:
+                kind, data = await asyncio.wait_for(queue.get(), KEEPALIVE_INTERVAL)
+            except TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+
+            if kind == "line":
+                yield f"data: {data}\n\n"
+            elif kind == "error":
+                yield f"event: error\ndata: {data}\n\n"
+            else:
+                yield "event: end\ndata: \n\n"
+                break
+
+    finally:
+        # Also reached when the client disconnects, closing the stream releases the reader thread
+        slot.release()
+        closed.set()
+        stream = holder.get("stream")
+        if stream is not None:
+            stream.close()
@@ -1,7 +1,6 @@
 from fastapi import FastAPI
+from contextlib import asynccontextmanager
 import uvicorn
-import docker
-from docker.errors import ImageNotFound, APIError, ContainerError
 import logging
 import sys
 
@@ -13,43 +12,42 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
-# Download necessary
-client = docker.from_env()
-
-# List of images to pre-pull
-images_to_pull = [
-    ("jeppeotte/usb_microphone_service", "latest"),
-    ("jeppeotte/s7comm_device_service", "latest"),
-    ("jeppeotte/mqtt_publisher", "latest")
-]
-
-for image, tag in images_to_pull:
-    try:
-        logger.info(f"Pulling {image}:{tag}...")
-        client.images.pull(image, tag=tag)
-        logger.info(f"Pulled {image}:{tag}")
-    except ImageNotFound:
-        logger.error(f"Image not found: {image}:{tag}")
-    except APIError as e:
-        logger.error(f"Docker API error for {image}:{tag}")
-        if "no matching manifest for" in str(e.explanation).lower():
-            logger.error("Incompatible image for this machine's architecture (e.g., x86_64 vs ARM).")
-        else:
-            logger.error(f"Error: {str(e)}")
-
 logger.info("Initializing configurator")
 
-# Initialize FastAPI
-app = FastAPI()
-
 # Import API routers
 from api.configure_node import router as configure_node_router
 from api.add_devices import router as add_devices_router
 from api.add_applications import router as add_applications_router
+from api.docker_jobs import router as docker_jobs_router
+from api.services import router as services_router
+from api.image_prepull import router as image_prepull_router
+from api.metrics import router as metrics_router, record_request
+from api.timeseries import router as timeseries_router
+from api.container_state import container_cache
+from api.image_prepull import image_prepuller
+
+@asynccontextmanager
+async def lifespan(app):
+    # Pull the service images in the background, so that the API is available right away
+    image_prepuller.start()
+    # Keep track of the state of the containers while the API is running
+    container_cache.start()
+    yield
+    container_cache.stop()
+    image_prepuller.stop()
+
+# Initialize FastAPI
+app = FastAPI(lifespan=lifespan)
+app.middleware("http")(record_request)
 
 app.include_router(configure_node_router)
 app.include_router(add_devices_router)
 app.include_router(add_applications_router)
+app.include_router(docker_jobs_router)
+app.include_router(services_router)
+app.include_router(image_prepull_router)
+app.include_router(metrics_router)
+app.include_router(timeseries_router)
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,37 @@
+from fastapi import APIRouter, Request
+from fastapi.responses import Response
+from common.metrics import registry, CONTENT_TYPE
+import logging
+import sys
+import time
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+http_request_seconds = registry.histogram("http_request_seconds", "Duration of the requests to the configurator API",
+                                          ["method", "route", "status"])
+
+async def record_request(request: Request, call_next):
+    # Middleware recording the duration of every request per route. The route template is used as label
+    # instead of the path, so that e.g. every device_id does not become a label of its own.
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        http_request_seconds.labels(request.method, route.path if route else "unmatched", status).observe(
+            time.perf_counter() - start)
+
+@router.get("/metrics")
+async def get_metrics():
+    return Response(content=registry.render(), media_type=CONTENT_TYPE)
@@ -0,0 +1,140 @@
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import PlainTextResponse, Response
+from pathlib import Path
+from ruamel.yaml import YAML
+from api.container_state import container_cache
+from api.docker_jobs import run_docker
+from common.metrics import METRICS_PORT
+from common.tracing import MAX_PROFILE_SECONDS
+import docker
+import logging
+import sys
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(prefix="/api/services")
+
+#Directory for docker container
+mounted_dir = Path("/mounted_dir")
+
+# Name of the container which runs the device services in the host mode of metadata.yaml
+DEVICE_HOST = "device_host"
+
+# Fetches a path from the metrics endpoint inside a service container and prints the status code and the body.
+# It is run with docker exec, as the configurator is not on the same network as the service containers.
+FETCH_COMMAND = """
+import sys, urllib.request, urllib.error
+try:
+    response = urllib.request.urlopen(sys.argv[1], timeout=float(sys.argv[2]))
+    status, body = response.status, response.read()
+except urllib.error.HTTPError as e:
+    status, body = e.code, e.read()
+sys.stdout.buffer.write(b"%d\\n" % status + body)
+"""
+
+def service_state(container_state):
+    if container_state is None:
+        return {"status": "not_found", "container": None}
+    return {"status": container_state["status"], "container": container_state}
+
+@router.get("/status")
+async def get_services_status():
+    # The state of every device and application service, served from the container state cache
+    try:
+        yaml = YAML()
+        metadata_path = mounted_dir.joinpath("core/metadata.yaml")
+
+        if not metadata_path.exists():
+            raise HTTPException(status_code=500,
+                                detail=f"metadata.yaml does not exist in the following path {metadata_path}")
+
+        with open(metadata_path, 'r') as f:
+            metadata = yaml.load(f)
+
+    except HTTPException:
+        raise
+
+    except Exception as e:
+        logger.error(f"Could not read metadata.yaml: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    if not container_cache.synced.is_set():
+        raise HTTPException(status_code=503, detail="The container state is not available yet.")
+
+    containers = container_cache.get_states()
+    services = metadata.get("services") or {}
+    # In the host mode the device services share the container of the device host
+    host_mode = metadata.get("device_mode") == "host"
+
+    device_services = [
+        {"device_id": device.get("device_id"),
+         "protocol_type": device.get("protocol_type"),
+         "activated": device.get("activated"),
+         **service_state(containers.get(DEVICE_HOST if host_mode else device.get("device_id")))}
+        for device in services.get("device_services") or []
+    ]
+
+    application_services = [
+        {"service": application.get("service"),
+         "enabled": application.get("enabled"),
+         **service_state(containers.get(application.get("service")))}
+        for application in services.get("application_services") or []
+    ]
+
+    return {"device_services": device_services, "application_services": application_services}
+
+async def fetch_debug_endpoint(service, path, timeout):
+    # Returns the status code and body of a debug path on the metrics endpoint of the service
+    try:
+        container = await run_docker("get", container_cache.get_container, service)
+        url = f"http://127.0.0.1:{METRICS_PORT}{path}"
+        exit_code, (stdout, stderr) = await run_docker("exec", container.exec_run,
+                                                      ["python", "-c", FETCH_COMMAND, url, str(timeout)],
+                                                      demux=True)
+    except docker.errors.NotFound:
+        raise HTTPException(status_code=404, detail=f"No container found for the service {service}")
+    except docker.errors.APIError as e:
+        # E.g. when the container is not running
+        raise HTTPException(status_code=409, detail=str(e.explanation or e))
+    except TimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
+
+    if exit_code != 0 or not stdout:
+        error = (stderr or b"").decode("utf-8", errors="replace").strip().splitlines()
+        logger.error(f"Could not reach the debug endpoint of {service}: {error[-1] if error else exit_code}")
+        raise HTTPException(status_code=502,
+                            detail=f"The debug endpoint of {service} is not reachable, "
+                                   f"the service image may be older than the endpoint")
+
+    status, _, body = stdout.partition(b"\n")
+    return int(status), body
+
+@router.get("/{service}/profile", response_class=PlainTextResponse)
+async def profile_service(service: str, seconds: float = 10, interval_ms: float = 5):
+    # Run the sampling profiler in the service for the given seconds. The result is in the folded stack
+    # format of flamegraph.pl, e.g. curl .../profile?seconds=30 | flamegraph.pl > profile.svg
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be between 0 and {MAX_PROFILE_SECONDS}")
+    if not 0 < interval_ms <= 1000:
+        raise HTTPException(status_code=400, detail="interval_ms must be between 0 and 1000")
+
+    logger.info(f"Profiling {service} for {seconds}s")
+    status, body = await fetch_debug_endpoint(service, f"/debug/profile?seconds={seconds}&interval_ms={interval_ms}",
+                                              timeout=seconds + 10)
+    if status != 200:
+        raise HTTPException(status_code=status, detail=body.decode("utf-8", errors="replace"))
+    return PlainTextResponse(body)
+
+@router.get("/{service}/traces")
+async def get_service_traces(service: str):
+    # The last sampled traces of the hot paths of the service
+    status, body = await fetch_debug_endpoint(service, "/debug/traces", timeout=10)
+    if status != 200:
+        raise HTTPException(status_code=status, detail=body.decode("utf-8", errors="replace"))
+    return Response(content=body, media_type="application/json")
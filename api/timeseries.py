@@ -0,0 +1,63 @@
+from fastapi import APIRouter, HTTPException
+from pathlib import Path
+from common.timeseries import TimeSeriesStore, valid_device
+import asyncio
+import time
+import logging
+import sys
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(prefix="/api/timeseries")
+
+#Directory for docker container
+mounted_dir = Path("/mounted_dir")
+
+# The store is written by the Historian application, the configurator only reads from it
+store = TimeSeriesStore(mounted_dir.joinpath("data/timeseries"))
+
+MAX_POINTS = 100000
+
+def check_device(device_id):
+    if not valid_device(device_id) or device_id not in store.devices():
+        raise HTTPException(status_code=404, detail=f"No stored data for the device {device_id}")
+
+@router.get("/devices")
+async def get_devices():
+    return {"devices": await asyncio.to_thread(store.devices)}
+
+@router.get("/{device_id}/metrics")
+async def get_metrics(device_id: str):
+    check_device(device_id)
+    return {"device_id": device_id, "metrics": await asyncio.to_thread(store.metrics, device_id)}
+
+@router.get("/{device_id}/query")
+async def query_metric(device_id: str, metric: str, start: float | None = None, end: float | None = None,
+                       step: float | None = None, limit: int = 10000):
+    # The raw samples of a metric between start and end (unix time, the last hour by default), or the
+    # min/max/avg/count per step seconds when step is given. To backfill, page through the raw samples by
+    # querying again from the time of the last sample returned.
+    check_device(device_id)
+    end = time.time() if end is None else end
+    start = end - 3600 if start is None else start
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+
+    if step is None:
+        if not 0 < limit <= MAX_POINTS:
+            raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_POINTS}")
+        points = await asyncio.to_thread(store.query, device_id, metric, start, end, limit)
+        return {"device_id": device_id, "metric": metric, "start": start, "end": end,
+                "complete": len(points) < limit, "points": points}
+
+    if step <= 0 or (end - start) / step > MAX_POINTS:
+        raise HTTPException(status_code=400, detail=f"step must be positive and give at most {MAX_POINTS} buckets")
+    buckets = await asyncio.to_thread(store.aggregate, device_id, metric, start, end, step)
+    return {"device_id": device_id, "metric": metric, "start": start, "end": end, "step": step,
+            "buckets": buckets}
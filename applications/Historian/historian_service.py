@@ -0,0 +1,142 @@
+import valkey
+import json
+import time
+import yaml
+import logging
+import signal
+import sys
+from pathlib import Path
+from common.metrics import registry, start_metrics_server
+from common.batch import decode_batch
+from common.timeseries import TimeSeriesStore, DEFAULT_RAW_RETENTION_HOURS, DEFAULT_ROLLUP_RETENTION_DAYS
+import common.tracing  # Adds /debug/profile and /debug/traces to the metrics endpoint
+
+# Configure logging to output INFO and above to stdout
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+logger = logging.getLogger(__name__)
+
+# Stores the data which the device services publish on the message bus in the time-series store of the gateway,
+# so that it can be queried through the configurator without a backend.
+
+#Directory for docker container
+mounted_dir = Path("/mounted_dir")
+
+# Samples are written with one bulk insert per device when this many are buffered, or after FLUSH_INTERVAL
+FLUSH_ROWS = 10000
+FLUSH_INTERVAL = 1.0
+# Seconds between the rollups and the retention of the store
+MAINTENANCE_INTERVAL = 60
+
+historian_samples = registry.counter("historian_samples", "Samples written to the time-series store", ["device"])
+historian_dropped_messages = registry.counter("historian_dropped_messages", "Messages which could not be decoded")
+historian_flush_seconds = registry.histogram("historian_flush_seconds", "Duration of the bulk inserts")
+
+def get_historian_config():
+    config_path = mounted_dir.joinpath("applications/Historian/Historian_config.yaml")
+    config = {}
+    if config_path.exists():
+        with open(config_path, 'r') as f:
+            config = yaml.safe_load(f) or {}
+    else:
+        logger.info(f"No config file under {config_path}, using the default retention")
+
+    retention = config.get("retention") or {}
+    return {"raw_retention_hours": retention.get("raw_hours", DEFAULT_RAW_RETENTION_HOURS),
+            "rollup_retention_days": retention.get("rollup_days", DEFAULT_ROLLUP_RETENTION_DAYS)}
+
+# Connecting to the internal message bus
+def valkey_connection():
+    valkey_client = valkey.Valkey(host="localhost", port=6379)
+
+    # Test connection
+    if not valkey_client.ping():
+        logger.error("No connection to the internal message bus")
+        sys.exit(1)
+
+    logger.info("Connection to the internal message bus was successful")
+    return valkey_client
+
+def decode_rows(message_type, payload):
+    # The samples of a DDATA message or a batch as rows (metric, time, value). Values which are not numbers are
+    # not stored.
+    if message_type == "DBATCH":
+        batch = decode_batch(payload)
+        return [(metric["name"], timestamp, value)
+                for metric in batch["metrics"]
+                for timestamp, value in zip(batch["timestamps"], metric["values"])]
+
+    message = json.loads(payload)
+    message_time = message.get("timestamp", message.get("time"))
+    return [(metric["name"], metric.get("timestamp", message_time), metric["value"])
+            for metric in message.get("metrics", [])
+            if isinstance(metric.get("value"), (int, float))]
+
+class Historian:
+    def __init__(self, valkey_client, store):
+        self.valkey_client = valkey_client
+        self.store = store
+        self.buffers = {}
+        self.buffered_rows = 0
+        self.running = True
+        signal.signal(signal.SIGTERM, self.handle_sigterm)
+
+    def handle_sigterm(self, signum, frame):
+        logger.info("Received SIGTERM, writing the buffered samples")
+        self.running = False
+
+    def flush(self):
+        with historian_flush_seconds.time():
+            for device, rows in self.buffers.items():
+                try:
+                    self.store.append(device, rows)
+                    historian_samples.labels(device).inc(len(rows))
+                except Exception as e:
+                    logger.error(f"Could not write {len(rows)} samples of {device}: {e}")
+        self.buffers = {}
+        self.buffered_rows = 0
+
+    def run(self):
+        pubsub = self.valkey_client.pubsub()
+        # spBv1.0/<group>/<message type>/<node>/<device>
+        pubsub.psubscribe("spBv1.0/*/DDATA/*/*", "spBv1.0/*/DBATCH/*/*")
+
+        next_flush = time.monotonic() + FLUSH_INTERVAL
+        next_maintenance = time.monotonic()
+        while self.running:
+            message = pubsub.get_message(timeout=FLUSH_INTERVAL)
+            if message is not None and message['type'] == 'pmessage':
+                topic = message['channel'].decode('utf-8').split("/")
+                try:
+                    rows = decode_rows(topic[2], message['data'])
+                except Exception as e:
+                    logger.error(f"Could not decode the message on {'/'.join(topic)}: {e}")
+                    historian_dropped_messages.inc()
+                    continue
+                self.buffers.setdefault(topic[4], []).extend(rows)
+                self.buffered_rows += len(rows)
+
+            now = time.monotonic()
+            if self.buffered_rows >= FLUSH_ROWS or (self.buffered_rows and now >= next_flush):
+                self.flush()
+                next_flush = now + FLUSH_INTERVAL
+            if now >= next_maintenance:
+                try:
+                    self.store.maintain()
+                except Exception as e:
+                    logger.error(f"Could not roll up or clean up the time-series store: {e}")
+                next_maintenance = now + MAINTENANCE_INTERVAL
+
+        self.flush()
+        self.store.close_writers()
+        pubsub.close()
+
+if __name__ == "__main__":
+    start_metrics_server()
+    store = TimeSeriesStore(mounted_dir.joinpath("data/timeseries"), **get_historian_config())
+    valkey_client = valkey_connection()
+    Historian(valkey_client, store).run()
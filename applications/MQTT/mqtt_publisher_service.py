@@ -1,11 +1,14 @@
 import paho.mqtt.client as mqtt
 import valkey
 import json
+import threading
 import time
 import yaml
 import logging
 import sys
 from pathlib import Path
+from common.metrics import registry, start_metrics_server
+import common.tracing  # Adds /debug/profile and /debug/traces to the metrics endpoint
 
 # Configure logging to output INFO and above to stdout
 logging.basicConfig(
@@ -19,6 +22,51 @@ logger = logging.getLogger(__name__)
 #Directory for docker container
 mounted_dir = Path("/mounted_dir")
 
+# Metrics of the forwarding from the message bus to the broker, exposed on the metrics endpoint of the container
+mqtt_published_messages = registry.counter("mqtt_published_messages", "Messages published to the MQTT broker", ["topic"])
+mqtt_published_bytes = registry.counter("mqtt_published_bytes", "Payload bytes published to the MQTT broker", ["topic"])
+mqtt_publish_errors = registry.counter("mqtt_publish_errors", "Messages the MQTT client could not queue for publishing")
+mqtt_inflight = registry.gauge("mqtt_inflight_messages", "QoS 1 and 2 messages waiting for an acknowledgement")
+mqtt_queued = registry.gauge("mqtt_queued_messages", "QoS 0 messages queued in the MQTT client and not yet sent")
+
+class PublishTracker:
+    """Counts the messages which the MQTT client accepted and has not yet sent (QoS 0) or which the broker has not
+    yet acknowledged (QoS 1 and 2), by the mid of publish() and of the on_publish callback"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}  # mid -> qos
+        # on_publish can run in the network thread before publish() has returned the mid
+        self.completed = set()
+
+    def published(self, info, qos):
+        # Without a connection only the messages of QoS 1 and 2 are queued, on_publish is never called for the others
+        if info.rc != mqtt.MQTT_ERR_SUCCESS and not (qos > 0 and info.rc == mqtt.MQTT_ERR_NO_CONN):
+            return
+        with self.lock:
+            if info.mid in self.completed:
+                self.completed.discard(info.mid)
+            else:
+                self.pending[info.mid] = qos
+
+    def on_publish(self, client, userdata, mid, reason_code, properties):
+        with self.lock:
+            if self.pending.pop(mid, None) is None:
+                self.completed.add(mid)
+
+    def on_disconnect(self, client, userdata, flags, reason_code, properties):
+        # The client drops the QoS 0 messages it has not sent yet, the others are sent again after the reconnect
+        with self.lock:
+            self.pending = {mid: qos for mid, qos in self.pending.items() if qos > 0}
+
+    def count(self, acknowledged):
+        # The pending messages of QoS 1 and 2 when acknowledged, otherwise of QoS 0
+        with self.lock:
+            return sum((qos > 0) == acknowledged for qos in self.pending.values())
+
+publish_tracker = PublishTracker()
+mqtt_inflight.set_function(lambda: publish_tracker.count(acknowledged=True))
+mqtt_queued.set_function(lambda: publish_tracker.count(acknowledged=False))
+
 def get_node_identity():
     metadata_path = mounted_dir.joinpath("core/metadata.yaml")
 
@@ -62,6 +110,8 @@ def mqtt_connection(identity):
     DDEATHTOPIC = f"spBv1.0/{GROUP_ID}/NDEATH/{EDGE_NODE_ID}"
     # MQTT Client Setup
     mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, EDGE_NODE_ID)
+    mqtt_client.on_publish = publish_tracker.on_publish
+    mqtt_client.on_disconnect = publish_tracker.on_disconnect
 
     # Setting the last will, if connection drops
     mqtt_client.will_set(
@@ -85,12 +135,13 @@ def mqtt_connection(identity):
 
     logger.info("Connection to the broker was successful!")
     # Publish DBIRTH
-    mqtt_client.publish(
+    info = mqtt_client.publish(
         DBIRTHTOPIC,
         payload=json.dumps({"timestamp": time.time(),
                             "status": {"connected": "True"}}),
         qos=0
     )
+    publish_tracker.published(info, 0)
 
     return mqtt_client
 
@@ -117,10 +168,19 @@ def receive_and_publish_messages(valkey_client, mqtt_client):
 
     for message in pubsub.listen():
         if message['type'] == 'pmessage':
-            mqtt_client.publish(message['channel'].decode('utf-8'), message['data'].decode('utf-8'))
+            topic = message['channel'].decode('utf-8')
+            # The payload is forwarded as it is, since the batches of the device services are binary
+            info = mqtt_client.publish(topic, message['data'], qos=0)
+            publish_tracker.published(info, 0)
+            if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                mqtt_published_messages.labels(topic).inc()
+                mqtt_published_bytes.labels(topic).inc(len(message['data']))
+            else:
+                mqtt_publish_errors.inc()
     return
 
 if __name__ == "__main__":
+    start_metrics_server()
     node_identity = get_node_identity()
     valkey_client = valkey_connection()
     mqtt_client = mqtt_connection(node_identity)
@@ -0,0 +1,176 @@
+import json
+import struct
+import time
+
+# Columnar batches of samples for high-rate data.
+#
+# Instead of a DDATA message per poll, with an object and a timestamp per metric, a batch holds N samples of all
+# variables: one array of timestamps shared by the variables and one array of values per variable. A batch is
+# binary and is forwarded by the MQTT publisher as it is. The layout, all little endian:
+#
+#   header     magic "DBAT", version (u8), encoding (u8), samples N (u32), variables M (u16), base time (f64)
+#   metadata   length (u32) and a JSON object with the lists "names", "datatypes", "units" and "formats", and
+#              optionally the object "info" about the batch, e.g. the sample rate of a burst
+#   timestamps microseconds since the base time, the time of the first sample
+#   values     one column per variable, in the struct format of the variable ("f" for REAL, "h" for INT, ...)
+#
+# With the packed encoding the timestamps are i64 and the columns are arrays of their format. The timestamps are
+# signed, as the clock can step back within a batch, e.g. when NTP syncs a gateway without a real time clock, and
+# 64 bit, so that a batch can span more than the 71 minutes of u32 microseconds. Version 1 had u32 timestamps,
+# its batches are still decoded. With the delta
+# encoding the timestamps and the columns are the differences to the previous entry as zigzag varints. Floats
+# are delta encoded through their bit pattern, so the encoding is lossless and a value which does not change
+# takes one byte.
+
+MAGIC = b"DBAT"
+VERSION = 2
+# Struct format of the packed timestamps by version
+PACKED_OFFSETS = {1: "I", 2: "q"}
+ENCODINGS = {"packed": 0, "delta": 1}
+HEADER = struct.Struct("<4sBBIHd")
+LENGTH = struct.Struct("<I")
+# Integer formats with the same size as the float formats, for the delta encoding of the bit patterns
+BIT_PATTERNS = {"f": "i", "d": "q"}
+
+def zigzag_varints(numbers):
+    # Signed integers as zigzag varints: 0, -1, 1, -2 ... are encoded as 0, 1, 2, 3 ... in 7 bits per byte
+    encoded = bytearray()
+    for number in numbers:
+        number = number << 1 if number >= 0 else (-number << 1) - 1
+        while number > 0x7F:
+            encoded.append((number & 0x7F) | 0x80)
+            number >>= 7
+        encoded.append(number)
+    return encoded
+
+def read_zigzag_varints(payload, offset, count):
+    numbers = []
+    for _ in range(count):
+        number, shift = 0, 0
+        while True:
+            byte = payload[offset]
+            offset += 1
+            number |= (byte & 0x7F) << shift
+            shift += 7
+            if byte < 0x80:
+                break
+        numbers.append((number >> 1) ^ -(number & 1))
+    return numbers, offset
+
+def deltas(numbers):
+    previous = 0
+    result = []
+    for number in numbers:
+        result.append(number - previous)
+        previous = number
+    return result
+
+def cumulative(numbers):
+    total = 0
+    result = []
+    for number in numbers:
+        total += number
+        result.append(total)
+    return result
+
+class BatchEncoder:
+    """Encodes the columns of a batch. The metadata of the variables is encoded once"""
+    def __init__(self, names, datatypes, units, formats, encoding="packed"):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown batch encoding {encoding}, use one of {list(ENCODINGS)}")
+        if not len(names) == len(datatypes) == len(units) == len(formats):
+            raise ValueError("names, datatypes, units and formats must have the same length")
+        self.encoding = encoding
+        self.encoding_code = ENCODINGS[encoding]
+        self.formats = list(formats)
+        self.metadata_fields = {"names": list(names), "datatypes": list(datatypes), "units": list(units),
+                                "formats": self.formats}
+        self.metadata = self.encode_metadata(self.metadata_fields)
+
+    @staticmethod
+    def encode_metadata(fields):
+        metadata = json.dumps(fields).encode()
+        return LENGTH.pack(len(metadata)) + metadata
+
+    def encode(self, timestamps, columns, info=None):
+        # timestamps holds the N sample times, columns the N values of every variable, info is added to the
+        # metadata of this batch
+        samples = len(timestamps)
+        base_time = timestamps[0] if samples else time.time()
+        offsets = [round((timestamp - base_time) * 1_000_000) for timestamp in timestamps]
+        parts = [HEADER.pack(MAGIC, VERSION, self.encoding_code, samples, len(self.formats), base_time),
+                 self.metadata if info is None else self.encode_metadata({**self.metadata_fields, "info": info})]
+        if self.encoding == "packed":
+            parts.append(struct.pack(f"<{samples}{PACKED_OFFSETS[VERSION]}", *offsets))
+            for value_format, column in zip(self.formats, columns):
+                parts.append(struct.pack(f"<{samples}{value_format}", *column))
+        else:
+            parts.append(zigzag_varints(deltas(offsets)))
+            for value_format, column in zip(self.formats, columns):
+                if value_format in BIT_PATTERNS:
+                    column = struct.unpack(f"<{samples}{BIT_PATTERNS[value_format]}",
+                                           struct.pack(f"<{samples}{value_format}", *column))
+                parts.append(zigzag_varints(deltas(column)))
+        return b"".join(parts)
+
+def decode_batch(payload):
+    # Returns {"time": <base time>, "timestamps": [...], "metrics": [{"name", "datatype", "units", "values"}],
+    #          "info": <info of the batch or None>}
+    magic, version, encoding, samples, variables, base_time = HEADER.unpack_from(payload)
+    if magic != MAGIC or version not in PACKED_OFFSETS:
+        raise ValueError("The payload is not a batch of a supported version")
+    offset = HEADER.size
+    (metadata_length,) = LENGTH.unpack_from(payload, offset)
+    offset += LENGTH.size
+    metadata = json.loads(payload[offset:offset + metadata_length])
+    offset += metadata_length
+
+    columns = []
+    if encoding == ENCODINGS["packed"]:
+        offsets_format = f"<{samples}{PACKED_OFFSETS[version]}"
+        offsets = struct.unpack_from(offsets_format, payload, offset)
+        offset += struct.calcsize(offsets_format)
+        for value_format in metadata["formats"]:
+            column_format = f"<{samples}{value_format}"
+            columns.append(list(struct.unpack_from(column_format, payload, offset)))
+            offset += struct.calcsize(column_format)
+    else:
+        offset_deltas, offset = read_zigzag_varints(payload, offset, samples)
+        offsets = cumulative(offset_deltas)
+        for value_format in metadata["formats"]:
+            column_deltas, offset = read_zigzag_varints(payload, offset, samples)
+            column = cumulative(column_deltas)
+            if value_format in BIT_PATTERNS:
+                column = list(struct.unpack(f"<{samples}{value_format}",
+                                            struct.pack(f"<{samples}{BIT_PATTERNS[value_format]}", *column)))
+            columns.append(column)
+
+    return {"time": base_time,
+            "timestamps": [base_time + offset / 1_000_000 for offset in offsets],
+            "metrics": [{"name": name, "datatype": datatype, "units": units, "values": column}
+                        for name, datatype, units, column in zip(metadata["names"], metadata["datatypes"],
+                                                                 metadata["units"], columns)],
+            "info": metadata.get("info")}
+
+class Batcher:
+    """Buffers the samples of all variables, and returns a batch when it holds the configured number of samples"""
+    def __init__(self, encoder, samples):
+        self.encoder = encoder
+        self.samples = samples
+        self.timestamps = []
+        self.rows = []
+
+    def add(self, timestamp, values):
+        self.timestamps.append(timestamp)
+        self.rows.append(values)
+        if len(self.timestamps) >= self.samples:
+            return self.flush()
+        return None
+
+    def flush(self):
+        # Returns the buffered samples as a batch, or None when there are none
+        if not self.timestamps:
+            return None
+        payload = self.encoder.encode(self.timestamps, list(zip(*self.rows)))
+        self.timestamps, self.rows = [], []
+        return payload
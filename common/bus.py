@@ -0,0 +1,83 @@
+import logging
+import threading
+import time
+from collections import deque
+
+from common.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Publisher of the internal message bus which is shared by the devices of the device host.
+#
+# publish() queues the message and returns, and one thread sends everything which is queued in a pipeline, so the
+# devices do not wait for Valkey and many small messages take one round trip. While the bus is quiet a message is
+# sent on its own as soon as it is queued. It takes the place of the Valkey client in the services: publish() in
+# common.metrics calls publish() of the publisher, and pubsub() returns a subscription of the shared client. When
+# Valkey can not be reached the messages are dropped after the error is logged, like a failed publish would be,
+# and at most MAX_QUEUED messages are kept waiting.
+
+MAX_QUEUED = 10000
+
+bus_flush_seconds = registry.histogram("bus_flush_seconds", "Duration of sending the queued messages in a pipeline")
+bus_flush_messages = registry.histogram("bus_flush_messages", "Messages sent per pipeline",
+                                        buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+bus_dropped_messages = registry.counter("bus_dropped_messages",
+                                        "Messages which were not published, as the queue was full or Valkey failed")
+
+class BusPublisher:
+    def __init__(self, valkey_client, max_queued=MAX_QUEUED):
+        self.valkey_client = valkey_client
+        self.max_queued = max_queued
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.stopped = False
+        registry.gauge("bus_queued_messages", "Messages waiting to be published").set_function(lambda: len(self.queue))
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def publish(self, topic, payload):
+        with self.condition:
+            if len(self.queue) >= self.max_queued:
+                bus_dropped_messages.inc()
+                return 0
+            self.queue.append((topic, payload))
+            self.condition.notify()
+        return 1
+
+    def pubsub(self):
+        return self.valkey_client.pubsub()
+
+    def ping(self):
+        return self.valkey_client.ping()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.stopped:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                messages = list(self.queue)
+                self.queue.clear()
+            self.send(messages)
+
+    def send(self, messages):
+        start = time.perf_counter()
+        try:
+            pipeline = self.valkey_client.pipeline(transaction=False)
+            for topic, payload in messages:
+                pipeline.publish(topic, payload)
+            pipeline.execute()
+        except Exception as e:
+            bus_dropped_messages.inc(len(messages))
+            logger.error(f"Could not publish {len(messages)} message(s) to the message bus: {e}")
+            return
+        bus_flush_seconds.observe(time.perf_counter() - start)
+        bus_flush_messages.observe(len(messages))
+
+    def close(self, timeout=5):
+        # Sends the queued messages and stops the thread
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join(timeout)
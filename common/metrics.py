@@ -0,0 +1,305 @@
+import bisect
+import logging
+import os
+import resource
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+logger = logging.getLogger(__name__)
+
+# Lightweight metrics registry shared by the services. The metrics are exposed in the Prometheus text format,
+# by the configurator on /metrics and by the other services on their own HTTP endpoint (METRICS_PORT).
+#
+# Updating a metric takes a lock and an addition, so it can be done on the hot path. The child of a labelled
+# metric can be looked up once with labels() and kept, e.g. in __init__ of the class which updates it.
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Buckets in seconds, from the sub-millisecond PLC reads to the uploads of audio files
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+def format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+class CounterChild:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name):
+        yield name, (), self.value
+
+class GaugeChild:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0.0
+        self.function = None
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set_function(self, function):
+        # The gauge is read from the function when the metrics are collected
+        self.function = function
+
+    def samples(self, name):
+        if self.function is None:
+            yield name, (), self.value
+            return
+        try:
+            yield name, (), float(self.function())
+        except Exception as e:
+            logger.debug(f"Could not collect {name}: {e}")
+
+class HistogramChild:
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        return Timer(self)
+
+    def samples(self, name):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            yield name + "_bucket", (("le", format_value(float(bound))),), cumulative
+        yield name + "_count", (), cumulative
+        yield name + "_sum", (), total
+
+class Timer:
+    """Context manager observing the duration of the block in a histogram"""
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+class Metric:
+    def __init__(self, name, documentation, labelnames, child_factory):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.child_factory = child_factory
+        self.lock = threading.Lock()
+        self.children = {}
+        if not self.labelnames:
+            self.unlabelled = self.labels()
+
+    def labels(self, *labelvalues, **labelkwargs):
+        if labelkwargs:
+            labelvalues = tuple(labelkwargs[name] for name in self.labelnames)
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(f"{self.name} has the labels {self.labelnames}, got {labelvalues}")
+        key = tuple(str(value) for value in labelvalues)
+        child = self.children.get(key)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(key, self.child_factory())
+        return child
+
+    @property
+    def exposition_name(self):
+        return self.name
+
+    def render(self):
+        name = self.exposition_name
+        lines = [f"# HELP {name} {self.documentation}", f"# TYPE {name} {self.type}"]
+        for labelvalues, child in list(self.children.items()):
+            for sample_name, extra_labels, value in child.samples(name):
+                lines.append(f"{sample_name}{format_labels(self.labelnames, labelvalues, extra_labels)} "
+                             f"{format_value(value)}")
+        return lines
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames, CounterChild)
+
+    @property
+    def exposition_name(self):
+        return self.name + "_total"
+
+    def inc(self, amount=1):
+        self.unlabelled.inc(amount)
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames, GaugeChild)
+
+    def set(self, value):
+        self.unlabelled.set(value)
+
+    def inc(self, amount=1):
+        self.unlabelled.inc(amount)
+
+    def dec(self, amount=1):
+        self.unlabelled.dec(amount)
+
+    def set_function(self, function):
+        self.unlabelled.set_function(function)
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, lambda: HistogramChild(buckets))
+
+    def observe(self, value):
+        self.unlabelled.observe(value)
+
+    def time(self):
+        return self.unlabelled.time()
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, metric):
+        # Registering a metric twice returns the first one, so that modules can be reloaded
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                    raise ValueError(f"The metric {metric.name} is already registered with another type or labels")
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = MetricsRegistry()
+
+def resident_memory_bytes():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+registry.gauge("process_cpu_seconds", "User and system CPU time of the process in seconds").set_function(time.process_time)
+registry.gauge("process_resident_memory_bytes", "Resident memory of the process in bytes").set_function(resident_memory_bytes)
+registry.gauge("process_max_resident_memory_bytes", "High-water mark of the resident memory in bytes").set_function(
+    lambda: resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+
+# Metrics of the internal message bus, used by every service which publishes to it
+bus_published_messages = registry.counter("bus_published_messages", "Messages published to the message bus", ["topic"])
+bus_published_bytes = registry.counter("bus_published_bytes", "Payload bytes published to the message bus", ["topic"])
+bus_publish_seconds = registry.histogram("bus_publish_seconds", "Latency of publishing to the message bus")
+
+def publish(valkey_client, topic, payload):
+    # Publish to the message bus and record the latency, the message and its size
+    start = time.perf_counter()
+    result = valkey_client.publish(topic, payload)
+    bus_publish_seconds.observe(time.perf_counter() - start)
+    bus_published_messages.labels(topic).inc()
+    bus_published_bytes.labels(topic).inc(len(payload))
+    return result
+
+# Other modules can serve their own paths on the metrics endpoint. A route is called with the query
+# parameters and returns the status code, the content type and the body.
+routes = {}
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == "/metrics":
+            status, content_type, body = 200, CONTENT_TYPE, self.server.registry.render()
+        elif url.path in routes:
+            query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+            try:
+                status, content_type, body = routes[url.path](query)
+            except Exception as e:
+                logger.error(f"Error while serving {url.path}: {e}")
+                status, content_type, body = 500, "text/plain; charset=utf-8", str(e)
+        else:
+            self.send_error(404)
+            return
+        body = body.encode("utf-8") if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class MetricsServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, handler=MetricsHandler, metrics_registry=registry):
+        super().__init__(address, handler)
+        self.registry = metrics_registry
+
+def start_metrics_server(port=METRICS_PORT, host="0.0.0.0", metrics_registry=registry):
+    # Serve the metrics from a daemon thread, METRICS_PORT=0 turns the endpoint off.
+    # The service keeps running without metrics when the port can not be used.
+    if not port:
+        return None
+    try:
+        server = MetricsServer((host, port), metrics_registry=metrics_registry)
+    except OSError as e:
+        logger.error(f"Could not start the metrics endpoint on port {port}: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Serving metrics on port {port}")
+    return server
@@ -0,0 +1,97 @@
+import json
+import math
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Serialization of the data messages of the device services from templates.
+#
+# The name, data type and unit of a variable do not change between polls, so the bytes of each metric object,
+# except its value and timestamp, are encoded once from the config. A poll only encodes the changed values and
+# the timestamp, and joins them with the precomputed fragments. The result is the same as json.dumps of the
+# message as a dict, with the keys in the same order, including NaN and Infinity for values which are not finite.
+#
+# When orjson is installed it encodes the floats which json.dumps writes without an exponent, 1e-4 <= |value| <
+# 1e16, as both write the shortest digits which read back as the value, and the integers and booleans. When every
+# changed value is one of these they are encoded in one call, otherwise one at a time. float.__repr__ is used for
+# the other floats, as orjson writes their exponents differently (1e16 instead of 1e+16).
+
+# Placeholders for the fields of a metric which change with every poll
+VALUE = object()
+TIMESTAMP = object()
+
+def encode_value(value):
+    # The value as json.dumps encodes it
+    if type(value) is float:
+        if orjson is not None and (1e-4 <= abs(value) < 1e16 or value == 0.0):
+            return orjson.dumps(value)
+        if math.isfinite(value):
+            return float.__repr__(value).encode()
+        return json.dumps(value).encode()
+    if type(value) is int:
+        return int.__repr__(value).encode()
+    return json.dumps(value).encode()
+
+def orjson_compatible(value):
+    # True when orjson encodes the value as json.dumps does
+    if type(value) is float:
+        return 1e-4 <= abs(value) < 1e16 or value == 0.0
+    return type(value) is bool or type(value) is int and -2 ** 63 <= value < 2 ** 64
+
+def encode_values(values):
+    if orjson is not None and values and all(map(orjson_compatible, values)):
+        # Numbers and booleans contain no comma, so the array encoded in one call splits into the values
+        return orjson.dumps(values)[1:-1].split(b",")
+    return [encode_value(value) for value in values]
+
+class MetricsSerializer:
+    """Serializes {time_key: <time>, "metrics": [<changed metrics>]} from templates of the metrics.
+
+    fields lists the keys of a metric object in order, each with a list holding the value of every variable,
+    or with VALUE or TIMESTAMP for the fields which are filled in by serialize().
+    """
+    def __init__(self, fields, time_key="time"):
+        slots = [values for _, values in fields if values is VALUE or values is TIMESTAMP]
+        if len(slots) != 2 or VALUE not in slots or TIMESTAMP not in slots:
+            raise ValueError("The fields of a metric need exactly one VALUE and one TIMESTAMP")
+        variables = len(next(values for _, values in fields if values is not VALUE and values is not TIMESTAMP))
+
+        self.envelope_start = b"{" + json.dumps(time_key).encode() + b": "
+        self.metrics_start = b", \"metrics\": ["
+        self.value_first = slots[0] is VALUE
+        self.templates = []
+        for index in range(variables):
+            fragments, current = [], "{"
+            for key, values in fields:
+                if current != "{":
+                    current += ", "
+                current += json.dumps(key) + ": "
+                if values is VALUE or values is TIMESTAMP:
+                    fragments.append(current.encode())
+                    current = ""
+                else:
+                    current += json.dumps(values[index])
+            fragments.append((current + "}").encode())
+            self.templates.append(tuple(fragments))
+
+    def serialize(self, indexes, values, timestamp, message_time=None):
+        # indexes are the variables to include and values holds the current value of every variable
+        encoded_values = encode_values([values[index] for index in indexes])
+        encoded_timestamp = encode_value(timestamp)
+        parts = [self.envelope_start, encode_value(time.time() if message_time is None else message_time),
+                 self.metrics_start]
+        separator = False
+        for index, encoded_value in zip(indexes, encoded_values):
+            if separator:
+                parts.append(b", ")
+            separator = True
+            start, middle, end = self.templates[index]
+            if self.value_first:
+                parts += (start, encoded_value, middle, encoded_timestamp, end)
+            else:
+                parts += (start, encoded_timestamp, middle, encoded_value, end)
+        parts.append(b"]}")
+        return b"".join(parts)
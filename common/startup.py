@@ -0,0 +1,107 @@
+import hashlib
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+import yaml
+
+from common.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Cold start of the device services: the cache of the validated config files, and the timing of the phases of the
+# startup.
+#
+# Parsing a config file with many variables as YAML takes far longer than validating it, so the validated config
+# is cached as the JSON of the model next to the file, e.g. devices/S7Comm/.plc1.yaml.cache. The cache starts with
+# a hash of the config file and of the module of the model, and is only used while both are unchanged. It is
+# validated again when it is loaded, so a cache which is not valid is never worse than parsing the file. A cache
+# which can not be written, e.g. on a read only mount, is skipped.
+#
+# StartupTimer logs how long each phase of the startup took, and sets them in the startup_seconds gauge.
+
+KEY_SIZE = hashlib.sha256().digest_size
+# The C parser of PyYAML is used where libyaml is installed, for the files which are not cached
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+startup_seconds = registry.gauge("startup_seconds", "Duration of the phases of the startup of the service",
+                                 ["phase"])
+
+def cache_path(config_path):
+    config_path = Path(config_path)
+    return config_path.with_name(f".{config_path.name}.cache")
+
+def cache_key(content, model):
+    # Changes with the config file and with the definition of the model
+    key = hashlib.sha256(content)
+    model_file = getattr(sys.modules.get(model.__module__), "__file__", None)
+    if model_file:
+        with open(model_file, "rb") as f:
+            key.update(f.read())
+    return key.digest()
+
+def write_cache(path, key, config):
+    try:
+        with tempfile.NamedTemporaryFile("wb", dir=path.parent, prefix=path.name, delete=False) as f:
+            f.write(key + config.model_dump_json().encode())
+        os.replace(f.name, path)
+    except OSError as e:
+        logger.debug(f"Could not write the config cache {path}: {e}")
+
+def load_config(config_path, model):
+    # Returns the config file validated as the model, from the cache when the file has not changed. Raises
+    # OSError, yaml.YAMLError and pydantic.ValidationError like reading and validating the file would.
+    with open(config_path, "rb") as f:
+        content = f.read()
+    key = cache_key(content, model)
+    path = cache_path(config_path)
+    try:
+        with open(path, "rb") as f:
+            cached = f.read()
+        if cached[:KEY_SIZE] == key:
+            config = model.model_validate_json(cached[KEY_SIZE:])
+            logger.info(f"Loaded the config {config_path} from the cache")
+            return config
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logger.warning(f"The config cache {path} can not be used, reading the config file: {e}")
+
+    config = model.model_validate(yaml.load(content, Loader=YAML_LOADER))
+    write_cache(path, key, config)
+    return config
+
+class StartupTimer:
+    """Times the phases of the startup. mark(phase) ends the phase which began at the previous mark, timed() times
+    a phase which runs alongside the others, e.g. in a thread"""
+    def __init__(self, start=None):
+        self.start = self.last = start if start is not None else time.perf_counter()
+        self.phases = []
+        self.lock = threading.Lock()
+
+    def record(self, phase, seconds):
+        with self.lock:
+            self.phases.append((phase, seconds))
+        startup_seconds.labels(phase).set(seconds)
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.record(phase, now - self.last)
+        self.last = now
+
+    def timed(self, phase, function, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.record(phase, time.perf_counter() - start)
+
+    def log(self):
+        total = time.perf_counter() - self.start
+        startup_seconds.labels("total").set(total)
+        with self.lock:
+            phases = ", ".join(f"{phase} {seconds * 1000:.0f} ms" for phase, seconds in self.phases)
+        logger.info(f"Started in {total * 1000:.0f} ms: {phases}")
@@ -0,0 +1,58 @@
+import struct
+import sys
+from pathlib import Path
+
+repository_dir = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(repository_dir))
+
+import pytest
+from common.batch import BatchEncoder, Batcher, decode_batch, HEADER, MAGIC, LENGTH, ENCODINGS
+
+# Tests of the columnar batches, run with: python -m pytest common
+
+BASE_TIME = 1_760_000_000.0
+NAMES, DATATYPES, UNITS, FORMATS = ["pressure", "count", "state"], ["REAL", "INT", "BOOL"], ["bar", "", ""], ["f", "h", "B"]
+# Microseconds after the base time: the clock steps back by 2 s after the third sample, and the last sample is
+# more than 2**32 microseconds after the first
+OFFSETS = [0, 10_000, 20_000, -1_980_000, -1_970_000, 2**32 + 123_456, 2**33]
+
+def columns(samples):
+    return [[0.5 * index for index in range(samples)],
+            [index - 3 for index in range(samples)],
+            [index % 2 for index in range(samples)]]
+
+@pytest.mark.parametrize("encoding", ["packed", "delta"])
+def test_round_trip_with_a_clock_step_and_a_long_span(encoding):
+    timestamps = [BASE_TIME + offset / 1_000_000 for offset in OFFSETS]
+    encoder = BatchEncoder(NAMES, DATATYPES, UNITS, FORMATS, encoding)
+    batch = decode_batch(encoder.encode(timestamps, columns(len(timestamps)), {"rate": 100.0}))
+    assert batch["time"] == BASE_TIME
+    assert [round((timestamp - BASE_TIME) * 1_000_000) for timestamp in batch["timestamps"]] == OFFSETS
+    assert [metric["values"] for metric in batch["metrics"]] == columns(len(timestamps))
+    assert [metric["name"] for metric in batch["metrics"]] == NAMES
+    assert batch["info"] == {"rate": 100.0}
+
+@pytest.mark.parametrize("encoding", ["packed", "delta"])
+def test_batcher(encoding):
+    batcher = Batcher(BatchEncoder(NAMES, DATATYPES, UNITS, FORMATS, encoding), samples=3)
+    payloads = [batcher.add(BASE_TIME - index, (1.5, index, 1)) for index in range(4)]
+    assert payloads[:2] == [None, None] and payloads[3] is None
+    batch = decode_batch(payloads[2])
+    assert batch["timestamps"] == [BASE_TIME, BASE_TIME - 1, BASE_TIME - 2]
+    assert batch["metrics"][1]["values"] == [0, 1, 2]
+    assert decode_batch(batcher.flush())["timestamps"] == [BASE_TIME - 3]
+    assert batcher.flush() is None
+
+def test_decodes_version_1():
+    # Version 1 had the packed timestamps as u32
+    metadata = b'{"names": ["a"], "datatypes": ["REAL"], "units": [""], "formats": ["f"]}'
+    payload = (HEADER.pack(MAGIC, 1, ENCODINGS["packed"], 2, 1, BASE_TIME) + LENGTH.pack(len(metadata)) + metadata
+               + struct.pack("<2I", 0, 2**32 - 1) + struct.pack("<2f", 1.0, 2.0))
+    batch = decode_batch(payload)
+    assert batch["timestamps"] == [BASE_TIME, BASE_TIME + (2**32 - 1) / 1_000_000]
+    assert batch["metrics"][0]["values"] == [1.0, 2.0]
+
+def test_unknown_version():
+    payload = HEADER.pack(MAGIC, 99, 0, 0, 0, BASE_TIME) + LENGTH.pack(2) + b"{}"
+    with pytest.raises(ValueError, match="supported version"):
+        decode_batch(payload)
@@ -0,0 +1,51 @@
+import sys
+from pathlib import Path
+
+repository_dir = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(repository_dir))
+
+from common.timeseries import TimeSeriesStore, HOUR, ROLLUP_DELAY
+
+# Tests of the time-series store, run with: python -m pytest common
+
+HOUR_START = 1_760_000_400 // HOUR * HOUR
+
+def hourly_rollup(store, device, metric):
+    # The rollup of the hour at 1 hour resolution, after the raw file is gone
+    return store.aggregate(device, metric, HOUR_START, HOUR_START + HOUR, HOUR)
+
+def test_late_samples_roll_the_hour_up_again(tmp_path):
+    store = TimeSeriesStore(tmp_path, raw_retention_hours=2)
+    store.append("plc", [("pressure", HOUR_START + 10, 1.0), ("pressure", HOUR_START + 20, 3.0)])
+    store.maintain(now=HOUR_START + HOUR + ROLLUP_DELAY)
+    # A batch with samples of the hour arrives after it was rolled up
+    store.append("plc", [("pressure", HOUR_START + 3590, 8.0)])
+    store.maintain(now=HOUR_START + HOUR + ROLLUP_DELAY + 60)
+    store.close_writers()
+    # Retention deletes the raw file, and the rollups hold all three samples
+    store.maintain(now=HOUR_START + 3 * HOUR)
+    assert store.raw_hours("plc") == []
+    assert hourly_rollup(store, "plc", "pressure") == [
+        {"time": HOUR_START, "min": 1.0, "max": 8.0, "avg": 4.0, "count": 3}]
+
+def test_unchanged_hours_are_not_rolled_up_again(tmp_path, caplog):
+    store = TimeSeriesStore(tmp_path)
+    store.append("plc", [("pressure", HOUR_START + 10, 1.0)])
+    store.maintain(now=HOUR_START + HOUR + ROLLUP_DELAY)
+    caplog.clear()
+    with caplog.at_level("INFO"):
+        store.maintain(now=HOUR_START + HOUR + ROLLUP_DELAY + 60)
+    assert "Rolled up" not in caplog.text
+
+def test_aggregate_of_an_hour_deleted_meanwhile(tmp_path, monkeypatch):
+    store = TimeSeriesStore(tmp_path, raw_retention_hours=2)
+    store.append("plc", [("pressure", HOUR_START + 10, 2.0)])
+    store.maintain(now=HOUR_START + HOUR + ROLLUP_DELAY)
+    store.close_writers()
+    # The retention deletes the file between raw_hours() and the read of the hour
+    raw_hours = store.raw_hours("plc")
+    store.maintain(now=HOUR_START + 3 * HOUR)
+    monkeypatch.setattr(store, "raw_hours", lambda device: raw_hours)
+    assert hourly_rollup(store, "plc", "pressure") == [
+        {"time": HOUR_START, "min": 2.0, "max": 2.0, "avg": 2.0, "count": 1}]
+    assert store.query("plc", "pressure", HOUR_START, HOUR_START + HOUR) == []
@@ -0,0 +1,283 @@
+import calendar
+import logging
+import math
+import sqlite3
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Embedded time-series store of the gateway, kept under /mounted_dir/data/timeseries.
+#
+# The raw samples of a device are appended to one SQLite file per hour, <device>/raw/<hour>.sqlite, with bulk
+# inserts. When an hour is over its samples are downsampled into min/max/sum/count rollups for every resolution
+# in ROLLUP_RESOLUTIONS, which are kept in <device>/rollups.sqlite. Samples which arrive after their hour was
+# rolled up, e.g. from a batch or a burst which is published after the hour ended, are appended to its file as
+# well, and the hour is rolled up again: the last rowid of every rolled up hour is kept, and an hour whose file
+# has rows beyond it is rolled up anew from all of its samples. Retention deletes whole hour files, and the
+# rollups after their own, longer retention. The files are in WAL mode, so the configurator can query them while
+# the historian writes to them.
+
+ROLLUP_RESOLUTIONS = (60, 3600)
+DEFAULT_RAW_RETENTION_HOURS = 24
+DEFAULT_ROLLUP_RETENTION_DAYS = 30
+# Seconds after the end of an hour before it is first rolled up, so that most samples which are published late,
+# e.g. in batches, are in the first rollup. Later samples roll the hour up again.
+ROLLUP_DELAY = 60
+HOUR = 3600
+HOUR_FORMAT = "%Y-%m-%dT%H"
+
+RAW_SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (metric TEXT NOT NULL, time REAL NOT NULL, value REAL);
+CREATE INDEX IF NOT EXISTS samples_metric_time ON samples (metric, time);
+"""
+ROLLUP_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rollups (resolution INTEGER NOT NULL, metric TEXT NOT NULL, time REAL NOT NULL,
+                                    min REAL, max REAL, sum REAL, count INTEGER,
+                                    PRIMARY KEY (resolution, metric, time)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rolled_up_rows (hour REAL PRIMARY KEY, last_rowid INTEGER);
+DROP TABLE IF EXISTS rolled_up_hours;
+"""
+
+def hour_name(hour_start):
+    return time.strftime(HOUR_FORMAT, time.gmtime(hour_start))
+
+def hour_start_of(name):
+    return calendar.timegm(time.strptime(name, HOUR_FORMAT))
+
+def valid_device(device):
+    # The device id is used as a directory name
+    return bool(device) and Path(device).name == device and not device.startswith(".")
+
+def open_database(path, schema=None, read_only=False):
+    if read_only:
+        connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+    else:
+        connection = sqlite3.connect(path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(schema)
+    return connection
+
+class TimeSeriesStore:
+    def __init__(self, data_dir, raw_retention_hours=DEFAULT_RAW_RETENTION_HOURS,
+                 rollup_retention_days=DEFAULT_ROLLUP_RETENTION_DAYS, resolutions=ROLLUP_RESOLUTIONS):
+        self.data_dir = Path(data_dir)
+        self.raw_retention = raw_retention_hours * HOUR
+        self.rollup_retention = rollup_retention_days * 24 * HOUR
+        self.resolutions = tuple(sorted(resolutions))
+        # Connections of the writer to the hour files it appends to, by device and hour
+        self.writers = {}
+
+    def raw_path(self, device, hour_start):
+        return self.data_dir.joinpath(device, "raw", f"{hour_name(hour_start)}.sqlite")
+
+    def rollup_path(self, device):
+        return self.data_dir.joinpath(device, "rollups.sqlite")
+
+    def raw_hours(self, device):
+        # The start of every hour which has a file of raw samples
+        hours = []
+        for path in self.data_dir.joinpath(device, "raw").glob("*.sqlite"):
+            try:
+                hours.append(hour_start_of(path.stem))
+            except ValueError:
+                logger.warning(f"Ignoring the unknown file {path}")
+        return sorted(hours)
+
+    def devices(self):
+        if not self.data_dir.exists():
+            return []
+        return sorted(path.name for path in self.data_dir.iterdir() if path.is_dir() and valid_device(path.name))
+
+    # Writing
+    def writer(self, device, hour_start):
+        connection = self.writers.get((device, hour_start))
+        if connection is None:
+            path = self.raw_path(device, hour_start)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            connection = self.writers[(device, hour_start)] = open_database(path, RAW_SCHEMA)
+        return connection
+
+    def append(self, device, rows):
+        # Appends the rows (metric, time, value) of a device, with one transaction per hour
+        if not valid_device(device):
+            raise ValueError(f"Invalid device id {device!r}")
+        by_hour = {}
+        for row in rows:
+            by_hour.setdefault(int(row[1] // HOUR) * HOUR, []).append(row)
+        for hour_start, hour_rows in by_hour.items():
+            with self.writer(device, hour_start) as connection:
+                connection.executemany("INSERT INTO samples (metric, time, value) VALUES (?, ?, ?)", hour_rows)
+
+    def close_writers(self, before=None):
+        # Closes the connections to the hour files which started before the given time, or all of them
+        for key in [key for key in self.writers if before is None or key[1] < before]:
+            self.writers.pop(key).close()
+
+    def close_writers_of(self, device, hour_start):
+        connection = self.writers.pop((device, hour_start), None)
+        if connection is not None:
+            connection.close()
+
+    # Downsampling and retention
+    def roll_up(self, device, hour_start):
+        with open_database(self.rollup_path(device), ROLLUP_SCHEMA) as rollups:
+            raw = open_database(self.raw_path(device, hour_start), read_only=True)
+            try:
+                # Read before the samples, so that rows which are appended meanwhile roll the hour up again
+                last_rowid = raw.execute("SELECT MAX(rowid) FROM samples").fetchone()[0]
+                for resolution in self.resolutions:
+                    rows = raw.execute("SELECT ?, metric, CAST(time / ? AS INTEGER) * ? AS bucket, "
+                                       "MIN(value), MAX(value), SUM(value), COUNT(value) FROM samples "
+                                       "WHERE value IS NOT NULL GROUP BY metric, bucket",
+                                       (resolution, resolution, resolution)).fetchall()
+                    rollups.executemany("INSERT OR REPLACE INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            finally:
+                raw.close()
+            rollups.execute("INSERT OR REPLACE INTO rolled_up_rows VALUES (?, ?)", (hour_start, last_rowid))
+        rollups.close()
+
+    def last_rowid(self, device, hour_start):
+        # The rowid of the last sample of an hour, None when it has none
+        raw = self.reader(self.raw_path(device, hour_start))
+        if raw is None:
+            return None
+        try:
+            return raw.execute("SELECT MAX(rowid) FROM samples").fetchone()[0]
+        except sqlite3.OperationalError:
+            return None
+        finally:
+            raw.close()
+
+    def maintain(self, now=None):
+        # Rolls up the hours which are over and applies the retention. Called periodically by the historian.
+        now = time.time() if now is None else now
+        self.close_writers(before=int((now - ROLLUP_DELAY) // HOUR) * HOUR - HOUR)
+        for device in self.devices():
+            rollups = open_database(self.rollup_path(device), ROLLUP_SCHEMA)
+            try:
+                rolled_up = dict(rollups.execute("SELECT hour, last_rowid FROM rolled_up_rows"))
+            finally:
+                rollups.close()
+
+            for hour_start in self.raw_hours(device):
+                if hour_start + HOUR + ROLLUP_DELAY > now:
+                    continue
+                if hour_start not in rolled_up or self.last_rowid(device, hour_start) != rolled_up[hour_start]:
+                    try:
+                        self.roll_up(device, hour_start)
+                        logger.info(f"Rolled up {hour_name(hour_start)} of {device}"
+                                    f"{' again with late samples' if hour_start in rolled_up else ''}")
+                    except sqlite3.Error as e:
+                        logger.error(f"Could not roll up {hour_name(hour_start)} of {device}: {e}")
+                        continue
+                if hour_start + HOUR <= now - self.raw_retention:
+                    self.close_writers_of(device, hour_start)
+                    path = self.raw_path(device, hour_start)
+                    for file in (path, Path(f"{path}-wal"), Path(f"{path}-shm")):
+                        file.unlink(missing_ok=True)
+                    logger.info(f"Deleted the raw samples of {hour_name(hour_start)} of {device}")
+
+            with open_database(self.rollup_path(device), ROLLUP_SCHEMA) as rollups:
+                rollups.execute("DELETE FROM rollups WHERE time < ?", (now - self.rollup_retention,))
+                rollups.execute("DELETE FROM rolled_up_rows WHERE hour < ?", (now - self.rollup_retention,))
+            rollups.close()
+
+    # Queries
+    def reader(self, path):
+        # None when the file does not exist, e.g. as the retention has just deleted it
+        try:
+            return open_database(path, read_only=True)
+        except sqlite3.OperationalError:
+            return None
+
+    def metrics(self, device):
+        names = set()
+        paths = [self.raw_path(device, hour_start) for hour_start in self.raw_hours(device)]
+        for path in paths + [self.rollup_path(device)]:
+            connection = self.reader(path)
+            if connection is None:
+                continue
+            try:
+                table = "rollups" if path == self.rollup_path(device) else "samples"
+                names.update(row[0] for row in connection.execute(f"SELECT DISTINCT metric FROM {table}"))
+            except sqlite3.OperationalError:
+                # The file has just been created and has no tables yet
+                pass
+            finally:
+                connection.close()
+        return sorted(names)
+
+    def query(self, device, metric, start, end, limit=10000):
+        # The raw samples [time, value] in [start, end), as far as they are retained, up to limit samples
+        points = []
+        for hour_start in self.raw_hours(device):
+            if hour_start + HOUR <= start or hour_start >= end or len(points) >= limit:
+                continue
+            connection = self.reader(self.raw_path(device, hour_start))
+            if connection is None:
+                continue
+            try:
+                points.extend(connection.execute("SELECT time, value FROM samples WHERE metric = ? AND time >= ? "
+                                                 "AND time < ? ORDER BY time LIMIT ?",
+                                                 (metric, start, end, limit - len(points))).fetchall())
+            except sqlite3.OperationalError:
+                pass
+            finally:
+                connection.close()
+        return [list(point) for point in points]
+
+    def aggregate(self, device, metric, start, end, step):
+        # min/max/avg/count of the samples in buckets of step seconds. Hours with raw samples are aggregated from
+        # them, older hours from the rollups with the largest resolution that fits into step.
+        buckets = {}
+
+        def merge(bucket, minimum, maximum, total, count):
+            if not count:
+                return
+            current = buckets.get(bucket)
+            if current is None:
+                buckets[bucket] = [minimum, maximum, total, count]
+            else:
+                current[0] = min(current[0], minimum)
+                current[1] = max(current[1], maximum)
+                current[2] += total
+                current[3] += count
+
+        raw_hours = set(self.raw_hours(device))
+        fitting = [resolution for resolution in self.resolutions if step % resolution == 0]
+        resolution = fitting[-1] if fitting else self.resolutions[0]
+        rollups = self.reader(self.rollup_path(device))
+        try:
+            hour_start = int(start // HOUR) * HOUR
+            while hour_start < end:
+                hour_end = hour_start + HOUR
+                range_start, range_end = max(start, hour_start), min(end, hour_end)
+                # An hour whose raw file was deleted since raw_hours() is answered from the rollups
+                raw = self.reader(self.raw_path(device, hour_start)) if hour_start in raw_hours else None
+                if raw is not None:
+                    try:
+                        rows = raw.execute("SELECT CAST((time - ?) / ? AS INTEGER) AS bucket, MIN(value), "
+                                           "MAX(value), SUM(value), COUNT(value) FROM samples WHERE metric = ? "
+                                           "AND time >= ? AND time < ? AND value IS NOT NULL GROUP BY bucket",
+                                           (start, step, metric, range_start, range_end)).fetchall()
+                    except sqlite3.OperationalError:
+                        rows = []
+                    finally:
+                        raw.close()
+                    for bucket, minimum, maximum, total, count in rows:
+                        merge(start + bucket * step, minimum, maximum, total, count)
+                elif rollups is not None:
+                    rows = rollups.execute("SELECT time, min, max, sum, count FROM rollups WHERE resolution = ? "
+                                           "AND metric = ? AND time >= ? AND time < ?",
+                                           (resolution, metric, range_start, range_end)).fetchall()
+                    for bucket_time, minimum, maximum, total, count in rows:
+                        merge(start + math.floor((bucket_time - start) / step) * step, minimum, maximum, total, count)
+                hour_start = hour_end
+        finally:
+            if rollups is not None:
+                rollups.close()
+
+        return [{"time": bucket, "min": minimum, "max": maximum, "avg": total / count, "count": count}
+                for bucket, (minimum, maximum, total, count) in sorted(buckets.items())]
@@ -0,0 +1,135 @@
+import collections
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+from common.metrics import registry, routes
+
+logger = logging.getLogger(__name__)
+
+# Tracing of the hot paths of the services, and a statistical profiler which can be run on demand.
+#
+# A trace follows one iteration of a sampling loop through its stages, e.g. read, decode, diff, serialize and
+# publish. Only a fraction of the iterations is traced (TRACE_SAMPLE_RATE), the others get NO_TRACE, whose methods
+# do nothing. The stages of a sampled trace are recorded in the trace_stage_seconds histogram and the last traces
+# are kept for /debug/traces on the metrics endpoint.
+#
+# The profiler samples the stacks of all threads with sys._current_frames() and returns them in the folded format
+# of flamegraph.pl, which speedscope and most other flame graph tools can read as well. It is started with
+# /debug/profile?seconds=N on the metrics endpoint, which is what the configurator calls for a container.
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+MAX_PROFILE_SECONDS = 60
+
+trace_stage_seconds = registry.histogram("trace_stage_seconds", "Duration of the stages of the sampled traces",
+                                         ["trace", "stage"])
+
+class Trace:
+    """One sampled iteration. mark(stage) ends the stage which began at the previous mark"""
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+        self.start_time = time.time()
+        self.start = self.last = time.perf_counter()
+        self.stages = []
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+
+    def finish(self):
+        self.tracer.record(self)
+
+class NoTrace:
+    def mark(self, stage):
+        pass
+
+    def finish(self):
+        pass
+
+NO_TRACE = NoTrace()
+
+class Tracer:
+    def __init__(self, sample_rate=TRACE_SAMPLE_RATE, max_traces=100):
+        self.sample_rate = sample_rate
+        self.traces = collections.deque(maxlen=max_traces)
+        self.stage_histograms = {}
+
+    def start_trace(self, name):
+        # One random number per iteration when the trace is not sampled
+        if self.sample_rate and random.random() < self.sample_rate:
+            return Trace(self, name)
+        return NO_TRACE
+
+    def record(self, trace):
+        for stage, duration in trace.stages:
+            histogram = self.stage_histograms.get((trace.name, stage))
+            if histogram is None:
+                histogram = self.stage_histograms[(trace.name, stage)] = trace_stage_seconds.labels(trace.name, stage)
+            histogram.observe(duration)
+        self.traces.append({"trace": trace.name,
+                            "time": trace.start_time,
+                            "total": trace.last - trace.start,
+                            "stages": dict(trace.stages)})
+
+tracer = Tracer()
+
+class SamplingProfiler:
+    """Samples the stacks of all threads except its own at a fixed interval"""
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def folded_stack(self, thread_name, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        stack.append(thread_name)
+        return ";".join(reversed(stack))
+
+    def profile(self, seconds, interval=0.005):
+        # Returns the folded stacks with the number of samples of each, or None when a profile is already running
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            own_thread = threading.get_ident()
+            samples = collections.Counter()
+            end = time.perf_counter() + seconds
+            while time.perf_counter() < end:
+                thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id != own_thread:
+                        samples[self.folded_stack(thread_names.get(thread_id, str(thread_id)), frame)] += 1
+                time.sleep(interval)
+            return "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
+        finally:
+            self.lock.release()
+
+profiler = SamplingProfiler()
+
+def serve_profile(query):
+    try:
+        seconds = float(query.get("seconds", 10))
+        interval = float(query.get("interval_ms", 5)) / 1000
+    except ValueError:
+        return 400, "text/plain; charset=utf-8", "seconds and interval_ms must be numbers"
+    if not 0 < seconds <= MAX_PROFILE_SECONDS or not 0 < interval <= 1:
+        return 400, "text/plain; charset=utf-8", f"seconds must be between 0 and {MAX_PROFILE_SECONDS}, interval_ms between 0 and 1000"
+
+    logger.info(f"Profiling for {seconds}s")
+    folded = profiler.profile(seconds, interval)
+    if folded is None:
+        return 409, "text/plain; charset=utf-8", "A profile is already running"
+    return 200, "text/plain; charset=utf-8", folded
+
+def serve_traces(query):
+    return 200, "application/json", json.dumps(list(tracer.traces))
+
+routes["/debug/profile"] = serve_profile
+routes["/debug/traces"] = serve_traces
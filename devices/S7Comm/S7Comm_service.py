@@ -1,8 +1,21 @@
 import time
+# Start of the service, the imports are the first phase of the startup
+started = time.perf_counter()
 import threading
 import snap7
 import math
 from models.devicemodels import S7CommDeviceServiceConfig
+from common.metrics import registry, publish, start_metrics_server
+from common.tracing import tracer
+from common.serialization import MetricsSerializer, VALUE, TIMESTAMP
+from common.batch import BatchEncoder, Batcher
+from common.startup import load_config, StartupTimer
+from read_planner import plan_groups, data_format, configured_blocks, partition_requests
+from connection_pool import ConnectionPool, open_connections
+from reconnect import Reconnector
+from ring_buffer import RingBufferHarvester
+from conditions import Trigger
+from config_reload import ConfigWatcher, changed_fields, config_reloads, CONNECTION_FIELDS, IDENTITY_FIELDS
 import yaml
 from pathlib import Path
 import valkey
@@ -11,6 +24,7 @@ import argparse
 import sys
 import logging
 import signal
+from concurrent.futures import ThreadPoolExecutor
 
 logging.basicConfig(
     level=logging.INFO,
@@ -20,28 +34,21 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
-#Setting the path for the config file
-parser = argparse.ArgumentParser()
-parser.add_argument(
-    "--device_service_config_path",
-    help="Parse the path for the device service config file from metadata"
-)
-args = parser.parse_args()
-
-if not args.device_service_config_path:
-    logging.error("Error: You must provide --device_service_config_path (path to the device service config file from metadata.yaml).")
-    sys.exit(1)
-
 #Directory for docker container
 mounted_dir = Path("/mounted_dir")
 
+# Metrics of the hot paths, exposed on the metrics endpoint of the container
+# Labelled by the device, as the device host runs several readers in one process
+read_seconds = registry.histogram("s7_read_seconds", "Latency of reads from the PLC per area", ["device", "area"])
+poll_overruns = registry.counter("poll_overruns", "Polls which took longer than the poll interval", ["device", "loop"])
+
 # Get configuration from config file
 def get_device_config(device_config_path):
     config_path = mounted_dir.joinpath(device_config_path)
 
     try:
-        with open(config_path, 'r') as f:
-            device_config = yaml.safe_load(f)
+        # From the cache when the file has not changed since the last start
+        config = load_config(config_path, S7CommDeviceServiceConfig)
 
     except FileNotFoundError:
         logging.error(f"Error: The configuration file '{config_path}' does not exist.")
@@ -51,8 +58,6 @@ def get_device_config(device_config_path):
         logging.error(f"Error reading the YAML file: {e}")
         sys.exit(1)
 
-    config = S7CommDeviceServiceConfig.model_validate(device_config)
-
     # Return all data from configfile
     return config
 
@@ -91,7 +96,8 @@ def connect_to_plc(device_config, retries=3, delay=5):
             client.connect(
                 device_config.device.ip,
                 device_config.device.rack,
-                device_config.device.slot
+                device_config.device.slot,
+                tcp_port=device_config.device.port or 102
             )
 
             if client.get_connected():
@@ -111,215 +117,415 @@ def connect_to_plc(device_config, retries=3, delay=5):
             logging.error("All retry attempts failed. Exiting.")
             sys.exit(1)
 
+def value_changed(previous, current):
+    if previous is None:
+        return True
+    if isinstance(current, float):
+        return not math.isclose(previous, current, rel_tol=1e-6)
+    return previous != current
+
 class PLCReader:
-    def __init__(self, device_config, client, valkey_client):
-        self.device_config = device_config
-        # Get the configuration of the data trigger
-        self.data_trigger_config = next((trigger for trigger in device_config.triggers if trigger.trigger_type == "data_trigger"),
-                                        None)
-        # Get the configuration of the process trigger
-        self.process_trigger_config = next((trigger for trigger in device_config.triggers if trigger.trigger_type == "process_trigger"),
-                                        None)
-        self.data_block = self.device_config.data_block
-        self.polling_intervals = self.device_config.polling
+    def __init__(self, device_config, client, valkey_client, extra_clients=None, config_path=None):
         self.client = client
-        self.valkey_client = valkey_client
         self.client_lock = threading.Lock() #Lock the client so that only 1 thread can access it at the time
+        device_id = device_config.device.device_id
+        self.read_seconds = {area: read_seconds.labels(device_id, area) for area in ("DB", "MK", "PE", "PA", "multi")}
+        self.config_reloads = {result: config_reloads.labels(device_id, result)
+                               for result in ("applied", "invalid", "restart")}
+        # Further connections for reading the data blocks in parallel, as many as the PLC accepts
+        if extra_clients is None:
+            extra_clients = open_connections(device_config, device_config.connections - 1) \
+                if configured_blocks(device_config) and device_config.connections > 1 else []
+        self.connection_pool = ConnectionPool(self.client, self.client_lock, extra_clients, self.read_seconds)
+        try:
+            self.apply_plan(device_config, self.plan_sampling(device_config))
+        except ValueError as e:
+            logger.error(f"Invalid data block or trigger configuration: {e}")
+            sys.exit(1)
+        self.valkey_client = valkey_client
         self.process_event = threading.Event()
         self.trigger_event = threading.Event()
+        self.data_trigger_state = None
         self.stop_event = threading.Event()
+        # The threads of the sampling, and the event which stops them when the config is reloaded
+        self.sampling_stopped, self.sampling_threads = None, []
+        # The config file is watched for changes, which are applied while the service runs
+        self.config_watcher = ConfigWatcher(config_path, device_config) if config_path is not None else None
+        # A failed read is recovered by reconnecting within the service, the triggers and schedules are kept
+        self.reconnector = Reconnector(self.connection_pool, device_config, self.stop_event, self.probe_plc,
+                                       self.publish_disconnected, self.restore_sampling)
         self.DDEATH_topic = f"spBv1.0/{device_config.device.group_id}/DDEATH/{device_config.device.node_id}/{device_config.device.device_id}"
         self.DBIRTH_topic = f"spBv1.0/{device_config.device.group_id}/DBIRTH/{device_config.device.node_id}/{device_config.device.device_id}"
         self.state_topic = f"spBv1.0/{device_config.device.group_id}/STATE/{device_config.device.node_id}/{device_config.device.device_id}"
         self.data_topic = f"spBv1.0/{device_config.device.group_id}/DDATA/{device_config.device.node_id}/{device_config.device.device_id}"
-        signal.signal(signal.SIGTERM, self.handle_sigterm)
+        self.batch_topic = f"spBv1.0/{device_config.device.group_id}/DBATCH/{device_config.device.node_id}/{device_config.device.device_id}"
+        self.data_overruns = poll_overruns.labels(device_id, "data")
         logging.info(f"Starting up the S7Comm service for device: {device_config.device.device_id}")
         # Publish that the device is turning on
-        self.valkey_client.publish(self.DBIRTH_topic, json.dumps({"time": time.time(),
+        publish(self.valkey_client, self.DBIRTH_topic, json.dumps({"time": time.time(),
                                                                   "status": {"connected": "True"}
                                                                   }))
         logger.info(f"Starting up the S7Comm service for device: {device_config.device.device_id}")
 
-    def monitor_process(self):
+    def plan_sampling(self, device_config, previous=None):
+        # The data blocks, read groups, ring buffers and triggers of a config, raises ValueError for an invalid
+        # config. The parts which have not changed since the previous config are kept with their state: the
+        # buffers and schedules of the read groups, the counters of the ring buffers and the state of the triggers.
+        data_blocks = configured_blocks(device_config)
+        pdu_length = self.connection_pool.pdu_length()
+        same_link = previous is not None and self.planned_link == (pdu_length, len(self.connection_pool))
+        same_blocks = same_link and configured_blocks(previous) == data_blocks
+        if same_blocks and previous.polling == device_config.polling:
+            read_groups = self.read_groups
+        else:
+            # The variables of all data blocks and areas grouped by rate class, with the requests to read each group
+            # split across the connections to the PLC
+            read_groups = plan_groups(data_blocks, device_config.polling, pdu_length,
+                                      connections=len(self.connection_pool))
+
+        # The ring buffers which the PLC program fills at cycle rate
+        running = {harvester.config.name: harvester for harvester in self.harvesters} if same_link else {}
+        device_id = device_config.device.device_id
+        harvesters = [running[ring_buffer.name] if ring_buffer.name in running and
+                      running[ring_buffer.name].config == ring_buffer else
+                      RingBufferHarvester(ring_buffer, pdu_length, device_id)
+                      for ring_buffer in device_config.ring_buffers]
+
+        # The conditions of the triggers, compiled once
+        triggers = []
+        for trigger_type in ("process_trigger", "data_trigger"):
+            trigger_config = next((trigger for trigger in device_config.triggers
+                                   if trigger.trigger_type == trigger_type), None)
+            running = getattr(self, trigger_type) if same_blocks else None
+            if trigger_config is None:
+                triggers.append(None)
+            elif running is not None and running.config == trigger_config:
+                triggers.append(running)
+            else:
+                triggers.append(Trigger(trigger_config, data_blocks, pdu_length))
+        return data_blocks, read_groups, harvesters, *triggers
+
+    def apply_plan(self, device_config, plan):
+        self.device_config = device_config
+        self.polling_intervals = device_config.polling
+        self.data_blocks, self.read_groups, self.harvesters, self.process_trigger, self.data_trigger = plan
+        self.planned_link = (self.connection_pool.pdu_length(), len(self.connection_pool))
+
+    def sampling(self, stopped):
+        # Whether the threads of the sampling keep running, stopped is set when the config is reloaded
+        return not (self.stop_event.is_set() or stopped.is_set())
+
+    def wait_for(self, event, stopped):
+        # Waits until the event is set, returns False when the sampling stops before
+        while not event.wait(0.1):
+            if not self.sampling(stopped):
+                return False
+        return self.sampling(stopped)
+
+    def monitor_process(self, stopped):
         # Determine if the "main" process has begun, so that the script do not spam the PLC with requests when it is idle
-        trigger_source = self.process_trigger_config.source
-        variable_type = trigger_source.get("variable_type")
-        logger.info(f"Process trigger variable_type: {variable_type}")
-        db_number = int(trigger_source.get("db_number"))
-        logger.info(f"Process trigger db_number: {db_number}")
-        byte_offset = int(trigger_source.get("byte_offset"))
-        logger.info(f"Process trigger byte_offset: {byte_offset}")
-        bit_offset = int(trigger_source.get("bit_offset"))
-        logger.info(f"Process trigger bite_offset: {bit_offset}")
-        bool_index = int(trigger_source.get("bool_index"))
-        logger.info(f"Process trigger bool_index: {bool_index}")
-        trigger_condition = self.process_trigger_config.condition
-        logger.info(f"Process trigger condition: {trigger_condition}")
-        poll_timer = getattr(self.polling_intervals, "process_trigger", 1.0)
+        trigger = self.process_trigger
+        logger.info(f"Process trigger condition: {trigger.condition.text}")
+        poll_timer = self.polling_intervals.process_trigger or 1.0
         logger.info(f"Checking the status of the process every: {poll_timer}s")
         previous_value = None
 
-        while not self.stop_event.is_set():
-            # Read state of PLC
+        while self.sampling(stopped):
+            # Read the variables of the condition from the PLC
             try:
                 with self.client_lock:
-                    if variable_type == "Memory bit":
-                        # Read from M area
-                        reading = self.client.read_area(
-                            area=snap7.type.Areas.MK, db_number=0, start=byte_offset, size=1
-                        )
-                        trigger_value = snap7.util.get_bool(reading, 0, bool_index)
-
-                    elif variable_type == "Boolean variable":
-                        # Read from DB area
-                        reading = self.client.read_area(
-                            area=snap7.type.Areas.DB, db_number=db_number, start=byte_offset, size=1
-                        )
-                        trigger_value = snap7.util.get_bool(reading, 0, bit_offset)
-
-                    else:
-                        raise ValueError(f"Unsupported variable_type: {variable_type}")
-
+                    self.connection_pool.read_requests(self.client, trigger.requests)
             except Exception as e:
-                logging.error(f"Could not connect to the client with the following exception: {e}")
-                logging.info("Restarting the container")
-                self.valkey_client.publish(self.DDEATH_topic, json.dumps({
-                    "time": time.time(),
-                    "status": {"connected": "False"}
-                }))
-                self.stop_event.set()
-                sys.exit(1)
+                if self.reconnector.recover(e):
+                    continue
+                return
+            self.reconnector.read_succeeded()
 
+            trigger.update()
+            trigger_value = trigger.evaluate()
             # Publish initial value or changed value
             if previous_value is None or trigger_value != previous_value:
                 logging.info(f"The state of the process: {trigger_value}")
-                self.valkey_client.publish(self.state_topic, json.dumps({"time": time.time(),
+                publish(self.valkey_client, self.state_topic, json.dumps({"time": time.time(),
                                                                          "status": {"process_trigger": str(trigger_value)}
                                                                    }))
                 previous_value = trigger_value
-            # print(f"This is the trigger state:{self.trigger_state}")
-            if trigger_value != trigger_condition:
-                trigger_state = trigger_value
-                if not trigger_state:
-                    self.process_event.clear()  # Clear event when trigger is False
-                else:
-                    self.process_event.set()  # Set event when trigger is True
-            time.sleep(poll_timer)
-
-    def monitor_trigger(self):
-        trigger_source = self.data_trigger_config.source
-        db_number = int(trigger_source.get("db_number"))
-        logger.info(f"Data trigger db_number: {db_number}")
-        byte_offset = int(trigger_source.get("byte_offset"))
-        logger.info(f"Data trigger byte_offset: {byte_offset}")
-        bit_offset = int(trigger_source.get("bit_offset"))
-        logger.info(f"Data trigger byte_offset: {bit_offset}")
-        trigger_condition = self.process_trigger_config.condition
-        logger.info(f"Data trigger condition: {trigger_condition}")
-        poll_timer = getattr(self.polling_intervals, "data_trigger", 1.0)
+            if trigger_value:
+                self.process_event.set()  # Set event when trigger is True
+            else:
+                self.process_event.clear()  # Clear event when trigger is False
+            stopped.wait(poll_timer)
+
+    def monitor_trigger(self, stopped):
+        trigger = self.data_trigger
+        logger.info(f"Data trigger condition: {trigger.condition.text}")
+        poll_timer = self.polling_intervals.data_trigger or 1.0
         logger.info(f"Checking if to poll data every: {poll_timer}s")
 
-        previous_value = None
+        while self.sampling(stopped):
+            if trigger.in_data_blocks and self.trigger_event.is_set():
+                # While the data is sampled the condition is evaluated on the values of its polls
+                stopped.wait(poll_timer)
+                continue
 
-        while not self.stop_event.is_set():
-            # Read trigger data from PLC
+            # Read the variables of the condition from the PLC
             try:
                 with self.client_lock:
-                    reading = self.client.db_read(db_number, byte_offset, 1)
-
+                    self.connection_pool.read_requests(self.client, trigger.requests)
             except Exception as e:
-                logging.error(f"Could not connect to the client with the following exception: {e}")
-                logging.info("Restarting the container")
-                self.valkey_client.publish(self.DDEATH_topic, json.dumps({"time": time.time(),
-                                                                          "status": {"connected": "False"}
-                                                                          }))
-                self.stop_event.set()
-                sys.exit(1)
-
-            trigger_value = snap7.util.get_bool(reading, 0, 0)
-
-            # Publish initial value or changed value
-            if previous_value is None or trigger_value != previous_value:
-                logging.info(f"Data trigger state: {trigger_value}")
-                self.valkey_client.publish(self.state_topic, json.dumps({"time": time.time(),
-                                                                         "status": {"data_trigger": str(trigger_value)}
-                                                                         }))
-                previous_value = trigger_value
-
-            self.process_event.wait()
-            #print(f"This is the trigger state:{self.trigger_state}")
-            if trigger_value != trigger_condition:
-                trigger_state = trigger_value
-                if not trigger_state:
-                    self.trigger_event.clear()  # Clear event when trigger is False
-                else:
-                    self.trigger_event.set()  # Set event when trigger is True
-            time.sleep(poll_timer)
-
-    def sample_main_data(self):
-        data_db_number = self.data_block.db_number
-        data_byte_offset = self.data_block.byte_offset
-        data_read_size = self.data_block.read_size
-        previous_values = None
-        variable_byte_offsets = [variable.byte_offset for variable in self.data_block.variables]
-        min_offset = min(variable_byte_offsets)
-        adjusted_variable_byte_offsets = [x - min_offset for x in variable_byte_offsets]
-        variable_units = [variable.units for variable in self.data_block.variables]
-        variable_names = [variable.name for variable in self.data_block.variables]
-        variable_bit_offsets = [variable.bit_offset for variable in self.data_block.variables]
-        indexes = range(len(variable_names))
-        variable_data_types = [variable.data_type for variable in self.data_block.variables]
-        poll_timer = self.polling_intervals.get("data_interval")
+                if self.reconnector.recover(e):
+                    continue
+                return
+            self.reconnector.read_succeeded()
+
+            trigger.update()
+            trigger_value = trigger.evaluate()
+            if not self.wait_for(self.process_event, stopped):
+                return
+            self.update_data_trigger(trigger_value)
+            stopped.wait(poll_timer)
+
+    def update_data_trigger(self, trigger_value):
+        # Publish initial value or changed value
+        if self.data_trigger_state is None or trigger_value != self.data_trigger_state:
+            logging.info(f"Data trigger state: {trigger_value}")
+            publish(self.valkey_client, self.state_topic, json.dumps({"time": time.time(),
+                                                                     "status": {"data_trigger": str(trigger_value)}
+                                                                     }))
+            self.data_trigger_state = trigger_value
+        if trigger_value:
+            self.trigger_event.set()  # Set event when trigger is True
+        else:
+            self.trigger_event.clear()  # Clear event when trigger is False
+
+    def sample_main_data(self, stopped):
+        read_groups, data_trigger = self.read_groups, self.data_trigger
+        variables = [variable for block in self.data_blocks for variable in block.variables]
+        variable_units = [variable.units for variable in variables]
+        variable_names = [variable.name for variable in variables]
+        variable_data_types = [variable.data_type for variable in variables]
+        current_values = [None] * len(variables)
+        # The last published value of every variable, None until it has been read
+        previous_values = [None] * len(variables)
+        # The metric of every variable is encoded once, the polls only add the value and the timestamp
+        serializer = MetricsSerializer([("name", variable_names),
+                                        ("value", VALUE),
+                                        ("timestamp", TIMESTAMP),
+                                        ("datatype", variable_data_types),
+                                        ("units", variable_units)])
+        # The first poll reads and decodes all variables, also of the read groups which were kept when the config
+        # was reloaded
+        for group in read_groups:
+            group.reset_changes()
+            group.next_due = time.perf_counter()
+        # The data trigger is evaluated on the values of the polls while they run, when it only uses them
+        evaluate_trigger = data_trigger is not None and data_trigger.in_data_blocks
+        # In batch mode every sample is buffered and published in columnar batches instead of DDATA messages.
+        # The variables of the slower rate classes repeat their last value in the samples between their reads.
+        batcher = None
+        if self.device_config.batch is not None:
+            batcher = Batcher(BatchEncoder(variable_names, variable_data_types, variable_units,
+                                           [data_format(data_type) for data_type in variable_data_types],
+                                           self.device_config.batch.encoding),
+                              self.device_config.batch.samples)
+
+        while self.sampling(stopped):
+            if not self.trigger_event.is_set():
+                if batcher is not None:
+                    # Publish the samples of the last recording before waiting for the next one
+                    payload = batcher.flush()
+                    if payload is not None:
+                        publish(self.valkey_client, self.batch_topic, payload)
+                if not self.wait_for(self.trigger_event, stopped):  # Block until trigger is True
+                    break
+                # Read every group as soon as the trigger is set
+                for group in read_groups:
+                    group.next_due = time.perf_counter()
+
+            # Read the groups which are due from the PLC
+            poll_start = time.perf_counter()
+            due_groups = [group for group in read_groups if group.next_due <= poll_start]
+            trace = tracer.start_trace("s7_data")
+            try:
+                self.connection_pool.read(due_groups)
+            except Exception as e:
+                if self.reconnector.recover(e):
+                    continue
+                return
+            self.reconnector.read_succeeded()
 
-        while not self.stop_event.is_set():
-            self.trigger_event.wait()  # Block until trigger is True
+            trace.mark("read")
+            sample_time = time.time()
+            # Value extraction, of the variables whose bytes have changed since the last read
+            group_values = [(group, [change for read_range in group.ranges for change in read_range.changes()])
+                            for group in due_groups]
+            for _, values in group_values:
+                for index, value in values:
+                    current_values[index] = value
+            trace.mark("decode")
+            if evaluate_trigger and not data_trigger.evaluate(current_values):
+                # The sample is published, and the sampling stops after it
+                self.update_data_trigger(False)
+
+            # Value comparison, per group for the adaptive polling
+            changed_indexes = []
+            for group, values in group_values:
+                group_changes = [index for index, value in values if value_changed(previous_values[index], value)]
+                group.adapt(bool(group_changes))
+                changed_indexes += group_changes
+            for index in changed_indexes:
+                previous_values[index] = current_values[index]
+            trace.mark("diff")
+
+            if batcher is not None:
+                payload = batcher.add(sample_time, list(current_values))
+                if payload is not None:
+                    trace.mark("serialize")
+                    publish(self.valkey_client, self.batch_topic, payload)
+                    trace.mark("publish")
+            # Publish the changed values if changes exist
+            elif changed_indexes:
+                payload = serializer.serialize(changed_indexes, current_values, sample_time)
+                trace.mark("serialize")
+                publish(self.valkey_client, self.data_topic, payload)
+                trace.mark("publish")
+            trace.finish()
+
+            # Keep every group on its own schedule, and skip the polls which there was no time for
+            now = time.perf_counter()
+            for group in due_groups:
+                group.next_due += group.interval
+                if group.next_due < now:
+                    self.data_overruns.inc()
+                    group.next_due = now
+            stopped.wait(max(0.0, min(group.next_due for group in read_groups) - time.perf_counter()))
+
+        if batcher is not None:
+            # Publish the buffered samples when the config is reloaded or the service stops
+            payload = batcher.flush()
+            if payload is not None:
+                publish(self.valkey_client, self.batch_topic, payload)
+
+    def capture_bursts(self, stopped):
+        # Reads all data blocks back to back while the data trigger is set, and publishes each burst as one batch
+        read_groups, data_trigger = self.read_groups, self.data_trigger
+        variables = [variable for block in self.data_blocks for variable in block.variables]
+        data_types = [variable.data_type for variable in variables]
+        encoder = BatchEncoder([variable.name for variable in variables], data_types,
+                               [variable.units for variable in variables],
+                               [data_format(data_type) for data_type in data_types],
+                               self.device_config.batch.encoding if self.device_config.batch else "packed")
+        # Imported here, so that numpy is only loaded by the services which capture bursts
+        from burst import BurstCapture
+        capture = BurstCapture(read_groups, variables, self.device_config.burst.max_samples)
+        # The ranges with the variables of the data trigger, which are decoded after every read when the
+        # trigger only uses the data blocks
+        trigger_ranges = None
+        if data_trigger is not None and data_trigger.in_data_blocks:
+            trigger_ranges = [read_range for group in read_groups for read_range in group.ranges
+                              if data_trigger.condition.indexes.intersection(read_range.indexes)]
+            trigger_values = [None] * len(variables)
+
+        while self.sampling(stopped):
+            if not self.trigger_event.is_set():
+                if capture.count:
+                    # The burst has ended
+                    self.publish_burst(encoder, capture)
+                if not self.wait_for(self.trigger_event, stopped):  # Block until trigger is True
+                    break
 
-            # Read main data from PLC
             try:
-                with self.client_lock:
-                    reading = self.client.db_read(data_db_number, data_byte_offset, data_read_size)
+                self.connection_pool.read(read_groups)
             except Exception as e:
-                logging.error(f"Could not connect to the client with the following exception: {e}")
-                logging.info("Restarting the container")
-                self.valkey_client.publish(self.DDEATH_topic, json.dumps({"time": time.time(),
-                                                                          "status": {"connected": "False"}
-                                                                          }))
-                self.stop_event.set()
-                sys.exit(1)
+                # The samples before the outage are kept, and the burst continues after the reconnect
+                if self.reconnector.recover(e):
+                    continue
+                return
+            self.reconnector.read_succeeded()
+
+            if capture.add(time.time()):
+                # The array is full, the burst continues in the next batch
+                self.publish_burst(encoder, capture)
+            if trigger_ranges is not None:
+                for read_range in trigger_ranges:
+                    for index, value in read_range.decode():
+                        trigger_values[index] = value
+                if not data_trigger.evaluate(trigger_values):
+                    self.update_data_trigger(False)
+
+        if capture.count:
+            # Publish the burst so far when the config is reloaded or the service stops
+            self.publish_burst(encoder, capture)
+
+    def publish_burst(self, encoder, capture):
+        timestamps, columns, rate = capture.take()
+        publish(self.valkey_client, self.batch_topic, encoder.encode(timestamps, columns, {"rate": rate}))
+        logger.info(f"Published a burst of {len(timestamps)} samples at {rate:.1f} Hz")
+
+    def harvest_ring_buffer(self, harvester, stopped):
+        # Publishes the samples of a ring buffer in batches, with the timestamps of the PLC
+        variables = harvester.config.variables
+        encoder = BatchEncoder([variable.name for variable in variables],
+                               [variable.data_type for variable in variables],
+                               [variable.units for variable in variables],
+                               [data_format(variable.data_type) for variable in variables],
+                               self.device_config.batch.encoding if self.device_config.batch else "packed")
+        overruns = poll_overruns.labels(self.device_config.device.device_id, f"ring_buffer_{harvester.config.name}")
+        next_due = time.perf_counter()
+        while self.sampling(stopped):
+            if not self.trigger_event.is_set():
+                if not self.wait_for(self.trigger_event, stopped):  # Block until trigger is True
+                    break
+                # The samples of the time without the trigger are not harvested
+                harvester.restart()
+                next_due = time.perf_counter()
 
-            sample_time = time.time()
-            # Value extraction
-            current_values = [snap7.util.get_real(reading, offset)
-                              for offset in adjusted_variable_byte_offsets]
+            try:
+                with self.client_lock, self.read_seconds["DB"].time():
+                    samples = harvester.harvest(self.client)
+            except Exception as e:
+                # The harvest continues from the last counter, the PLC has buffered the samples of a short outage
+                if self.reconnector.recover(e):
+                    continue
+                return
+            self.reconnector.read_succeeded()
+
+            if samples is not None:
+                publish(self.valkey_client, self.batch_topic, encoder.encode(*samples))
+
+            next_due += harvester.config.interval
+            now = time.perf_counter()
+            if next_due < now:
+                overruns.inc()
+                next_due = now
+            stopped.wait(next_due - now)
+
+    def probe_plc(self):
+        # Health probe after a reconnect, the state of the CPU is answered by every S7 PLC
+        logger.info(f"The CPU of the PLC is in state {self.client.get_cpu_state()}")
+
+    def publish_disconnected(self):
+        publish(self.valkey_client, self.DDEATH_topic, json.dumps({"time": time.time(),
+                                                                  "status": {"connected": "False"}
+                                                                  }))
 
-            # Value comparison
-            if previous_values is None:
-                changed_indexes = indexes
-            else:
-                # Find changed indexes via numpy (fastest for large datasets)
-                changed_indexes = [i for i, (prev, curr) in enumerate(zip(previous_values, current_values))
-                                   if not math.isclose(prev, curr, rel_tol=1e-6)]
-
-            # Build metric structure for changed values
-            changed_metrics = [{
-                "name": variable_names[i],
-                "value": current_values[i],
-                "timestamp": sample_time,
-                "datatype": variable_data_types[i],
-                "units": variable_units[i]
-            } for i in changed_indexes]
-            # Publish if changes exist
-            if changed_metrics:
-                self.valkey_client.publish(self.data_topic, json.dumps({"time": time.time(),
-                                                                   "metrics": changed_metrics}))
-
-            # Update previous values
-            previous_values = current_values
-            time.sleep(poll_timer)
+    def restore_sampling(self):
+        # The requests are split across the connections which the PLC accepted again
+        for group in self.read_groups:
+            group.partitions = partition_requests(group.requests, len(self.connection_pool))
+        publish(self.valkey_client, self.DBIRTH_topic, json.dumps({"time": time.time(),
+                                                                  "status": {"connected": "True"}
+                                                                  }))
 
     # Handling the shutdown of the container
     def handle_sigterm(self, signum, frame):
         logger.info("Received SIGTERM, shutting down gracefully...")
+        self.stop()
+        # give threads a moment to stop
+        time.sleep(4)
+        sys.exit(0)
+
+    def stop(self):
         # Stop the while loops
         self.stop_event.set()
         # Stop the process
@@ -327,65 +533,179 @@ class PLCReader:
         # Stop the data sampling
         self.trigger_event.clear()
         # Publish that the device is turning off
-        self.valkey_client.publish(self.DDEATH_topic, json.dumps({"time": time.time(),
+        publish(self.valkey_client, self.DDEATH_topic, json.dumps({"time": time.time(),
                                                                  "status": {"connected": "False"}
                                                                  }))
         logger.info(f"Published DDEATH message to topic: {self.DDEATH_topic}")
-        # give threads a moment to stop
-        time.sleep(4)
-        sys.exit(0)
 
-
-    def start_sampling(self):
-
-        if self.process_trigger_config:
+    def close(self):
+        # Closes the connections to the PLC once the threads have stopped, for the device host which keeps running
+        for thread in self.sampling_threads:
+            thread.join(5)
+        with self.client_lock:
+            self.connection_pool.close()
+            self.client.disconnect()
+            self.client.destroy()
+
+
+    def start_threads(self):
+        # Starts the threads of the sampling, they run until the returned event is set or the service stops
+        stopped = threading.Event()
+        threads = []
+        if self.process_trigger:
             # Start thread for process monitoring
-            process_thread = threading.Thread(target=self.monitor_process)
-            process_thread.daemon = True
-            process_thread.start()
+            threads.append(threading.Thread(target=self.monitor_process, args=(stopped,)))
         else:
             logger.info("Process trigger is not configured and will not be performed")
 
-        if self.data_trigger_config:
+        if self.data_trigger:
             # Start thread for trigger monitoring
-            trigger_thread = threading.Thread(target=self.monitor_trigger)
-            trigger_thread.daemon = True
-            trigger_thread.start()
-
+            threads.append(threading.Thread(target=self.monitor_trigger, args=(stopped,)))
         else:
             logger.info("Data trigger is not configured and will not be performed")
 
-        if self.data_block:
-            # Start thread for main data sampling
-            data_thread = threading.Thread(target=self.sample_main_data)
-            data_thread.daemon = True
-            data_thread.start()
-
+        if self.data_blocks:
+            # Start thread for main data sampling, or for burst capture while the data trigger is set
+            threads.append(threading.Thread(target=self.capture_bursts if self.device_config.burst
+                                            else self.sample_main_data, args=(stopped,)))
         else:
             logger.info("Data blocks are not configured")
 
-        # Keep the main program running
+        for harvester in self.harvesters:
+            # Start a thread per ring buffer
+            threads.append(threading.Thread(target=self.harvest_ring_buffer, args=(harvester, stopped)))
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        return stopped, threads
+
+    def reload_config(self, device_config):
+        # Applies a changed config to the running reader. The threads of the sampling are stopped after their
+        # current read and started again with the new config, the parts of the sampling which have not changed keep
+        # their state. Only a change of the connection parameters reconnects to the PLC, and a change of the
+        # identity of the device restarts the service, as its topics change.
+        device_changes = changed_fields(self.device_config.device, device_config.device)
+        if device_changes & IDENTITY_FIELDS:
+            logger.warning(f"The {', '.join(sorted(device_changes & IDENTITY_FIELDS))} of the device changed, "
+                           f"restarting the service")
+            self.config_reloads["restart"].inc()
+            self.stop_event.set()
+            return
+        try:
+            plan = self.plan_sampling(device_config, self.device_config)
+        except ValueError as e:
+            self.config_reloads["invalid"].inc()
+            logger.error(f"The changed config is not valid, keeping the running config: {e}")
+            return
+        logger.info(f"Reloading the config, changed: {', '.join(sorted(changed_fields(self.device_config, device_config)))}")
+
+        self.sampling_stopped.set()
+        for thread in self.sampling_threads:
+            thread.join(5)
+        self.reconnector.device_config = device_config
+        self.reconnector.config = device_config.reconnect
+        if device_changes & CONNECTION_FIELDS or device_config.connections != self.device_config.connections:
+            if not self.reconnect_plc(device_config):
+                return
+            try:
+                # The PDU or the number of connections can have changed
+                plan = self.plan_sampling(device_config, self.device_config)
+            except ValueError as e:
+                logger.error(f"The changed config is not valid for the new connection to the PLC: {e}")
+                self.stop_event.set()
+                return
+        self.apply_plan(device_config, plan)
+        self.config_watcher.config = device_config
+        self.config_reloads["applied"].inc()
+        publish(self.valkey_client, self.DBIRTH_topic, json.dumps({"time": time.time(),
+                                                                  "status": {"connected": "True"}
+                                                                  }))
+        self.sampling_stopped, self.sampling_threads = self.start_threads()
+
+    def reconnect_plc(self, device_config):
+        # Connects to the PLC with the connection parameters of a changed config, returns False when the service
+        # is stopping as the PLC could not be reached
+        with self.client_lock:
+            self.connection_pool.close()
+            self.connection_pool = ConnectionPool(self.client, self.client_lock, read_seconds=self.read_seconds)
+        self.reconnector.connection_pool = self.connection_pool
+        try:
+            with self.client_lock:
+                self.connection_pool.reconnect(device_config)
+        except Exception as e:
+            if not self.reconnector.recover(e):
+                return False
+        self.reconnector.read_succeeded()
+        extra_clients = open_connections(device_config, device_config.connections - 1) \
+            if configured_blocks(device_config) and device_config.connections > 1 else []
+        with self.client_lock:
+            self.connection_pool = ConnectionPool(self.client, self.client_lock, extra_clients, self.read_seconds)
+        self.reconnector.connection_pool = self.connection_pool
+        logger.info(f"Connected to the PLC at {device_config.device.ip} with {len(self.connection_pool)} connection(s)")
+        return True
+
+    def start(self):
+        self.sampling_stopped, self.sampling_threads = self.start_threads()
+
+    def check_config(self):
+        # Applies the changes of the config file
+        if self.config_watcher is not None:
+            device_config = self.config_watcher.check()
+            if device_config is not None:
+                self.reload_config(device_config)
+
+    def start_sampling(self):
+        self.start()
+
+        # Keep the main program running, and apply the changes of the config file
         while not self.stop_event.is_set():
             time.sleep(1)
+            self.check_config()
 
         # Publishing that the service is shutting down
-        self.valkey_client.publish(self.DDEATH_topic, json.dumps({"time": time.time(),
+        publish(self.valkey_client, self.DDEATH_topic, json.dumps({"time": time.time(),
                                                                   "status": {"connected": "False"}
                                                                   }))
         logger.info("Shutting down")
         sys.exit(1)
 
 
-# Get configuration from config file
-device_config_path = args.device_service_config_path
-# Setup
-# First ensure that the connection to the internal message bus can be established
-valkey_client = valkey_connection()
-# Second get the configuration of the device service
-device_config = get_device_config(device_config_path)
-# Third connect to the PLC
-client = connect_to_plc(device_config)
-
-# Forth Initialize PLCReader and start sampling
-plc_reader = PLCReader(device_config, client, valkey_client)
-plc_reader.start_sampling()
+if __name__ == "__main__":
+    #Setting the path for the config file
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--device_service_config_path",
+        help="Parse the path for the device service config file from metadata"
+    )
+    args = parser.parse_args()
+
+    if not args.device_service_config_path:
+        logging.error("Error: You must provide --device_service_config_path (path to the device service config file from metadata.yaml).")
+        sys.exit(1)
+
+    # Get configuration from config file
+    device_config_path = args.device_service_config_path
+    startup = StartupTimer(started)
+    startup.mark("imports")
+    start_metrics_server()
+    # Setup
+    # First get the configuration of the device service
+    device_config = get_device_config(device_config_path)
+    startup.mark("config")
+    # Second connect to the internal message bus and to the PLC, at the same time. A failed connection exits the
+    # service when its result is taken.
+    with ThreadPoolExecutor(2) as executor:
+        valkey_future = executor.submit(startup.timed, "valkey", valkey_connection)
+        plc_future = executor.submit(startup.timed, "plc", connect_to_plc, device_config)
+        valkey_client = valkey_future.result()
+        client = plc_future.result()
+    startup.mark("connections")
+
+    # Third Initialize PLCReader and start sampling
+    plc_reader = PLCReader(device_config, client, valkey_client,
+                           config_path=mounted_dir.joinpath(device_config_path))
+    signal.signal(signal.SIGTERM, plc_reader.handle_sigterm)
+    startup.mark("reader")
+    startup.log()
+    plc_reader.start_sampling()
@@ -0,0 +1,54 @@
+import numpy as np
+from read_planner import data_format
+
+# Burst capture of the data blocks while the data trigger is set, for short events such as a press stroke, of
+# which polling at data_interval gives only a handful of samples.
+#
+# During a burst the ranges of all read groups are read back to back, as fast as the link to the PLC allows,
+# and the bytes of every read are copied as a row into an array which is allocated once for max_samples reads.
+# Nothing is decoded while the burst runs. When it ends, every variable is decoded from its bytes in all rows at
+# once, as a big endian array of its data type.
+
+class BurstCapture:
+    def __init__(self, read_groups, variables, max_samples):
+        # variables holds all variables of the data blocks, in the order they are indexed by the read groups
+        self.max_samples = max_samples
+        self.count = 0
+        # The columns of every range in a row, and the buffer of the range as an array
+        self.sources = []
+        self.variable_columns = [None] * len(variables)
+        row_size = 0
+        for read_range in (read_range for group in read_groups for read_range in group.ranges):
+            self.sources.append((row_size, row_size + read_range.size,
+                                 np.frombuffer(read_range.buffer, dtype=np.uint8)))
+            for index in read_range.indexes:
+                self.variable_columns[index] = row_size + variables[index].byte_offset - read_range.start
+            row_size += read_range.size
+        self.rows = np.empty((max_samples, row_size), dtype=np.uint8)
+        self.timestamps = np.empty(max_samples, dtype=np.float64)
+        self.dtypes = [np.dtype(">" + data_format(variable.data_type)) for variable in variables]
+        self.bits = [variable.bit_offset if variable.data_type.upper() == "BOOL" else None for variable in variables]
+
+    def add(self, timestamp):
+        # Copies the last read of the ranges into the next row, returns True when the array is full
+        row = self.rows[self.count]
+        for start, end, source in self.sources:
+            row[start:end] = source
+        self.timestamps[self.count] = timestamp
+        self.count += 1
+        return self.count == self.max_samples
+
+    def take(self):
+        # Returns the timestamps, the columns of the variables and the sample rate of the samples so far, and
+        # starts over
+        rows = self.rows[:self.count]
+        columns = []
+        for column, dtype, bit in zip(self.variable_columns, self.dtypes, self.bits):
+            values = np.ascontiguousarray(rows[:, column:column + dtype.itemsize]).view(dtype)[:, 0]
+            if bit is not None:
+                values = (values >> bit & 1).astype(bool)
+            columns.append(values.tolist())
+        timestamps = self.timestamps[:self.count].tolist()
+        rate = (len(timestamps) - 1) / (timestamps[-1] - timestamps[0]) if len(timestamps) > 1 else 0.0
+        self.count = 0
+        return timestamps, columns, rate
@@ -0,0 +1,254 @@
+import operator
+import re
+from models.devicemodels import S7commVariables
+from read_planner import AREAS, area_of, plan_ranges, pack_requests, max_range_size
+
+# Trigger conditions of the S7Comm service.
+#
+# A condition is an expression over the variables of the data blocks, and over the bit of the trigger source as
+# the variable source. It is parsed and compiled once at startup into a predicate of the values of a poll:
+#
+#   pressure > 5.0 AND NOT door_open
+#   HYSTERESIS(temperature, 80, 75) OR source
+#   LATCH(RISING(stroke_start), RISING(stroke_end))
+#
+# Comparisons are <, <=, >, >=, = (or ==) and <> (or !=) between variables, numbers, TRUE and FALSE. A variable
+# on its own is true when it is not 0. HYSTERESIS(value, on, off) turns true when value reaches on and false when
+# it reaches off, which is below on for a high level and above it for a low level. RISING(x) and FALLING(x) are
+# true in the one evaluation in which x turns true or false, and LATCH(set, reset) turns true with set and false
+# with reset. Keywords are not case sensitive, and names which are not identifiers are quoted, e.g. "Motor 1".
+# AND and OR always evaluate all of their operands, so that the edges and latches in them keep their state.
+#
+# The conditions of older configs, "True" or "False", compare the bit of the source.
+
+TOKENS = re.compile(r"""\s*(?:(?P<number>-?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+                           |(?P<name>[A-Za-z_][A-Za-z0-9_.]*)
+                           |"(?P<quoted>[^"]*)"
+                           |(?P<symbol><=|>=|<>|!=|==|[<>=(),]))""", re.VERBOSE)
+COMPARISONS = {"<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge,
+               "=": operator.eq, "==": operator.eq, "<>": operator.ne, "!=": operator.ne}
+CONSTANTS = {"TRUE": True, "FALSE": False}
+SOURCE = "source"
+
+def tokenize(text):
+    # Returns (kind, value, position) of the tokens of the text
+    tokens, position = [], 0
+    while text[position:].strip():
+        match = TOKENS.match(text, position)
+        if match is None:
+            raise ValueError(f"Invalid trigger condition {text!r}: unexpected {text[position:].strip()[0]!r} "
+                             f"at {position}")
+        tokens.append((match.lastgroup, match.group(match.lastgroup), match.start(match.lastgroup)))
+        position = match.end()
+    return tokens
+
+def constant(value):
+    return lambda values: value
+
+def variable(index):
+    return lambda values: values[index]
+
+def all_of(operands):
+    if len(operands) == 1:
+        return operands[0]
+    return lambda values: all([operand(values) for operand in operands])
+
+def any_of(operands):
+    if len(operands) == 1:
+        return operands[0]
+    return lambda values: any([operand(values) for operand in operands])
+
+def negation(operand):
+    return lambda values: not operand(values)
+
+def comparison(compare, left, right):
+    return lambda values: compare(left(values), right(values))
+
+def edge(operand, rising):
+    previous = None
+    def evaluate(values):
+        nonlocal previous
+        current = bool(operand(values))
+        changed = previous is not None and current != previous and current == rising
+        previous = current
+        return changed
+    return evaluate
+
+def latch(set_operand, reset_operand):
+    state = False
+    def evaluate(values):
+        nonlocal state
+        set_value, reset_value = set_operand(values), reset_operand(values)
+        if reset_value:
+            state = False
+        elif set_value:
+            state = True
+        return state
+    return evaluate
+
+def hysteresis(value_operand, on_operand, off_operand):
+    state = False
+    def evaluate(values):
+        nonlocal state
+        value, on, off = value_operand(values), on_operand(values), off_operand(values)
+        if on >= off:
+            # High level
+            if value >= on:
+                state = True
+            elif value <= off:
+                state = False
+        elif value <= on:
+            state = True
+        elif value >= off:
+            state = False
+        return state
+    return evaluate
+
+# The functions by their name, with their number of arguments
+FUNCTIONS = {"RISING": (lambda operand: edge(operand, True), 1),
+             "FALLING": (lambda operand: edge(operand, False), 1),
+             "LATCH": (latch, 2),
+             "HYSTERESIS": (hysteresis, 3)}
+
+class Condition:
+    """A condition compiled into a predicate of the values of the variables, which are indexed by names"""
+    def __init__(self, text, names):
+        self.text = text
+        self.names = names
+        self.tokens = tokenize(text)
+        self.position = 0
+        # The indexes of the variables in the condition
+        self.indexes = set()
+        self.predicate = self.expression()
+        if self.position < len(self.tokens):
+            self.fail("the end of the condition")
+
+    def __call__(self, values):
+        return bool(self.predicate(values))
+
+    def fail(self, expected):
+        if self.position < len(self.tokens):
+            _, value, position = self.tokens[self.position]
+            found = f"{value!r} at {position}"
+        else:
+            found = "the end"
+        raise ValueError(f"Invalid trigger condition {self.text!r}: expected {expected}, found {found}")
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None, None)
+
+    def accept(self, kind, value):
+        # Moves past the next token when it is the given symbol or keyword
+        token_kind, token_value, _ = self.peek()
+        if token_kind == kind and (token_value.upper() if kind == "name" else token_value) == value:
+            self.position += 1
+            return True
+        return False
+
+    def expect(self, symbol):
+        if not self.accept("symbol", symbol):
+            self.fail(repr(symbol))
+
+    def expression(self):
+        operands = [self.term()]
+        while self.accept("name", "OR"):
+            operands.append(self.term())
+        return any_of(operands)
+
+    def term(self):
+        operands = [self.factor()]
+        while self.accept("name", "AND"):
+            operands.append(self.factor())
+        return all_of(operands)
+
+    def factor(self):
+        if self.accept("name", "NOT"):
+            return negation(self.factor())
+        left = self.operand()
+        kind, value, _ = self.peek()
+        if kind == "symbol" and value in COMPARISONS:
+            self.position += 1
+            return comparison(COMPARISONS[value], left, self.operand())
+        return left
+
+    def operand(self):
+        kind, value, _ = self.peek()
+        if kind == "number":
+            self.position += 1
+            return constant(float(value) if any(character in value for character in ".eE") else int(value))
+        if kind == "name" and value.upper() in CONSTANTS:
+            self.position += 1
+            return constant(CONSTANTS[value.upper()])
+        if kind == "name" and value.upper() in FUNCTIONS:
+            self.position += 1
+            function, arguments = FUNCTIONS[value.upper()]
+            self.expect("(")
+            operands = [self.expression()]
+            for _ in range(arguments - 1):
+                self.expect(",")
+                operands.append(self.expression())
+            self.expect(")")
+            return function(*operands)
+        if kind in ("name", "quoted"):
+            if value not in self.names:
+                raise ValueError(f"Invalid trigger condition {self.text!r}: unknown variable {value!r}")
+            self.position += 1
+            self.indexes.add(self.names[value])
+            return variable(self.names[value])
+        if self.accept("symbol", "("):
+            operand = self.expression()
+            self.expect(")")
+            return operand
+        self.fail("a variable, a number or '('")
+
+def source_variable(source):
+    # The area and the variable of the bit of a trigger source
+    variable_type = source.get("variable_type", "Boolean variable")
+    if variable_type == "Memory bit":
+        return AREAS["M"], 0, S7commVariables(name=SOURCE, data_type="BOOL", byte_offset=int(source["byte_offset"]),
+                                               bit_offset=int(source["bool_index"]), units="")
+    if variable_type == "Boolean variable":
+        return AREAS["DB"], int(source["db_number"]), S7commVariables(
+            name=SOURCE, data_type="BOOL", byte_offset=int(source["byte_offset"]),
+            bit_offset=int(source["bit_offset"]), units="")
+    raise ValueError(f"Unsupported variable_type of the trigger source: {variable_type}")
+
+class Trigger:
+    """A trigger with its compiled condition, and the requests which read the variables of the condition"""
+    def __init__(self, config, blocks, pdu_length):
+        self.config = config
+        # The variables of the data blocks are indexed as in the read groups, the source bit follows them
+        located = [(area_of(block), block.db_number if area_of(block) == AREAS["DB"] else 0, variable)
+                   for block in blocks for variable in block.variables]
+        names = {variable.name: index for index, (_, _, variable) in enumerate(located)}
+        text = config.condition.strip()
+        if config.source:
+            if SOURCE in names:
+                raise ValueError(f"The name {SOURCE} of the trigger source is used by a variable of the device")
+            names[SOURCE] = len(located)
+            located.append(source_variable(config.source))
+            if text.upper() in CONSTANTS:
+                text = f"{SOURCE} = {text}"
+        self.condition = Condition(text, names)
+        # The condition can be evaluated on the values of the polls of the data blocks when it does not use the
+        # source
+        self.in_data_blocks = names.get(SOURCE) not in self.condition.indexes
+        self.values = [None] * len(located)
+
+        members = {}  # (area, db number) -> [(index, variable)]
+        for index in sorted(self.condition.indexes):
+            area, db_number, condition_variable = located[index]
+            members.setdefault((area, db_number), []).append((index, condition_variable))
+        self.ranges = [read_range for (area, db_number), variables in members.items()
+                       for read_range in plan_ranges(area, db_number, variables, max_size=max_range_size(pdu_length))]
+        self.requests = pack_requests(self.ranges, pdu_length)
+
+    def update(self):
+        # Decodes the values of the last read of the requests
+        for read_range in self.ranges:
+            for index, value in read_range.decode():
+                self.values[index] = value
+
+    def evaluate(self, values=None):
+        # Evaluates the condition on the values of its own reads, or on the values of a poll of the data blocks
+        return self.condition(self.values if values is None else values)
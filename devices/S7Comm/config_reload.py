@@ -0,0 +1,69 @@
+import logging
+import os
+import yaml
+from pydantic import ValidationError
+from models.devicemodels import S7CommDeviceServiceConfig
+from common.metrics import registry
+from common.startup import load_config as load_cached_config
+
+logger = logging.getLogger(__name__)
+
+# Reloading of the config of the S7Comm service while it runs, so that tuning the polling of a running line
+# costs neither a container restart nor a gap in the data.
+#
+# The watcher compares the modification time and the size of the config file on every check, and loads a changed
+# file once it has stayed the same for one check, so that a file is not read while it is written. A file which can
+# not be loaded or is not a valid config is logged, and the running config is kept. The reader then applies the
+# sections of the config which have changed, see PLCReader.reload_config.
+
+# Fields of the device which need a new connection to the PLC, and the ones which need a restart of the service
+CONNECTION_FIELDS = {"ip", "port", "rack", "slot"}
+IDENTITY_FIELDS = {"group_id", "node_id", "device_id", "protocol_type"}
+
+config_reloads = registry.counter("config_reloads", "Changes of the config file, by whether they were applied",
+                                  ["device", "result"])
+
+def load_config(config_path):
+    # A reloaded config is cached as well, so that the next start of the service does not parse it again
+    return load_cached_config(config_path, S7CommDeviceServiceConfig)
+
+def changed_fields(old, new):
+    # The fields of two models which differ
+    return {field for field in type(new).model_fields if getattr(old, field) != getattr(new, field)}
+
+class ConfigWatcher:
+    def __init__(self, config_path, config):
+        self.config_path = config_path
+        self.config = config
+        self.invalid_reloads = config_reloads.labels(config.device.device_id, "invalid")
+        self.signature = self.stat()
+        # Signature of a change which was seen in the last check
+        self.pending = None
+
+    def stat(self):
+        try:
+            status = os.stat(self.config_path)
+        except FileNotFoundError:
+            return None
+        return status.st_mtime_ns, status.st_size
+
+    def check(self):
+        # Returns the config when the file has changed to a valid config which differs from the running one
+        signature = self.stat()
+        if signature is None or signature == self.signature:
+            self.pending = None
+            return None
+        if signature != self.pending:
+            # The file may still be written
+            self.pending = signature
+            return None
+        self.signature, self.pending = signature, None
+        try:
+            config = load_config(self.config_path)
+        except (OSError, yaml.YAMLError, ValidationError) as e:
+            self.invalid_reloads.inc()
+            logger.error(f"The changed config {self.config_path} is not valid, keeping the running config: {e}")
+            return None
+        if config == self.config:
+            return None
+        return config
@@ -0,0 +1,104 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait
+import snap7
+
+logger = logging.getLogger(__name__)
+
+# Connections to the same PLC, for reading large data volumes in parallel.
+#
+# A connection has one request in flight at a time, so the data which can be read over it per second is limited
+# by its round trip time. With more connections the requests of a read group are split across them and sent
+# concurrently, snap7 releases the GIL while it waits for the PLC. The first connection is the one of the
+# service, which the trigger threads use as well. A read holds its lock until all connections are done, so that
+# a reconnect, which takes the same lock, never closes a connection while it is read from.
+#
+# A CPU has a limited number of connection resources, which it shares with the HMI and the engineering tools.
+# When it refuses a connection the service continues with the ones it has, down to its single connection.
+
+def connect(client, device_config):
+    client.connect(device_config.device.ip, device_config.device.rack, device_config.device.slot,
+                   tcp_port=device_config.device.port or 102)
+    if not client.get_connected():
+        raise ConnectionError("Connected but PLC is not responding")
+
+def open_connections(device_config, count):
+    # Opens up to count further connections and stops at the first one which the PLC refuses
+    clients = []
+    for _ in range(count):
+        client = snap7.client.Client()
+        try:
+            connect(client, device_config)
+        except Exception as e:
+            logger.warning(f"The PLC refused connection {len(clients) + 2}, "
+                           f"continuing with {len(clients) + 1} connection(s): {e}")
+            client.destroy()
+            break
+        clients.append(client)
+    return clients
+
+class ConnectionPool:
+    def __init__(self, client, client_lock, extra_clients=(), read_seconds=None):
+        self.clients = [client] + list(extra_clients)
+        self.client_lock = client_lock
+        # Histogram children by the area label of a request
+        self.read_seconds = read_seconds
+        self.executor = None
+        if len(self.clients) > 1:
+            self.executor = ThreadPoolExecutor(max_workers=len(self.clients) - 1, thread_name_prefix="s7_connection")
+
+    def __len__(self):
+        return len(self.clients)
+
+    def pdu_length(self):
+        # The requests have to fit into the smallest PDU which was negotiated
+        return min(client.get_pdu_length() for client in self.clients)
+
+    def read_requests(self, client, requests):
+        for request in requests:
+            if self.read_seconds is None:
+                request.read(client)
+            else:
+                with self.read_seconds[request.area_label].time():
+                    request.read(client)
+
+    def read(self, groups):
+        # Reads the groups into the buffers of their ranges. The requests of the first connection are read in the
+        # calling thread while the executor reads the others.
+        with self.client_lock:
+            partitions = [[] for _ in self.clients]
+            for group in groups:
+                for connection, requests in enumerate(group.partitions):
+                    # More partitions than connections when connections were lost in a reconnect
+                    partitions[connection % len(self.clients)] += requests
+            futures = [self.executor.submit(self.read_requests, client, requests)
+                       for client, requests in zip(self.clients[1:], partitions[1:]) if requests]
+            try:
+                self.read_requests(self.clients[0], partitions[0])
+            finally:
+                wait(futures)
+            for future in futures:
+                future.result()
+
+    def reconnect(self, device_config):
+        # Reconnects the connections after the PLC was lost, the caller holds the lock of the first one. An error
+        # of the first connection is raised, the further connections which the PLC refuses now are closed.
+        self.clients[0].disconnect()
+        connect(self.clients[0], device_config)
+        for client in self.clients[1:]:
+            try:
+                client.disconnect()
+                connect(client, device_config)
+            except Exception as e:
+                logger.warning(f"The PLC refused a connection after reconnecting, closing it: {e}")
+                self.clients.remove(client)
+                client.destroy()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        for client in self.clients[1:]:
+            try:
+                client.disconnect()
+                client.destroy()
+            except Exception as e:
+                logger.debug(f"Could not close a connection to the PLC: {e}")
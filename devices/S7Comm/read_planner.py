@@ -0,0 +1,281 @@
+import ctypes
+import struct
+from snap7.type import Areas, WordLen, S7DataItem
+
+# Plans the reads of the variables in the data blocks and memory areas of the S7Comm service.
+#
+# The variables are grouped by their rate class, and every group is polled at the interval of its class, so that
+# slow signals do not use the communication budget of the PLC at the rate of the fast ones. Within a group the
+# variables are merged into ranges of their data block or area. A gap between two variables is read across when
+# it is at most MAX_GAP bytes, as an extra request costs more than a few bytes. The ranges of a group are then
+# packed into as few requests as possible, each a read of up to MAX_ITEMS ranges which fits into one PDU. A range
+# is ended before it outgrows a PDU, so that a large data block is read with several requests, which can be sent
+# on different connections when the device has more than one.
+#
+# Every range is read into a buffer of its own, which is allocated once, and compared with the bytes of the read
+# before. Only the segments of a range whose bytes have changed are decoded, each with one precompiled struct,
+# according to the data types of the variables.
+
+# Struct formats of the S7 data types, which are big endian in the PLC. BOOL is read as its byte.
+DATA_TYPES = {"BOOL": "B", "BYTE": "B", "USINT": "B", "SINT": "b", "CHAR": "B",
+              "WORD": "H", "UINT": "H", "INT": "h",
+              "DWORD": "I", "UDINT": "I", "DINT": "i", "REAL": "f",
+              "LWORD": "Q", "ULINT": "Q", "LINT": "q", "LREAL": "d"}
+MAX_GAP = 16
+# Bytes of a range which are compared and decoded together
+SEGMENT_SIZE = 64
+DEFAULT_CLASS = "default"
+# The areas of the PLC by the names used in the config
+AREAS = {"DB": Areas.DB, "I": Areas.PE, "PE": Areas.PE, "Q": Areas.PA, "PA": Areas.PA, "M": Areas.MK, "MK": Areas.MK}
+# Items per multi-variable read, a limit of snap7
+MAX_ITEMS = 20
+# Sizes in bytes of the S7 read request and response, for fitting the requests into the PDU
+REQUEST_HEADER, REQUEST_ITEM = 12, 12
+RESPONSE_HEADER, RESPONSE_ITEM = 14, 4
+
+class ItemReadError(RuntimeError):
+    """The PLC answered a read, but refused an item of it, e.g. as the data block does not exist or is shorter than
+    the range. Reading it again gives the same error, so it is not recovered by reconnecting."""
+
+def configured_blocks(device_config):
+    # The data blocks and areas of the device, data_block is the single block of older configs
+    return ([device_config.data_block] if device_config.data_block else []) + list(device_config.data_blocks)
+
+def area_of(block):
+    area = AREAS.get(block.area.upper())
+    if area is None:
+        raise ValueError(f"Unsupported area {block.area} of {block.name}, use one of {list(AREAS)}")
+    return area
+
+def data_format(data_type):
+    value_format = DATA_TYPES.get(data_type.upper())
+    if value_format is None:
+        raise ValueError(f"Unsupported data type {data_type}, use one of {list(DATA_TYPES)}")
+    return value_format
+
+class Segment:
+    """Neighbouring fields of a range, which are compared and decoded together"""
+    def __init__(self, range_start, fields, members, current, previous):
+        # fields holds (byte offset, format) and members (index, field, bit) with the fields counted from 0
+        self.offset = fields[0][0] - range_start
+        end = max(offset + struct.calcsize(value_format) for offset, value_format in fields) - range_start
+        # Views of the bytes of the segment in the buffers of the range
+        self.current = current[self.offset:end]
+        self.previous = previous[self.offset:end]
+        self.members = members
+
+        # One struct for the segment when the fields do not overlap, otherwise one per field
+        position, layout = fields[0][0], ">"
+        for offset, value_format in fields:
+            if offset < position:
+                layout = None
+                break
+            layout += "x" * (offset - position) + value_format
+            position = offset + struct.calcsize(value_format)
+        self.layout = struct.Struct(layout) if layout is not None else None
+        self.field_structs = [(offset - range_start, struct.Struct(">" + value_format))
+                              for offset, value_format in fields]
+
+    def decode(self, data):
+        # Returns (index, value) of the variables in the segment
+        if self.layout is not None:
+            field_values = self.layout.unpack_from(data, self.offset)
+        else:
+            field_values = [field_struct.unpack_from(data, offset)[0] for offset, field_struct in self.field_structs]
+        return [(index, field_values[field] if bit is None else bool(field_values[field] >> bit & 1))
+                for index, field, bit in self.members]
+
+class ReadRange:
+    """A contiguous range of a data block or area and the decoding of the variables in it.
+
+    The range is read into buffer, and previous keeps the bytes of the read before. Both are allocated once.
+    """
+    def __init__(self, area, db_number, start, variables):
+        # variables holds (index, variable) sorted by byte offset
+        self.area = area
+        self.db_number = db_number if area == Areas.DB else 0
+        self.start = start
+        self.indexes = [index for index, _ in variables]
+        fields = []  # (byte offset, format) of every field
+        members = []  # (index, bit) of the variables of every field, bit is None but for BOOL
+        for index, variable in variables:
+            field = (variable.byte_offset, data_format(variable.data_type))
+            if not fields or fields[-1] != field:
+                fields.append(field)
+                members.append([])
+            members[-1].append((index, variable.bit_offset if variable.data_type.upper() == "BOOL" else None))
+        self.size = max(offset + struct.calcsize(value_format) for offset, value_format in fields) - start
+        self.buffer = bytearray(self.size)
+        self.previous = bytearray(self.size)
+        self.decoded = False
+
+        # The fields are split into segments of up to SEGMENT_SIZE bytes, overlapping fields stay in one segment
+        current, previous = memoryview(self.buffer), memoryview(self.previous)
+        self.segments = []
+        segment_fields, segment_members, position = [], [], None
+        for (offset, value_format), field_members in zip(fields, members):
+            field_end = offset + struct.calcsize(value_format)
+            if segment_fields and offset >= position and field_end - segment_fields[0][0] > SEGMENT_SIZE:
+                self.segments.append(Segment(start, segment_fields, segment_members, current, previous))
+                segment_fields, segment_members, position = [], [], None
+            segment_members += [(index, len(segment_fields), bit) for index, bit in field_members]
+            segment_fields.append((offset, value_format))
+            position = field_end if position is None else max(position, field_end)
+        self.segments.append(Segment(start, segment_fields, segment_members, current, previous))
+
+    def decode(self):
+        # Returns (index, value) of all variables from the last read
+        return [change for segment in self.segments for change in segment.decode(self.buffer)]
+
+    def changes(self):
+        # Returns (index, value) of the variables in the segments whose bytes have changed since the last call,
+        # of all variables on the first call. Comparing the raw bytes first skips the decoding of the values
+        # which are static, which most of them are most of the time.
+        if not self.decoded:
+            self.decoded = True
+            changes = self.decode()
+        elif self.buffer == self.previous:
+            return []
+        else:
+            changes = [change for segment in self.segments if segment.current != segment.previous
+                       for change in segment.decode(self.buffer)]
+        self.previous[:] = self.buffer
+        return changes
+
+def response_size(read_range):
+    # Data of an item in the response, padded to an even length
+    return RESPONSE_ITEM + read_range.size + read_range.size % 2
+
+class ReadRequest:
+    """Ranges which are read together with a multi-variable read. The items point to the buffers of the ranges,
+    so a read allocates nothing."""
+    def __init__(self, ranges):
+        self.ranges = ranges
+        self.size = sum(read_range.size for read_range in ranges)
+        areas = {read_range.area for read_range in ranges}
+        self.area_label = next(iter(areas)).name if len(areas) == 1 else "multi"
+        self.items = (S7DataItem * len(ranges))()
+        # ctypes arrays on the buffers of the ranges, which have to stay referenced for the items
+        self.arrays = [(ctypes.c_ubyte * read_range.size).from_buffer(read_range.buffer) for read_range in ranges]
+        for item, read_range, array in zip(self.items, ranges, self.arrays):
+            item.Area = read_range.area
+            item.WordLen = WordLen.Byte
+            item.DBNumber = read_range.db_number
+            item.Start = read_range.start
+            item.Amount = read_range.size
+            item.pData = ctypes.cast(array, ctypes.POINTER(ctypes.c_ubyte))
+
+    def read(self, client):
+        # Reads the ranges of the request into their buffers
+        client.read_multi_vars(self.items)
+        for item, read_range in zip(self.items, self.ranges):
+            if item.Result != 0:
+                raise ItemReadError(f"Reading {read_range.size} bytes from {read_range.area.name} {read_range.db_number} "
+                                    f"at {read_range.start} failed with code {item.Result:#x}")
+
+def max_range_size(pdu_length):
+    # The largest range which fits into the response of a single read
+    return pdu_length - RESPONSE_HEADER - RESPONSE_ITEM - 1
+
+def pack_requests(ranges, pdu_length, max_items=MAX_ITEMS):
+    # First fit decreasing: the ranges are put into the first request they fit in, largest first
+    requests = []  # [ranges, response size]
+    max_items = max(1, min(max_items, (pdu_length - REQUEST_HEADER) // REQUEST_ITEM))
+    for read_range in sorted(ranges, key=lambda read_range: read_range.size, reverse=True):
+        size = response_size(read_range)
+        for request in requests:
+            if len(request[0]) < max_items and request[1] + size <= pdu_length:
+                request[0].append(read_range)
+                request[1] += size
+                break
+        else:
+            requests.append([[read_range], RESPONSE_HEADER + size])
+    return [ReadRequest(sorted(request_ranges, key=lambda read_range: (read_range.area, read_range.db_number,
+                                                                       read_range.start)))
+            for request_ranges, _ in requests]
+
+def partition_requests(requests, connections):
+    # Splits the requests into one list per connection with about the same number of bytes each, by giving the
+    # largest request to the connection with the fewest bytes so far. Connections without requests are left out.
+    partitions = [[] for _ in range(connections)]
+    sizes = [0] * connections
+    for request in sorted(requests, key=lambda request: request.size, reverse=True):
+        connection = sizes.index(min(sizes))
+        partitions[connection].append(request)
+        sizes[connection] += request.size
+    return [partition for partition in partitions if partition]
+
+class ReadGroup:
+    """The variables of a rate class, polled together"""
+    def __init__(self, rate_class, interval, ranges, pdu_length, adaptive=None, connections=1):
+        self.rate_class = rate_class
+        self.base_interval = interval
+        self.interval = interval
+        self.ranges = ranges
+        self.requests = pack_requests(ranges, pdu_length)
+        # The requests of every connection
+        self.partitions = partition_requests(self.requests, connections)
+        self.indexes = [index for read_range in ranges for index in read_range.indexes]
+        self.adaptive = adaptive
+        self.next_due = 0.0
+
+    def reset_changes(self):
+        # The next changes() of the ranges return all variables
+        for read_range in self.ranges:
+            read_range.decoded = False
+
+    def adapt(self, changed):
+        # In adaptive mode the interval is shortened while values change and lengthened while they are static,
+        # within min_factor and max_factor times the interval of the class
+        if self.adaptive is None:
+            return
+        if changed:
+            self.interval = max(self.base_interval * self.adaptive.min_factor, self.interval / self.adaptive.step)
+        else:
+            self.interval = min(self.base_interval * self.adaptive.max_factor, self.interval * self.adaptive.step)
+
+def plan_ranges(area, db_number, variables, max_gap=MAX_GAP, max_size=None):
+    # variables holds (index, variable) of one group in one data block or area
+    ranges, current = [], []
+    end = None
+    for index, variable in sorted(variables, key=lambda item: (item[1].byte_offset, item[1].bit_offset)):
+        size = struct.calcsize(data_format(variable.data_type))
+        if current and (variable.byte_offset > end + max_gap or
+                        (max_size is not None and
+                         max(end, variable.byte_offset + size) - current[0][1].byte_offset > max_size)):
+            ranges.append(ReadRange(area, db_number, current[0][1].byte_offset, current))
+            current, end = [], None
+        current.append((index, variable))
+        end = variable.byte_offset + size if end is None else max(end, variable.byte_offset + size)
+    if current:
+        ranges.append(ReadRange(area, db_number, current[0][1].byte_offset, current))
+    return ranges
+
+def plan_groups(blocks, polling, pdu_length, max_gap=MAX_GAP, connections=1):
+    # The read groups of the data blocks and areas, one per rate class which is used by a variable. The
+    # variables are indexed in the order of the blocks and of the variables within them. The requests of every
+    # group are split across the given number of connections.
+    default_interval = polling.data_interval or polling.default_interval
+    intervals = dict(polling.rate_classes)
+    intervals.setdefault(DEFAULT_CLASS, default_interval)
+
+    members = {}  # Rate class -> (area, db number) -> [(index, variable)]
+    index = 0
+    for block in blocks:
+        area = area_of(block)
+        for variable in block.variables:
+            rate_class = variable.rate_class or DEFAULT_CLASS
+            if rate_class not in intervals:
+                raise ValueError(f"The variable {variable.name} has the rate class {rate_class}, "
+                                 f"which is not in the rate classes {list(intervals)}")
+            key = (area, block.db_number if area == Areas.DB else 0)
+            members.setdefault(rate_class, {}).setdefault(key, []).append((index, variable))
+            index += 1
+
+    groups = []
+    for rate_class, areas in sorted(members.items(), key=lambda item: intervals[item[0]]):
+        ranges = [read_range for (area, db_number), variables in areas.items()
+                  for read_range in plan_ranges(area, db_number, variables, max_gap, max_range_size(pdu_length))]
+        groups.append(ReadGroup(rate_class, intervals[rate_class], ranges, pdu_length, polling.adaptive,
+                                connections))
+    return groups
@@ -0,0 +1,117 @@
+import logging
+import random
+import threading
+import time
+from common.metrics import registry
+from read_planner import ItemReadError
+
+logger = logging.getLogger(__name__)
+
+# Reconnecting to the PLC within the service, instead of exiting and waiting for docker to restart the container.
+#
+# The thread whose read fails reports it with recover(). The first report moves the state from CONNECTED to
+# RECONNECTING, and that thread reconnects with exponential backoff and jitter between the attempts, while the
+# other threads wait in recover() until the connection is back. An attempt succeeds when a health probe over the
+# new connection is answered. The events of the triggers and the schedules and buffers of the read groups are
+# kept, so the sampling continues where it stopped.
+#
+# The budget runs from the first failed read of a thread until a read of that thread succeeds again, across
+# reconnects: a reconnect whose probe is answered, followed by a read which fails again, continues the backoff and
+# the budget of the reconnect before, instead of starting over. When there has been no successful read for the budget, the state is FAILED
+# and the service exits as before. An item which the PLC refuses on a live connection, e.g. an address outside of
+# its data block, fails every read, so it stops the service at once instead of reconnecting.
+
+CONNECTED, RECONNECTING, FAILED = "connected", "reconnecting", "failed"
+
+plc_reconnects = registry.counter("plc_reconnects", "Reconnects to the PLC within the service", ["device"])
+reconnect_seconds = registry.histogram("plc_reconnect_seconds",
+                                       "Time from a lost connection to the PLC until it was reconnected",
+                                       ["device"], buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300))
+
+def backoff_delays(initial_delay, max_delay):
+    # Exponential backoff with jitter, each delay is between half and all of the backoff of the attempt, so that
+    # the services of a gateway do not reconnect to the PLC at the same moment
+    backoff = initial_delay
+    while True:
+        yield backoff / 2 + random.uniform(0, backoff / 2)
+        backoff = min(max_delay, backoff * 2)
+
+class Reconnector:
+    def __init__(self, connection_pool, device_config, stop_event, probe, on_lost, on_restored):
+        self.connection_pool = connection_pool
+        self.device_config = device_config
+        self.config = device_config.reconnect
+        self.stop_event = stop_event
+        # probe() reads from the PLC over the first connection, on_lost() and on_restored() publish the state
+        self.probe = probe
+        self.on_lost = on_lost
+        self.on_restored = on_restored
+        self.reconnects = plc_reconnects.labels(device_config.device.device_id)
+        self.reconnect_seconds = reconnect_seconds.labels(device_config.device.device_id)
+        self.state = CONNECTED
+        self.lock = threading.Lock()
+        self.connected = threading.Event()
+        self.connected.set()
+        # Per thread, the start of its failed reads and the backoff of their reconnects, while its reads fail
+        self.failing = threading.local()
+
+    def read_succeeded(self):
+        # Called by the threads after a successful read, ends the budget of their failed reads
+        self.failing.since = None
+
+    def fail(self, message):
+        with self.lock:
+            self.state = FAILED
+        if not self.stop_event.is_set():
+            logger.error(message)
+            self.stop_event.set()
+
+    def recover(self, error):
+        # Called by a thread whose read failed. Returns True when the connection is back and the read can be
+        # repeated, and False when the service is stopping.
+        if isinstance(error, ItemReadError):
+            self.fail(f"The PLC refused a read, check the addresses of the variables, restarting the container: {error}")
+            return False
+        if getattr(self.failing, "since", None) is None:
+            self.failing.since = time.perf_counter()
+            self.failing.delays = backoff_delays(self.config.initial_delay, self.config.max_delay)
+        with self.lock:
+            reconnecting = self.state == CONNECTED
+            if reconnecting:
+                self.state = RECONNECTING
+                self.connected.clear()
+        if not reconnecting:
+            # Another thread is reconnecting
+            while not self.connected.wait(0.1):
+                if self.stop_event.is_set() or self.state == FAILED:
+                    return False
+            return True
+
+        logger.error(f"Lost the connection to the PLC: {error}")
+        self.on_lost()
+        lost = time.perf_counter()
+        if not self.reconnect(self.failing.since + self.config.budget):
+            self.fail(f"No successful read from the PLC within {self.config.budget}s, restarting the container")
+            return False
+        with self.lock:
+            self.state = CONNECTED
+
+        duration = time.perf_counter() - lost
+        self.reconnects.inc()
+        self.reconnect_seconds.observe(duration)
+        logger.info(f"Reconnected to the PLC after {duration:.2f}s")
+        self.on_restored()
+        self.connected.set()
+        return True
+
+    def reconnect(self, deadline):
+        for attempt, delay in enumerate(self.failing.delays, start=1):
+            if time.perf_counter() + delay > deadline or self.stop_event.wait(delay):
+                return False
+            try:
+                with self.connection_pool.client_lock:
+                    self.connection_pool.reconnect(self.device_config)
+                    self.probe()
+                return True
+            except Exception as e:
+                logger.warning(f"Reconnect attempt {attempt} failed: {e}")
@@ -0,0 +1,206 @@
+import ctypes
+import logging
+import struct
+import time
+from collections import deque
+from snap7.type import Areas, WordLen, S7DataItem
+from common.metrics import registry
+from read_planner import data_format, max_range_size, ItemReadError, MAX_ITEMS, RESPONSE_HEADER, RESPONSE_ITEM
+
+logger = logging.getLogger(__name__)
+
+# Harvesting of ring buffers which the PLC program fills at cycle rate, for sampling rates which polling can
+# not reach.
+#
+# The PLC program writes every sample into slot counter % slots of a data block, with its own timestamp, and
+# then increments counter, the number of samples written so far. A harvest reads the counter and then only the
+# slots written since the last harvest, in bulk: up to two pieces of the buffer, as the new slots can wrap around
+# its end, split into requests which fit into the PDU. The slots are read into a mirror of the buffer, which is
+# allocated once. When the gateway falls behind by more than slots - reserve samples, the oldest ones are
+# skipped and counted as lost, as the PLC may be overwriting them while they are read.
+#
+# The timestamps of the PLC are ticks of a counter which wraps around. They are turned into unix time with the
+# offset between the clocks, which is estimated as the smallest lag between the newest sample and the time it
+# was harvested, over the last CLOCK_WINDOW harvests. The offset which is used follows the estimate by at most
+# MAX_SLEW seconds per second, so that the timestamps of consecutive batches never go back.
+
+CLOCK_WINDOW = 100
+MAX_SLEW = 0.01
+# Size limit of a data block which is read with absolute addresses, i.e. without optimized block access
+MAX_DB_SIZE = 65536
+
+ring_buffer_samples = registry.counter("ring_buffer_samples", "Samples harvested from ring buffers",
+                                       ["device", "ring"])
+ring_buffer_lost_samples = registry.counter("ring_buffer_lost_samples",
+                                            "Samples which were overwritten before they were harvested",
+                                            ["device", "ring"])
+ring_buffer_fill = registry.gauge("ring_buffer_fill", "Fraction of the slots which were new at the last harvest",
+                                  ["device", "ring"])
+
+class RingBufferHarvester:
+    def __init__(self, config, pdu_length, device_id):
+        self.config = config
+        self.index_struct = struct.Struct(">" + data_format(config.index_type))
+        self.index_modulus = 1 << (8 * self.index_struct.size)
+        self.reserve = config.reserve if config.reserve is not None else config.slots // 10
+        if not 0 <= self.reserve < config.slots:
+            raise ValueError(f"The reserve of the ring buffer {config.name} must be less than its {config.slots} slots")
+        if config.slots_offset + config.slots * config.slot_size > MAX_DB_SIZE:
+            raise ValueError(f"The ring buffer {config.name} does not fit into a data block of {MAX_DB_SIZE} bytes")
+        self.max_piece = max_range_size(pdu_length)
+        self.pdu_length = pdu_length
+        self.mirror = bytearray(config.slots * config.slot_size)
+
+        # One struct for a slot, with the timestamp and the variables as its fields
+        timestamp_format = data_format(config.timestamp.data_type)
+        self.tick_modulus = 1 << (8 * struct.calcsize(timestamp_format))
+        fields = {config.timestamp.byte_offset: timestamp_format}
+        for variable in config.variables:
+            value_format = data_format(variable.data_type)
+            if fields.setdefault(variable.byte_offset, value_format) != value_format:
+                raise ValueError(f"The variable {variable.name} of the ring buffer {config.name} overlaps another one")
+        position, layout = 0, ">"
+        for offset, value_format in sorted(fields.items()):
+            if offset < position:
+                raise ValueError(f"The fields of the ring buffer {config.name} overlap at byte {offset}")
+            layout += "x" * (offset - position) + value_format
+            position = offset + struct.calcsize(value_format)
+        if position > config.slot_size:
+            raise ValueError(f"The fields of the ring buffer {config.name} do not fit into its slot_size")
+        self.slot_struct = struct.Struct(layout + "x" * (config.slot_size - position))
+        field_indexes = {offset: index for index, offset in enumerate(sorted(fields))}
+        self.tick_field = field_indexes[config.timestamp.byte_offset]
+        # The field and the bit (or None) of every variable
+        self.variable_fields = [(field_indexes[variable.byte_offset],
+                                 variable.bit_offset if variable.data_type.upper() == "BOOL" else None)
+                                for variable in config.variables]
+
+        self.samples = ring_buffer_samples.labels(device_id, config.name)
+        self.lost_samples = ring_buffer_lost_samples.labels(device_id, config.name)
+        self.fill = ring_buffer_fill.labels(device_id, config.name)
+        self.clock_offsets = deque(maxlen=CLOCK_WINDOW)
+        self.restart()
+
+    def restart(self):
+        # The next harvest starts from the current counter, e.g. when the recording starts again
+        self.last_count = None
+        self.last_tick = None
+        self.plc_time = 0.0
+        self.clock_offsets.clear()
+        self.clock_offset = None
+
+    def read_counter(self, client):
+        reading = client.read_area(Areas.DB, self.config.db_number, self.config.index_offset, self.index_struct.size)
+        return self.index_struct.unpack(reading)[0] % self.index_modulus
+
+    def read_slots(self, client, first_slot, count):
+        # Reads count slots from first_slot on into the mirror, wrapping around the end of the buffer
+        slot_size = self.config.slot_size
+        pieces = []
+        first_count = min(count, self.config.slots - first_slot)
+        for start, length in ((first_slot * slot_size, first_count * slot_size),
+                              (0, (count - first_count) * slot_size)):
+            for offset in range(start, start + length, self.max_piece):
+                pieces.append((offset, min(self.max_piece, start + length - offset)))
+
+        # As many pieces per request as fit into the PDU
+        requests, current, size = [], [], RESPONSE_HEADER
+        for offset, length in pieces:
+            item_size = RESPONSE_ITEM + length + length % 2
+            if current and (size + item_size > self.pdu_length or len(current) == MAX_ITEMS):
+                requests.append(current)
+                current, size = [], RESPONSE_HEADER
+            current.append((offset, length))
+            size += item_size
+        if current:
+            requests.append(current)
+
+        for request in requests:
+            items = (S7DataItem * len(request))()
+            # ctypes arrays on the mirror, which have to stay referenced while the items are read
+            arrays = [(ctypes.c_ubyte * length).from_buffer(self.mirror, offset) for offset, length in request]
+            for item, (offset, length), array in zip(items, request, arrays):
+                item.Area = Areas.DB
+                item.WordLen = WordLen.Byte
+                item.DBNumber = self.config.db_number
+                item.Start = self.config.slots_offset + offset
+                item.Amount = length
+                item.pData = ctypes.cast(array, ctypes.POINTER(ctypes.c_ubyte))
+            client.read_multi_vars(items)
+            for item in items:
+                if item.Result != 0:
+                    raise ItemReadError(f"Reading the ring buffer {self.config.name} failed with code {item.Result:#x}")
+
+    def harvest(self, client):
+        # Returns the timestamps and the columns of the variables of the samples written since the last harvest,
+        # or None when there are none
+        count = self.read_counter(client)
+        harvest_time = time.time()
+        if self.last_count is None:
+            self.last_count = count
+            return None
+        new_samples = (count - self.last_count) % self.index_modulus
+        if new_samples > self.index_modulus // 2:
+            # The counter went back, the PLC program was restarted
+            logger.warning(f"The counter of the ring buffer {self.config.name} went back, restarting the harvest")
+            self.restart()
+            self.last_count = count
+            return None
+        self.fill.set(new_samples / self.config.slots)
+        if new_samples == 0:
+            return None
+        readable = self.config.slots - self.reserve
+        if new_samples > readable:
+            self.lost_samples.inc(new_samples - readable)
+            logger.warning(f"Lost {new_samples - readable} samples of the ring buffer {self.config.name}, "
+                           f"harvest more often or make the buffer larger")
+            new_samples = readable
+
+        first_slot = (count - new_samples) % self.config.slots
+        self.read_slots(client, first_slot, new_samples)
+        self.last_count = count
+
+        # The slots in the order they were written
+        slot_size = self.config.slot_size
+        first_count = min(new_samples, self.config.slots - first_slot)
+        mirror = memoryview(self.mirror)
+        rows = list(self.slot_struct.iter_unpack(mirror[first_slot * slot_size:
+                                                        (first_slot + first_count) * slot_size]))
+        rows += self.slot_struct.iter_unpack(mirror[:(new_samples - first_count) * slot_size])
+        fields = list(zip(*rows))
+        self.samples.inc(new_samples)
+        return self.timestamps(fields[self.tick_field], harvest_time), \
+            [fields[field] if bit is None else [bool(value >> bit & 1) for value in fields[field]]
+             for field, bit in self.variable_fields]
+
+    def timestamps(self, ticks, harvest_time):
+        # The unix times of the ticks of the PLC clock
+        resolution = self.config.timestamp.resolution
+        newest = ticks[-1] % self.tick_modulus
+        elapsed = 0.0
+        if self.last_tick is not None:
+            ticks_elapsed = (newest - self.last_tick) % self.tick_modulus
+            if ticks_elapsed > self.tick_modulus // 2:
+                ticks_elapsed -= self.tick_modulus
+            elapsed = ticks_elapsed * resolution
+            self.plc_time += elapsed
+        self.last_tick = newest
+        self.clock_offsets.append(harvest_time - self.plc_time)
+        estimate = min(self.clock_offsets)
+        if self.clock_offset is None:
+            self.clock_offset = estimate
+        if elapsed <= 0:
+            return [self.clock_offset + self.plc_time - (newest - tick) % self.tick_modulus * resolution
+                    for tick in ticks]
+
+        # The offset is slewed across the samples since the last harvest
+        previous_offset = self.clock_offset
+        max_step = MAX_SLEW * elapsed
+        self.clock_offset += max(-max_step, min(max_step, estimate - self.clock_offset))
+        step = self.clock_offset - previous_offset
+        timestamps = []
+        for tick in ticks:
+            age = (newest - tick) % self.tick_modulus * resolution
+            fraction = max(0.0, 1.0 - age / elapsed)
+            timestamps.append(self.plc_time - age + previous_offset + step * fraction)
+        return timestamps
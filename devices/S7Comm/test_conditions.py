@@ -0,0 +1,144 @@
+import sys
+from pathlib import Path
+
+repository_dir = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(repository_dir))
+sys.path.insert(0, str(repository_dir.joinpath("devices/S7Comm")))
+
+import pytest
+from models.devicemodels import DataBlock, Triggers
+from conditions import Condition, Trigger, SOURCE
+
+# Tests of the trigger conditions, run with: python -m pytest devices/S7Comm
+
+NAMES = {"a": 0, "b": 1, "c": 2, "Motor 1": 3}
+PDU_LENGTH = 480
+
+def evaluate_each(condition, polls):
+    # The result of every evaluation of the condition, on the values of successive polls
+    return [condition(values) for values in polls]
+
+def data_block():
+    return DataBlock(name="process", db_number=10, read_size=0, byte_offset=0, variables=[
+        {"name": "pressure", "data_type": "REAL", "byte_offset": 0, "bit_offset": 0, "units": "bar"},
+        {"name": "door_open", "data_type": "BOOL", "byte_offset": 4, "bit_offset": 2, "units": ""}])
+
+def trigger_config(condition, source=None):
+    return Triggers(trigger_type="data_trigger", node_id="node", device_id="plc", topic="", condition=condition,
+                    source=source or {})
+
+BOOLEAN_SOURCE = {"variable_type": "Boolean variable", "db_number": 20, "byte_offset": 0, "bit_offset": 3}
+
+@pytest.mark.parametrize("text, values, expected", [
+    # AND binds stronger than OR
+    ("a OR b AND c", [1, 1, 0, 0], True),
+    ("a OR b AND c", [0, 1, 0, 0], False),
+    ("(a OR b) AND c", [1, 1, 0, 0], False),
+    # NOT binds stronger than AND
+    ("NOT a AND b", [0, 1, 0, 0], True),
+    ("NOT (a AND b)", [1, 1, 0, 0], False),
+    # Comparisons bind stronger than NOT and AND
+    ("NOT a > 5 AND b = 2", [3, 2, 0, 0], True),
+    ("a >= 2.5 AND b <> 1", [2.5, 0, 0, 0], True),
+    ("a == b OR c != 0", [1, 2, 0, 0], False),
+    # Keywords are not case sensitive, and quoted names can contain spaces
+    ("\"Motor 1\" and not c or false", [0, 0, 0, 1], True),
+    ("a < -1e3 OR TRUE", [0, 0, 0, 0], True),
+])
+def test_precedence(text, values, expected):
+    assert Condition(text, NAMES)(values) is expected
+
+def test_indexes_of_the_variables():
+    assert Condition("a > 1 AND \"Motor 1\"", NAMES).indexes == {0, 3}
+
+def test_rising():
+    condition = Condition("RISING(a)", NAMES)
+    # The first evaluation has no previous value, so it is not an edge
+    assert evaluate_each(condition, [[1], [1], [0], [1], [1], [0]]) == [False, False, False, True, False, False]
+
+def test_falling():
+    condition = Condition("FALLING(a > 5)", NAMES)
+    assert evaluate_each(condition, [[6], [7], [3], [2], [8], [1]]) == [False, False, True, False, False, True]
+
+def test_latch():
+    condition = Condition("LATCH(a, b)", NAMES)
+    polls = [[0, 0], [1, 0], [0, 0], [0, 1], [0, 0], [1, 1], [1, 0]]
+    # Reset wins when both are set
+    assert evaluate_each(condition, polls) == [False, True, True, False, False, False, True]
+
+def test_latch_of_edges():
+    condition = Condition("LATCH(RISING(a), RISING(b))", NAMES)
+    polls = [[0, 0], [1, 0], [1, 0], [0, 0], [0, 1], [0, 1], [1, 1]]
+    assert evaluate_each(condition, polls) == [False, True, True, True, False, False, True]
+
+def test_hysteresis_high_level():
+    condition = Condition("HYSTERESIS(a, 80, 75)", NAMES)
+    polls = [[70], [78], [80], [77], [75], [78], [81]]
+    assert evaluate_each(condition, polls) == [False, False, True, True, False, False, True]
+
+def test_hysteresis_low_level():
+    condition = Condition("HYSTERESIS(a, 10, 15)", NAMES)
+    polls = [[20], [12], [10], [14], [15], [11], [9]]
+    assert evaluate_each(condition, polls) == [False, False, True, True, False, False, True]
+
+def test_stateful_operands_of_or_keep_their_state():
+    # OR evaluates all of its operands, so the edge is seen even while the first operand is true
+    condition = Condition("a OR RISING(b)", NAMES)
+    assert evaluate_each(condition, [[1, 0], [1, 1], [0, 1]]) == [True, True, False]
+
+@pytest.mark.parametrize("text, message", [
+    ("a AND", "expected a variable, a number or '('"),
+    ("(a OR b", "expected ')'"),
+    ("a b", "expected the end of the condition"),
+    ("a > 1 $ b", "unexpected '$'"),
+    ("HYSTERESIS(a, 1)", "expected ','"),
+    ("missing > 1", "unknown variable 'missing'"),
+    ("", "expected a variable, a number or '('"),
+])
+def test_invalid_conditions(text, message):
+    with pytest.raises(ValueError, match="Invalid trigger condition") as error:
+        Condition(text, NAMES)
+    assert message in str(error.value)
+
+@pytest.mark.parametrize("text, source_value, expected", [
+    ("True", True, True),
+    ("True", False, False),
+    (" false ", False, True),
+    ("FALSE", True, False),
+])
+def test_legacy_condition_compares_the_source(text, source_value, expected):
+    trigger = Trigger(trigger_config(text, BOOLEAN_SOURCE), [data_block()], PDU_LENGTH)
+    assert trigger.condition.text == f"{SOURCE} = {text.strip()}"
+    assert not trigger.in_data_blocks
+    # The source bit follows the variables of the data blocks
+    assert trigger.evaluate([0.0, False, source_value]) is expected
+
+def test_legacy_condition_of_a_memory_bit():
+    source = {"variable_type": "Memory bit", "byte_offset": 2, "bool_index": 6}
+    trigger = Trigger(trigger_config("True", source), [data_block()], PDU_LENGTH)
+    assert [read_range.db_number for read_range in trigger.ranges] == [0]
+
+def test_condition_over_the_data_blocks():
+    trigger = Trigger(trigger_config("pressure > 5.0 AND NOT door_open", BOOLEAN_SOURCE), [data_block()], PDU_LENGTH)
+    assert trigger.in_data_blocks
+    # Only the data block is read, not the source
+    assert [read_range.db_number for read_range in trigger.ranges] == [10]
+    assert trigger.evaluate([6.0, False, False])
+    assert not trigger.evaluate([6.0, True, False])
+
+def test_condition_with_the_source_is_not_in_the_data_blocks():
+    trigger = Trigger(trigger_config("pressure > 5.0 OR source", BOOLEAN_SOURCE), [data_block()], PDU_LENGTH)
+    assert not trigger.in_data_blocks
+    assert sorted(read_range.db_number for read_range in trigger.ranges) == [10, 20]
+
+def test_condition_without_a_source():
+    trigger = Trigger(trigger_config("HYSTERESIS(pressure, 8, 6)"), [data_block()], PDU_LENGTH)
+    assert trigger.in_data_blocks
+    with pytest.raises(ValueError, match="unknown variable 'source'"):
+        Trigger(trigger_config("source"), [data_block()], PDU_LENGTH)
+
+def test_variable_named_source():
+    block = data_block()
+    block.variables[0].name = SOURCE
+    with pytest.raises(ValueError, match="used by a variable of the device"):
+        Trigger(trigger_config("True", BOOLEAN_SOURCE), [block], PDU_LENGTH)
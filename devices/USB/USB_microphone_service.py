@@ -1,20 +1,23 @@
 import time
+# Start of the service, the imports are the first phase of the startup
+started = time.perf_counter()
 import threading
 from models.devicemodels import USBMicrophoneDevice
+from common.metrics import registry, publish, start_metrics_server
+from common.startup import load_config, StartupTimer
+import common.tracing  # Adds /debug/profile and /debug/traces to the metrics endpoint
 import yaml
 from pathlib import Path
 import valkey
 import json
 import argparse
 import sys
-import sounddevice as sd
 import numpy as np
 import io
-import httpx
-import wavio
 from datetime import datetime
 import logging
 import signal
+from audio_sources import create_audio_source, AudioSourceError
 
 logging.basicConfig(
     level=logging.INFO,
@@ -25,28 +28,23 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-#Setting the path for the config file
-parser = argparse.ArgumentParser()
-parser.add_argument("--device_service_config_path",
-                    help="Parse the path for the device service config file from metadata")
-parser.add_argument("--backend_ip",
-                    help="Parse the ip of the device where the file saver service is running")
-args = parser.parse_args()
-
-if not args.device_service_config_path:
-    print("Error: You must provide --device_service_config_path (path to the device service config file from metadata.yaml).")
-    sys.exit(1)
-
 #Directory for docker container
 mounted_dir = Path("/mounted_dir")
 
+# Metrics of the hot paths, exposed on the metrics endpoint of the container
+# Labelled by the device, as the device host runs several readers in one process
+audio_overflows = registry.counter("audio_callback_overflows", "Audio blocks delivered with a status flag, e.g. an input overflow",
+                                   ["device"])
+upload_seconds = registry.histogram("audio_upload_seconds", "Duration of the uploads of audio files to the data saver",
+                                    ["device", "result"])
+
 # Get configuration from config file
 def get_device_config(device_config_path):
     config_path = mounted_dir.joinpath(device_config_path)
 
     try:
-        with open(config_path, 'r') as f:
-            device_config = yaml.safe_load(f)
+        # From the cache when the file has not changed since the last start
+        config = load_config(config_path, USBMicrophoneDevice)
 
     except FileNotFoundError:
         logger.error(f"Error: The configuration file '{config_path}' does not exist.")
@@ -56,8 +54,6 @@ def get_device_config(device_config_path):
         logger.error(f"Error reading the YAML file: {e}")
         sys.exit(1)
 
-    config = USBMicrophoneDevice.model_validate(device_config)
-
     # Return all data from configfile
     return config
 
@@ -89,8 +85,16 @@ def valkey_connection(retries=3, delay=5):
 
 
 class PLCReader:
-    def __init__(self, device_config, valkey_client):
+    def __init__(self, device_config, valkey_client, backend_ip=None, backend_port=8000, data_dir=mounted_dir):
         self.device_config = device_config
+        self.backend_ip = backend_ip
+        self.backend_port = backend_port
+        self.data_dir = data_dir
+        # Number of audio blocks delivered with a status flag, e.g. an input overflow
+        self.overruns = 0
+        self.audio_overflows = audio_overflows.labels(device_config.device.device_id)
+        self.upload_seconds = {result: upload_seconds.labels(device_config.device.device_id, result)
+                               for result in ("saved", "failed")}
         # Get the configuration of the data trigger
         self.data_trigger_config = next((trigger for trigger in device_config.triggers if trigger.trigger_type == "data_trigger"),
                                         None)
@@ -98,13 +102,13 @@ class PLCReader:
         self.valkey_client = valkey_client
         self.trigger_event = threading.Event()
         self.stop_event = threading.Event()
+        self.threads = []
         self.DDEATH_topic = f"spBv1.0/{device_config.device.group_id}/DDEATH/{device_config.device.node_id}/{device_config.device.device_id}"
         self.DBIRTH_topic = f"spBv1.0/{device_config.device.group_id}/DBIRTH/{device_config.device.node_id}/{device_config.device.device_id}"
         self.state_topic = f"spBv1.0/{device_config.device.group_id}/STATE/{device_config.device.node_id}/{device_config.device.device_id}"
         self.data_topic = f"spBv1.0/{device_config.device.group_id}/AUDIODATA/{device_config.device.node_id}/{device_config.device.device_id}"
-        signal.signal(signal.SIGTERM, self.handle_sigterm)
         # Publish that the device is turning on
-        self.valkey_client.publish(self.DBIRTH_topic, json.dumps({"time": time.time(),
+        publish(self.valkey_client, self.DBIRTH_topic, json.dumps({"time": time.time(),
                                                                   "status": {"connected": "True"}
                                                                   }))
         logger.info(f"Starting up the USB microphone service for device: {device_config.device.device_id}")
@@ -117,108 +121,127 @@ class PLCReader:
         logger.info(f"Trigger condition: {trigger_condition}")
         previous_value = None
         # Initialise the subscription to a topic
-        pubsub = valkey_client.pubsub()
+        pubsub = self.valkey_client.pubsub()
         # Subscribes to source where trigger condition will be posted
         logger.info(f"This is the source of the trigger: {trigger_source}")
         pubsub.subscribe(trigger_source)
+        logger.info("Waiting for the trigger")
         while not self.stop_event.is_set():
-            logger.info("Waiting for the trigger")
-            for message in pubsub.listen():
-                if message['type'] == 'message':
-                    message_data = json.loads(message['data'].decode('utf-8'))
-                    #As there will come multiple messages on this channel we need to ensure that the message
-                    # Is a data trigger message, and will return none if it isnt
-                    trigger_value = message_data.get("status", {}).get("data_trigger", None)
-                    if trigger_value:
-                        logger.info(f"Received sampling trigger")
-
-                        # Publish initial value or changed value
-                        if previous_value is None or trigger_value != previous_value:
-                            logger.info(f"Data trigger state: {trigger_value}")
-                            self.valkey_client.publish(self.state_topic, json.dumps({"time": time.time(),
-                                                                                     "status": {
-                                                                                         "data_trigger": str(trigger_value)}
-                                                                                     }))
-                            previous_value = trigger_value
-                        if trigger_value == trigger_condition:
-                            logger.info("Trigger event set")
-                            self.trigger_event.set() # Set event if the trigger_value is = condition
-                        else:
-                            logger.info("Trigger event cleared")
-                            self.trigger_event.clear() # Clear event when trigger_value is != condition
+            # Returns after a second without a message, so that the loop stops with the service
+            message = pubsub.get_message(timeout=1.0)
+            if message is not None and message['type'] == 'message':
+                message_data = json.loads(message['data'].decode('utf-8'))
+                #As there will come multiple messages on this channel we need to ensure that the message
+                # Is a data trigger message, and will return none if it isnt
+                trigger_value = message_data.get("status", {}).get("data_trigger", None)
+                if trigger_value:
+                    logger.info(f"Received sampling trigger")
+
+                    # Publish initial value or changed value
+                    if previous_value is None or trigger_value != previous_value:
+                        logger.info(f"Data trigger state: {trigger_value}")
+                        publish(self.valkey_client, self.state_topic, json.dumps({"time": time.time(),
+                                                                                 "status": {
+                                                                                     "data_trigger": str(trigger_value)}
+                                                                                 }))
+                        previous_value = trigger_value
+                    if trigger_value == trigger_condition:
+                        logger.info("Trigger event set")
+                        self.trigger_event.set() # Set event if the trigger_value is = condition
+                    else:
+                        logger.info("Trigger event cleared")
+                        self.trigger_event.clear() # Clear event when trigger_value is != condition
+        pubsub.close()
+
+    def encode_audio(self, audio_buffer, samplerate):
+        # Save the recorded blocks as a WAV file in a memory buffer
+        import wavio
+        audio_data = np.concatenate(audio_buffer)
+        buffer = io.BytesIO()
+        wavio.write(buffer, audio_data, samplerate)
+        buffer.seek(0)
+        return audio_data, buffer
+
+    def upload_audio(self, file_name, buffer, device_id):
+        # Send the audio file to the data saver in the backend, returns False if it could not be saved there
+        import httpx
+        file = {"file": (file_name, buffer, "audio/wav")}
+        device = {"device_id": device_id}
+        upload_start = time.perf_counter()
+        try:
+            with httpx.Client(timeout=2) as client:
+                response = client.post(f"http://{self.backend_ip}:{self.backend_port}/api/data_saver/upload_audio",
+                                       files=file,
+                                       data=device)
+
+            if response.status_code == 200:
+                logger.info("Successfully saved the audio file in the backend")
+                self.upload_seconds["saved"].observe(time.perf_counter() - upload_start)
+                return True
+
+            else:
+                raise httpx.HTTPStatusError("Unexpected status code", request=response.request, response=response)
+
+        except (httpx.RequestError, httpx.HTTPStatusError) as e:
+            logger.error("Could not save the audio file in the backend, saving locally instead. Check connection.")
+            self.upload_seconds["failed"].observe(time.perf_counter() - upload_start)
+            return False
 
     def sample_microphone_data(self):
         name = self.USB_device.name
         data_type = self.USB_device.data_type
         units = self.USB_device.units
         samplerate = self.USB_device.samplerate
-        channel = self.USB_device.channel
         device_id = self.device_config.device.device_id
 
         logger.info(f"Will sample the microphone with a samplerate of: {samplerate} Hz")
+        # The modules for saving and uploading the audio files are not needed for the startup, they are imported
+        # by this thread while it waits for the first trigger
+        import httpx
+        import wavio
 
         # Create a directory for saving the audio files locally if the connection drops
-        audio_datapath = mounted_dir.joinpath(f"data/audio_data/{device_id}")
+        audio_datapath = self.data_dir.joinpath(f"data/audio_data/{device_id}")
 
         if not audio_datapath.exists():
             audio_datapath.mkdir(parents=True,exist_ok=True)
             logger.info("Created a path for the audio data if the connection drops")
 
-        # Find the sound device
-        device_name = name.lower()
-        input_device_index = None
-        for idx, device in enumerate(sd.query_devices()):
-            if device_name in device['name'].lower() and device['max_input_channels'] > 0:
-                input_device_index = idx
-                break
-
-        if input_device_index is not None:
-            logger.info(
-                f"Using input device: {sd.query_devices(input_device_index)['name']} (index {input_device_index})")
-        else:
-            logger.error(f"No matching input device found for name: {self.USB_device.name}")
-            self.stop_event.set()
-            sys.exit(1)
-
         def audio_callback(indata, frames, time_info, status):
             if status:
+                self.overruns += 1
+                self.audio_overflows.inc()
                 logger.info(status)
             # Append the audio data to the buffer
             audio_buffer.append(indata.copy())
 
+        # Find the audio source, the sound device unless another source is configured
+        try:
+            audio_source = create_audio_source(self.USB_device, audio_callback)
+        except AudioSourceError as e:
+            logger.error(e)
+            self.stop_event.set()
+            sys.exit(1)
+
         while not self.stop_event.is_set():
-            self.trigger_event.wait()  # Block until trigger is True
+            if not self.trigger_event.wait(1):  # Block until trigger is True
+                continue
 
             audio_buffer = []
             try:
                 logger.info("Starting audio sampling")
                 sample_time = time.time()
-                with sd.InputStream(samplerate=samplerate,
-                                    channels=channel,
-                                    callback=audio_callback,
-                                    dtype="int16",
-                                    device=(input_device_index,None)):
+                with audio_source:
                     while self.trigger_event.is_set():
                         time.sleep(0.1)  # Keep the thread alive while audio is streaming
 
                 logger.info("Audio sampling stopped")
 
-            except sd.PortAudioError as e:
-                if "Invalid sample rate" in str(e):
-                    logger.error(f"Invalid sample rate: {samplerate}")
-                    #Exit thread
-                    self.stop_event.set()
-                    sys.exit(1)
-
-                else:
-                    logger.error("PortAudio error during input stream setup.")
-                    devices = sd.query_devices()
-                    if not devices:
-                        logger.info("No audio devices ws found")
-                    else:
-                        logger.info(f"The following audio devices are available: {devices}")
-                    self.stop_event.set()
-                    sys.exit(1)
+            except AudioSourceError as e:
+                logger.error(e)
+                #Exit thread
+                self.stop_event.set()
+                sys.exit(1)
 
             except Exception as e:
                 logger.error("Unexpected error during audio sampling")
@@ -226,36 +249,15 @@ class PLCReader:
                 sys.exit(1)
 
             if audio_buffer:
-                audio_buffer = np.concatenate(audio_buffer)
-                # save the file in memory buffer
-                buffer = io.BytesIO()
-                wavio.write(buffer, audio_buffer, samplerate)
-                buffer.seek(0)
+                audio_data, buffer = self.encode_audio(audio_buffer, samplerate)
                 #Convert the sample time to date time
                 sample_time_dt = datetime.fromtimestamp(sample_time)
                 formatted_dt = sample_time_dt.strftime("%Y_%m_%d_%H_%M_%S")
                 file_name = f"{formatted_dt}_{device_id}"
 
-                file = {"file": (file_name, buffer, "audio/wav")}
-
-                device = {"device_id": device_id}
-                try:
-                    with httpx.Client(timeout=2) as client:
-                        response = client.post(f"http://{args.backend_ip}:8000/api/data_saver/upload_audio",
-                                               files=file,
-                                               data=device)
-
-                    if response.status_code == 200:
-                        logger.info("Successfully saved the audio file in the backend")
-
-                    else:
-                        raise httpx.HTTPStatusError("Unexpected status code", request=response.request, response=response)
-
-                except (httpx.RequestError, httpx.HTTPStatusError) as e:
-                    logger.error("Could not save the audio file in the backend, saving locally instead. Check connection.")
-
+                if not self.upload_audio(file_name, buffer, device_id):
                     audio_file = audio_datapath.joinpath(file_name)
-                    wavio.write(str(audio_file), audio_buffer, samplerate, sampwidth=2)
+                    wavio.write(str(audio_file), audio_data, samplerate, sampwidth=2)
                     if audio_file.exists():
                         logger.info("Saved the audio file locally")
                     else:
@@ -271,22 +273,33 @@ class PLCReader:
                 }]
 
                 # Publish if the information about the data file to the database
-                self.valkey_client.publish(self.data_topic, json.dumps({"time": time.time(),
+                publish(self.valkey_client, self.data_topic, json.dumps({"time": time.time(),
                                                                    "metrics": audio_metric}))
 
     # Handling the shutdown of the container
     def handle_sigterm(self, signum, frame):
         logger.info("Received SIGTERM, shutting down gracefully...")
+        self.stop()
+        # give threads a moment to stop
+        time.sleep(4)
+        sys.exit(0)
+
+    def stop(self):
         # Stops the while loops of each function
         self.stop_event.set()
         # Stops the audio sampling
         self.trigger_event.clear()
-        # give threads a moment to stop
-        time.sleep(4)
-        sys.exit(0)
+        # Publish that the device is turning off
+        publish(self.valkey_client, self.DDEATH_topic, json.dumps({"time": time.time(),
+                                                                  "status": {"connected": "False"}
+                                                                  }))
 
-    def start_sampling(self):
+    def close(self):
+        # Waits for the threads to stop, for the device host which keeps running
+        for thread in self.threads:
+            thread.join(5)
 
+    def start(self):
         # Start thread for trigger monitoring
         trigger_thread = threading.Thread(target=self.monitor_trigger)
         trigger_thread.daemon = True
@@ -296,13 +309,17 @@ class PLCReader:
         data_thread = threading.Thread(target=self.sample_microphone_data)
         data_thread.daemon = True
         data_thread.start()
+        self.threads = [trigger_thread, data_thread]
+
+    def start_sampling(self):
+        self.start()
 
         # Keep the main program running
         while not self.stop_event.is_set():
             time.sleep(1)
 
         #Publishing that the service is shutting down
-        self.valkey_client.publish(self.DDEATH_topic, json.dumps({"time": time.time(),
+        publish(self.valkey_client, self.DDEATH_topic, json.dumps({"time": time.time(),
                                                                   "status": {"connected": "False"}
                                                                   }))
         logger.info("Shutting down")
@@ -310,14 +327,33 @@ class PLCReader:
 
 
 
-# Get configuration from config file
-device_config_path = args.device_service_config_path
-# Setup
-# First ensure that the connection to the internal message bus can be established
-valkey_client = valkey_connection()
-# Second get the configuration of the device service
-device_config = get_device_config(args.device_service_config_path)
-
-# Forth Initialize PLCReader and start sampling
-plc_reader = PLCReader(device_config, valkey_client)
-plc_reader.start_sampling()
+if __name__ == "__main__":
+    #Setting the path for the config file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device_service_config_path",
+                        help="Parse the path for the device service config file from metadata")
+    parser.add_argument("--backend_ip",
+                        help="Parse the ip of the device where the file saver service is running")
+    args = parser.parse_args()
+
+    if not args.device_service_config_path:
+        print("Error: You must provide --device_service_config_path (path to the device service config file from metadata.yaml).")
+        sys.exit(1)
+
+    startup = StartupTimer(started)
+    startup.mark("imports")
+    start_metrics_server()
+    # Setup
+    # First ensure that the connection to the internal message bus can be established
+    valkey_client = valkey_connection()
+    startup.mark("valkey")
+    # Second get the configuration of the device service
+    device_config = get_device_config(args.device_service_config_path)
+    startup.mark("config")
+
+    # Forth Initialize PLCReader and start sampling
+    plc_reader = PLCReader(device_config, valkey_client, backend_ip=args.backend_ip)
+    signal.signal(signal.SIGTERM, plc_reader.handle_sigterm)
+    startup.mark("reader")
+    startup.log()
+    plc_reader.start_sampling()
@@ -0,0 +1,173 @@
+import logging
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Audio sources for the USB microphone service. Every source is used like sd.InputStream: it is a context
+# manager, and while it is open it calls callback(indata, frames, time_info, status) with blocks of int16 audio.
+# Besides the PortAudio device this makes it possible to run the service from a WAV file or a signal generator.
+
+class AudioSourceError(Exception):
+    pass
+
+class PortAudioSource:
+    """Records from the first PortAudio input device whose name contains the configured name"""
+    def __init__(self, name, samplerate, channels, callback, blocksize=0):
+        # Imported here, so that the other sources can be used on machines without PortAudio
+        try:
+            import sounddevice as sd
+        except OSError as e:
+            raise AudioSourceError(f"PortAudio is not available: {e}")
+        self.sd = sd
+        self.samplerate = samplerate
+        self.channels = channels
+        self.callback = callback
+        self.blocksize = blocksize
+        self.stream = None
+
+        # Find the sound device
+        device_name = name.lower()
+        self.input_device_index = None
+        for idx, device in enumerate(sd.query_devices()):
+            if device_name in device['name'].lower() and device['max_input_channels'] > 0:
+                self.input_device_index = idx
+                break
+
+        if self.input_device_index is None:
+            raise AudioSourceError(f"No matching input device found for name: {name}")
+        logger.info(f"Using input device: {sd.query_devices(self.input_device_index)['name']} "
+                    f"(index {self.input_device_index})")
+
+    def __enter__(self):
+        try:
+            self.stream = self.sd.InputStream(samplerate=self.samplerate,
+                                              channels=self.channels,
+                                              callback=self.callback,
+                                              blocksize=self.blocksize,
+                                              dtype="int16",
+                                              device=(self.input_device_index, None))
+            self.stream.start()
+        except self.sd.PortAudioError as e:
+            if "Invalid sample rate" in str(e):
+                raise AudioSourceError(f"Invalid sample rate: {self.samplerate}")
+            devices = self.sd.query_devices()
+            if not devices:
+                raise AudioSourceError(f"PortAudio error during input stream setup ({e}), no audio devices was found")
+            raise AudioSourceError(f"PortAudio error during input stream setup ({e}), "
+                                   f"the following audio devices are available: {devices}")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stream.stop()
+        self.stream.close()
+
+class GeneratedSource:
+    """Base for the sources which are not a sound card.
+
+    Blocks are delivered from a thread at the pace of the sample rate. When the callback has not returned in
+    time for the next block, the blocks which were missed are dropped and the next block has the status
+    "input overflow", as PortAudio does when the callback can not keep up.
+    """
+    def __init__(self, samplerate, channels, callback, blocksize=1024):
+        self.samplerate = samplerate
+        self.channels = channels
+        self.callback = callback
+        self.blocksize = blocksize or 1024
+        self.position = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def read(self, frames):
+        # Returns the next frames as an int16 array with the shape (frames, channels)
+        raise NotImplementedError
+
+    def run(self):
+        block_duration = self.blocksize / self.samplerate
+        next_block = time.perf_counter() + block_duration
+        status = ""
+        while not self.stop_event.is_set():
+            delay = next_block - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -block_duration:
+                # Drop the blocks there was no time for
+                missed = int(-delay / block_duration)
+                self.position += missed * self.blocksize
+                next_block += missed * block_duration
+                status = "input overflow"
+            self.callback(self.read(self.blocksize), self.blocksize, None, status)
+            status = ""
+            next_block += block_duration
+
+    def __enter__(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop_event.set()
+        self.thread.join()
+
+class SignalGeneratorSource(GeneratedSource):
+    """Sine wave of the given frequency with optional white noise, the same on every channel"""
+    def __init__(self, samplerate, channels, callback, blocksize=1024, frequency=440.0, amplitude=0.5, noise=0.0):
+        super().__init__(samplerate, channels, callback, blocksize)
+        self.frequency = frequency
+        self.amplitude = amplitude
+        self.noise = noise
+        self.rng = np.random.default_rng()
+
+    def read(self, frames):
+        t = (np.arange(frames) + self.position) / self.samplerate
+        self.position += frames
+        signal = self.amplitude * np.sin(2 * np.pi * self.frequency * t)
+        if self.noise:
+            signal += self.rng.uniform(-self.noise, self.noise, frames)
+        samples = (np.clip(signal, -1, 1) * 32767).astype(np.int16)
+        return np.repeat(samples[:, np.newaxis], self.channels, axis=1)
+
+class WavFileSource(GeneratedSource):
+    """Plays a WAV file in a loop, at the configured sample rate"""
+    def __init__(self, path, samplerate, channels, callback, blocksize=1024):
+        super().__init__(samplerate, channels, callback, blocksize)
+        import wavio
+
+        try:
+            wav = wavio.read(str(path))
+        except (OSError, ValueError) as e:
+            raise AudioSourceError(f"Could not read the WAV file {path}: {e}")
+        if wav.rate != samplerate:
+            logger.warning(f"The WAV file has a samplerate of {wav.rate} Hz, it is played at {samplerate} Hz")
+        data = wav.data
+        if wav.sampwidth != 2:
+            # Scale to 16 bit samples
+            data = (data.astype(np.float64) * 32767 / np.iinfo(data.dtype).max).astype(np.int16)
+        # Use the first channels of the file, or repeat the last channel when the file has fewer channels
+        if data.shape[1] >= channels:
+            data = data[:, :channels]
+        else:
+            data = np.concatenate([data, np.repeat(data[:, -1:], channels - data.shape[1], axis=1)], axis=1)
+        self.data = np.ascontiguousarray(data, dtype=np.int16)
+
+    def read(self, frames):
+        indexes = (np.arange(frames) + self.position) % len(self.data)
+        self.position += frames
+        return self.data[indexes]
+
+def create_audio_source(USB_device, callback, blocksize=0):
+    # Creates the source configured for the USB device, PortAudio unless another source is configured
+    source = USB_device.source or "portaudio"
+    if source == "portaudio":
+        return PortAudioSource(USB_device.name, USB_device.samplerate, USB_device.channel, callback, blocksize)
+    if source == "wav":
+        if not USB_device.file:
+            raise AudioSourceError("The wav source needs the path of a WAV file in file")
+        return WavFileSource(USB_device.file, USB_device.samplerate, USB_device.channel, callback, blocksize)
+    if source == "generator":
+        return SignalGeneratorSource(USB_device.samplerate, USB_device.channel, callback, blocksize,
+                                     frequency=USB_device.frequency or 440.0)
+    raise AudioSourceError(f"Unknown audio source: {source}")
@@ -0,0 +1,334 @@
+import time
+# Start of the service, the imports are the first phase of the startup
+started = time.perf_counter()
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from models.devicemodels import DeviceService
+from common.metrics import registry, routes, start_metrics_server
+from common.bus import BusPublisher
+from common.startup import StartupTimer
+import common.tracing  # Adds /debug/profile and /debug/traces to the metrics endpoint
+from pydantic import ValidationError
+import yaml
+from pathlib import Path
+import valkey
+import json
+import argparse
+import os
+import sys
+import logging
+import signal
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+logger = logging.getLogger(__name__)
+
+# Device host: runs the device services of the gateway in one process, instead of a container per device.
+#
+# The host runs every activated device service of metadata.yaml with the driver of its protocol. A driver creates
+# the reader of the device service, e.g. the PLCReader of the S7Comm service, which runs its own sampling threads
+# as it does in its container. What the devices share is the process: one interpreter with the modules loaded
+# once, one Valkey connection behind a batched publisher (common/bus.py), one metrics endpoint and one thread
+# pool which starts and stops the devices. Only the drivers of the configured protocols are imported.
+#
+# metadata.yaml is watched, so devices which the configurator adds, removes or deactivates are started and
+# stopped while the host runs. A device which stops, e.g. as it could not reconnect to its PLC within the
+# reconnect budget, or which can not be started, is started again after RESTART_DELAY, doubling up to
+# MAX_RESTART_DELAY, like the restart policy of its container would. The states of the devices are served on
+# /devices of the metrics endpoint, and /devices/restart?device_id=<id> restarts one of them.
+
+#Directory for docker container
+mounted_dir = Path("/mounted_dir")
+
+RESTART_DELAY = 5.0
+MAX_RESTART_DELAY = 60.0
+# Threads of the pool which starts and stops the devices, a start waits for the connection to the device
+HOST_WORKERS = int(os.getenv("HOST_WORKERS", "8"))
+
+hosted_devices = registry.gauge("hosted_devices", "Device services run by the device host, by state", ["state"])
+device_restarts = registry.counter("device_restarts", "Restarts of the device services by the device host",
+                                   ["device"])
+
+# Drivers of the device services, which return the reader of a device from the path of its config
+def start_S7_device(device_config_path, bus):
+    # Imported here, so that the host only loads the drivers of the configured devices
+    import S7Comm_service
+    device_config = S7Comm_service.get_device_config(device_config_path)
+    client = S7Comm_service.connect_to_plc(device_config)
+    return S7Comm_service.PLCReader(device_config, client, bus, config_path=mounted_dir.joinpath(device_config_path))
+
+def start_USB_microphone(device_config_path, bus):
+    import USB_microphone_service
+    device_config = USB_microphone_service.get_device_config(device_config_path)
+    return USB_microphone_service.PLCReader(device_config, bus, backend_ip=backend_ip())
+
+# By the driver of the device service in metadata.yaml, or by its protocol_type for the services which were added
+# before the driver was recorded
+DRIVERS = {"S7Comm": start_S7_device, "USB_microphone": start_USB_microphone, "USB": start_USB_microphone}
+
+def backend_ip():
+    # The data saver for the audio files runs on the broker of the MQTT publisher
+    mqtt_path = mounted_dir.joinpath("applications/MQTT/MQTT_config.yaml")
+    try:
+        with open(mqtt_path, 'r') as f:
+            return yaml.safe_load(f)["broker"].get("ip", "")
+    except (OSError, yaml.YAMLError, KeyError, TypeError) as e:
+        logger.error(f"Could not read the ip of the backend from {mqtt_path}: {e}")
+        return None
+
+# Connecting to the internal message bus
+def valkey_connection(retries=3, delay=5):
+    logger.info("Connecting the to internal messagebus")
+    attempt = 0
+    while attempt < retries:
+        try:
+            valkey_client = valkey.Valkey(host="localhost", port=6379)
+
+            # Test connection
+            if valkey_client.ping():
+                logger.info("Connection to the internal message bus was successful")
+                return valkey_client
+            else:
+                logger.error("Ping failed, no connection to the internal message bus")
+
+        except Exception as e:
+            logger.error(f"Connection attempt {attempt + 1} failed with error: {e}")
+
+        attempt += 1
+        if attempt < retries:
+            logger.info(f"Retrying in {delay} seconds... ({attempt}/{retries}) attempts")
+            time.sleep(delay)
+        else:
+            logger.error("All retry attempts failed. Shutting down")
+            sys.exit(1)
+
+class HostedDevice:
+    """A device service run by the host, with the state of its reader"""
+    def __init__(self, service, start_device):
+        self.service = service
+        self.start_device = start_device
+        self.reader = None
+        # starting, running, waiting (for a restart), stopping, stopped or unsupported
+        self.state = "starting"
+        self.error = None
+        self.failures = 0
+        self.restarts = device_restarts.labels(service.device_id)
+        self.next_start = 0.0
+        # Set when the device was removed from metadata.yaml while it was starting
+        self.removed = False
+
+    def describe(self):
+        return {"device_id": self.service.device_id, "protocol_type": self.service.protocol_type,
+                "driver": self.service.driver, "config": self.service.config, "state": self.state,
+                "restarts": int(self.restarts.value), "error": self.error}
+
+class DeviceHost:
+    def __init__(self, bus, metadata_path, workers=HOST_WORKERS):
+        self.bus = bus
+        self.metadata_path = metadata_path
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="device_host")
+        self.lock = threading.Lock()
+        self.devices = {}  # device_id -> HostedDevice
+        self.metadata_signature = None
+        self.restart_requests = set()
+        self.stop_event = threading.Event()
+        for state in ("starting", "running", "waiting", "stopping", "unsupported"):
+            hosted_devices.labels(state).set_function(lambda state=state: self.count(state))
+        routes["/devices"] = self.devices_route
+        routes["/devices/restart"] = self.restart_route
+
+    def count(self, state):
+        with self.lock:
+            return sum(device.state == state for device in self.devices.values())
+
+    def load_services(self):
+        # The activated device services of metadata.yaml by their device_id, None when the file can not be read
+        try:
+            with open(self.metadata_path, 'r') as f:
+                metadata = yaml.safe_load(f) or {}
+        except (OSError, yaml.YAMLError) as e:
+            logger.error(f"Could not read {self.metadata_path}, keeping the running devices: {e}")
+            return None
+        services = {}
+        for entry in (metadata.get("services") or {}).get("device_services") or []:
+            try:
+                service = DeviceService.model_validate(entry)
+            except ValidationError as e:
+                logger.error(f"Skipping an invalid device service in {self.metadata_path}: {e}")
+                continue
+            if service.activated:
+                services[service.device_id] = service
+        return services
+
+    def metadata_changed(self):
+        try:
+            status = os.stat(self.metadata_path)
+        except FileNotFoundError:
+            return False
+        signature = status.st_mtime_ns, status.st_size
+        if signature == self.metadata_signature:
+            return False
+        self.metadata_signature = signature
+        return True
+
+    def sync(self):
+        # Starts the new device services of metadata.yaml and stops the ones which were removed, deactivated or
+        # moved to another config file. Returns the futures of the starts.
+        services = self.load_services()
+        if services is None:
+            return []
+        futures = []
+        with self.lock:
+            devices = dict(self.devices)
+        for device_id, device in devices.items():
+            service = services.get(device_id)
+            if service is None or service.config != device.service.config or \
+                    service.driver != device.service.driver or service.protocol_type != device.service.protocol_type:
+                logger.info(f"The device service {device_id} was changed or removed in metadata.yaml, stopping it")
+                with self.lock:
+                    del self.devices[device_id]
+                device.removed = True
+                futures.append(self.executor.submit(self.stop_device, device))
+        for device_id, service in services.items():
+            if device_id in self.devices:
+                continue
+            driver = service.driver or service.protocol_type
+            start_device = DRIVERS.get(driver)
+            device = HostedDevice(service, start_device)
+            with self.lock:
+                self.devices[device_id] = device
+            if start_device is None:
+                device.state = "unsupported"
+                device.error = f"The device host has no driver for {driver}"
+                logger.warning(f"{device.error}, the device service {device_id} is not run")
+                continue
+            futures.append(self.executor.submit(self.start_device, device))
+        return futures
+
+    def start_device(self, device):
+        device_id = device.service.device_id
+        device.state = "starting"
+        logger.info(f"Starting the device service {device_id}")
+        try:
+            reader = device.start_device(device.service.config, self.bus)
+            reader.start()
+        # The services exit when a device can not be started, which in the host only fails this device
+        except (Exception, SystemExit) as e:
+            device.failures += 1
+            delay = min(RESTART_DELAY * 2 ** (device.failures - 1), MAX_RESTART_DELAY)
+            device.error = str(e) if isinstance(e, Exception) else "The device service exited while starting"
+            logger.error(f"Could not start the device service {device_id}, retrying in {delay:.0f}s: {device.error}")
+            device.next_start = time.monotonic() + delay
+            device.state = "waiting"
+            return
+        device.reader, device.error, device.failures = reader, None, 0
+        device.state = "running"
+        if device.removed:
+            self.stop_device(device)
+
+    def stop_device(self, device):
+        reader = device.reader
+        if reader is None:
+            return
+        device.state = "stopping"
+        try:
+            reader.stop()
+            reader.close()
+        except Exception as e:
+            logger.error(f"Error while stopping the device service {device.service.device_id}: {e}")
+        device.reader = None
+        device.state = "stopped"
+
+    def restart_device(self, device, delay=0.0):
+        self.stop_device(device)
+        device.restarts.inc()
+        device.next_start = time.monotonic() + delay
+        device.state = "waiting"
+
+    def supervise(self):
+        # Called every second: applies the changes of metadata.yaml and of the configs of the devices, and
+        # restarts the devices which stopped or were asked to restart
+        if self.metadata_changed():
+            self.sync()
+        with self.lock:
+            devices = list(self.devices.values())
+            restart_requests, self.restart_requests = self.restart_requests, set()
+        now = time.monotonic()
+        for device in devices:
+            reader = device.reader
+            if device.service.device_id in restart_requests and device.state in ("running", "waiting"):
+                logger.info(f"Restarting the device service {device.service.device_id}")
+                device.state = "stopping"
+                self.executor.submit(self.restart_device, device)
+            elif device.state == "running" and reader.stop_event.is_set():
+                logger.warning(f"The device service {device.service.device_id} stopped, restarting it in "
+                               f"{RESTART_DELAY:.0f}s")
+                device.state = "stopping"
+                self.executor.submit(self.restart_device, device, RESTART_DELAY)
+            elif device.state == "running" and hasattr(reader, "check_config"):
+                try:
+                    reader.check_config()
+                except Exception as e:
+                    logger.error(f"Could not apply the changed config of {device.service.device_id}: {e}")
+            elif device.state == "waiting" and now >= device.next_start:
+                device.state = "starting"
+                self.executor.submit(self.start_device, device)
+
+    def stop(self):
+        # Stops all devices at the same time
+        with self.lock:
+            devices = list(self.devices.values())
+        wait([self.executor.submit(self.stop_device, device) for device in devices])
+        self.executor.shutdown(wait=False)
+
+    def devices_route(self, query):
+        with self.lock:
+            devices = [device.describe() for device in self.devices.values()]
+        return 200, "application/json", json.dumps(devices)
+
+    def restart_route(self, query):
+        device_id = query.get("device_id")
+        with self.lock:
+            if device_id not in self.devices:
+                return 404, "text/plain; charset=utf-8", f"The device host does not run the device {device_id}"
+            self.restart_requests.add(device_id)
+        return 202, "application/json", json.dumps({"device_id": device_id, "status": "restarting"})
+
+    def handle_sigterm(self, signum, frame):
+        logger.info("Received SIGTERM, shutting down gracefully...")
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.wait(1):
+            self.supervise()
+        self.stop()
+        self.bus.close()
+        logger.info("Shutting down")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--metadata_path", default="core/metadata.yaml",
+                        help="Path of metadata.yaml in the mounted directory")
+    args = parser.parse_args()
+
+    startup = StartupTimer(started)
+    startup.mark("imports")
+    start_metrics_server()
+    # Setup
+    # First ensure that the connection to the internal message bus can be established, it is shared by the devices
+    bus = BusPublisher(valkey_connection())
+    startup.mark("valkey")
+
+    # Second start the device services of metadata.yaml, at the same time
+    device_host = DeviceHost(bus, mounted_dir.joinpath(args.metadata_path))
+    signal.signal(signal.SIGTERM, device_host.handle_sigterm)
+    device_host.metadata_changed()
+    wait(device_host.sync())
+    startup.mark("devices")
+    startup.log()
+    device_host.run()
@@ -1,15 +1,20 @@
 import time
 import valkey
-import json
 from pymodbus.client import AsyncModbusTcpClient
 import yaml
 from pathlib import Path
 import asyncio
 from pymodbus import ModbusException
-from typing import List
 from models.devicemodels import ModbusDeviceServiceConfig
+from common.metrics import registry, publish, start_metrics_server
+from common.tracing import tracer
+from common.serialization import MetricsSerializer, VALUE, TIMESTAMP
 import sys
 
+# Metrics of the hot paths, exposed on the metrics endpoint of the container
+read_seconds = registry.histogram("modbus_read_seconds", "Latency of reads from the Modbus device per area", ["area"])
+poll_overruns = registry.counter("poll_overruns", "Polls which took longer than the poll interval", ["loop"])
+
 # Get configuration from config file
 def get_device_config(device_config_path):
     config_path = Path.cwd().parent.joinpath(device_config_path)
@@ -69,76 +74,78 @@ async def connect_modbus_client(ip, port):
         print(f"Could not connect to the modbus device, with the following error: {e}")
         exit()
 
-def create_datadict(
-        indexes: List[int],
-        names: List[str],
-        data_types: List[str],
-        values: List[dict],
-        units: List[str],
-        sampletime):
-
-    current_time = time.time()
-    #Creating metrics list
-    metrics =[
-            {
-                "name": names[i],
-                "timestamp": sampletime,
-                "dataType": data_types[i],
-                "value": values[i],
-                "unit": units[i]
-            }
-            for i in indexes]
-
-    return {
-        "timestamp": current_time,
-        "metrics": metrics
-    }
-
-previous_data = None
-# Reads the desired holding registers from the device.
-async def reading_task(modbus_client,valkey_client,address0,count,unitid,data_types,units,names,topic):
-    global previous_data
-
-    try:
-        # Read holding register
+# The maximum number of holding registers in one read request allowed by the Modbus specification
+MAX_REGISTERS_PER_READ = 125
+
+def plan_reads(addresses, max_count=MAX_REGISTERS_PER_READ):
+    # Group the addresses into ranges of contiguous registers, so that each range is read with one request.
+    # Gaps are not read across, since most devices answer a read of an unmapped register with an exception.
+    reads = []
+    for index in sorted(range(len(addresses)), key=lambda i: addresses[i]):
+        address = addresses[index]
+        if reads:
+            last_read = reads[-1]
+            end = last_read["address"] + last_read["count"]
+            if last_read["address"] <= address < end:
+                last_read["indexes"].append((index, address - last_read["address"]))
+                continue
+            if address == end and last_read["count"] < max_count:
+                last_read["count"] += 1
+                last_read["indexes"].append((index, address - last_read["address"]))
+                continue
+        reads.append({"address": address, "count": 1, "indexes": [(index, 0)]})
+    return reads
+
+async def read_registers(modbus_client, read_plan, unitid, size):
+    # Reads all ranges in the read plan and returns the values in the order of the holding registers
+    data = [None] * size
+    latency = read_seconds.labels("holding_registers")
+    for read in read_plan:
+        read_start = time.perf_counter()
         results = await modbus_client.read_holding_registers(
-            address=address0,
-            count=count,
+            address=read["address"] - 1,
+            count=read["count"],
             slave=unitid)
-        sampletime = time.time()
+        latency.observe(time.perf_counter() - read_start)
         if results.isError():
             print(f"Received exception from device ({results})")
-            modbus_client.close()
-            raise ModbusException
+            raise ModbusException(str(results))
 
-        data = results.registers
+        for index, offset in read["indexes"]:
+            data[index] = results.registers[offset]
+    return data
+
+# Reads the desired holding registers from the device and returns them to be compared with on the next poll
+async def reading_task(modbus_client,valkey_client,read_plan,unitid,serializer,size,topic,previous_data):
+    trace = tracer.start_trace("modbus_holding_registers")
+    try:
+        data = await read_registers(modbus_client, read_plan, unitid, size)
+        sampletime = time.time()
+        trace.mark("read")
 
         if previous_data is None:
-            previous_data = data.copy()
-            print("This is the printed because no previouse data")
-            indexes = range(len(names))
-            data_struct = create_datadict(indexes,names,data_types,data,units,sampletime)
+            payload = serializer.serialize(range(size),data,sampletime)
+            trace.mark("serialize")
             #Publishing data to the messagebus
-            valkey_client.publish(topic,json.dumps(data_struct))
-            print(data_struct)
-            return
+            publish(valkey_client,topic,payload)
+            trace.mark("publish")
+            trace.finish()
+            return data
 
         if data != previous_data:
-            print("These are the the values changed in the register")
             #Find changed indexes
             changed_indexes = [i for i, (previous, current) in enumerate(zip(previous_data, data))
                                if previous != current]
+            trace.mark("diff")
 
-            data_struct = create_datadict(changed_indexes,names,data_types,data,units,sampletime)
-            print(data_struct)
+            payload = serializer.serialize(changed_indexes,data,sampletime)
+            trace.mark("serialize")
             #Publishing data to the messagebus
-            valkey_client.publish(topic,json.dumps(data_struct))
-            #Changing the previous data set
-            previous_data = data.copy()
+            publish(valkey_client,topic,payload)
+            trace.mark("publish")
 
-            return
-
-        print("No new data in the registers")
+        trace.finish()
+        return data
 
     except ModbusException as exc:
         print(f"Received ModbusException({exc}) from library")
@@ -151,25 +158,26 @@ async def reading_task(modbus_client,valkey_client,address0,count,unitid,data_ty
 
 
 # Begin the polling of data from holding registers
-async def begin_HR_polling(valkey_client, device, polling, holding_registers):
+async def begin_HR_polling(valkey_client, device, polling, holding_registers, modbus_client=None):
 
-    try:
-        # Connect to modbus device
-        modbus_client = AsyncModbusTcpClient(device.ip, port=device.port)
+    if modbus_client is None:
+        try:
+            # Connect to modbus device
+            modbus_client = AsyncModbusTcpClient(device.ip, port=device.port)
 
-        if not await modbus_client.connect():
-            raise ConnectionError(f"Failed to connect to the Modbus device at {device.ip}:{device.port}.")
+            if not await modbus_client.connect():
+                raise ConnectionError(f"Failed to connect to the Modbus device at {device.ip}:{device.port}.")
 
-    except ConnectionError as e:
-        print(f"Connection error: {e} \n"
-              "Make sure that modbus devices is running")
-        sys.exit()
+        except ConnectionError as e:
+            print(f"Connection error: {e} \n"
+                  "Make sure that modbus devices is running")
+            sys.exit()
 
-    except Exception as e:
-        print(f"Could not connect to the modbus device, with the following error: {e}")
-        sys.exit()
+        except Exception as e:
+            print(f"Could not connect to the modbus device, with the following error: {e}")
+            sys.exit()
 
-    print(f"Connection to the Modbus device at {device.ip}:{device.port} was successful!")
+        print(f"Connection to the Modbus device at {device.ip}:{device.port} was successful!")
     # Create topic for publishing data
     topic = f"spBv1.0/{device.group_id}/DDATA/{device.node_id}/{device.device_id}"
 
@@ -182,26 +190,42 @@ async def begin_HR_polling(valkey_client, device, polling, holding_registers):
     data_types = [reg.data_type for reg in holding_registers]
     units = [reg.units for reg in holding_registers]
 
-    # Defining addresses to poll data from
-    count = len(addresses) # the number of addresses needed to pull
-    address0 = addresses[0]-1 # the address to begin counting from
-
-    print(f"Now polling data every {poll_timer} seconds")
+    # The metric of every register is encoded once, the polls only add the value and the timestamp
+    serializer = MetricsSerializer([("name", names),
+                                    ("timestamp", TIMESTAMP),
+                                    ("dataType", data_types),
+                                    ("value", VALUE),
+                                    ("unit", units)],
+                                   time_key="timestamp")
 
+    # Defining the requests needed to poll all addresses
+    read_plan = plan_reads(addresses)
 
+    print(f"Now polling data every {poll_timer} seconds with {len(read_plan)} requests per poll")
 
+    # The data of the previous poll, kept per device so that several devices can be polled in one process
+    previous_data = None
+    overruns = poll_overruns.labels("holding_registers")
+    loop = asyncio.get_running_loop()
+    next_poll = loop.time()
     while True:
-        task = asyncio.create_task(reading_task(modbus_client,valkey_client,
-                                                address0=address0,count=count,
-                                                unitid=device.unit_id,data_types=data_types,
-                                                units=units,names=names,topic=topic))
-
-        await asyncio.sleep(poll_timer)
-        # If the task return an exception
-        if task.exception() is not None:
+        try:
+            previous_data = await reading_task(modbus_client,valkey_client,
+                                               read_plan=read_plan,unitid=device.unit_id,
+                                               serializer=serializer,size=len(names),topic=topic,
+                                               previous_data=previous_data)
+        except Exception:
             print("There was an error inside the data polling")
             break
 
+        # Keep the polls on a fixed schedule, and skip the polls which there was no time for
+        next_poll += poll_timer
+        now = loop.time()
+        if next_poll < now:
+            overruns.inc()
+            next_poll = now
+        await asyncio.sleep(next_poll - now)
+
     print("The system is turning off")
 if __name__ == "__main__":
     # Get configuration from config file
@@ -210,6 +234,6 @@ if __name__ == "__main__":
     device, polling, holding_registers, coils = get_device_config(device_config_path)
     # Connect to valkey_client the internal message bus
     valkey_client = valkey_connection()
-
+    start_metrics_server()
 
     asyncio.run(begin_HR_polling(valkey_client, device, polling, holding_registers))
\ No newline at end of file
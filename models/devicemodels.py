@@ -22,6 +22,8 @@ class DeviceService(BaseModel):
     config: str
     tested: bool
     activated: bool
+    # The driver of the device service in the device host, e.g. S7Comm or USB_microphone
+    driver: str | None = None
 
 # For the application_services
 class ApplicationService(BaseModel):
@@ -57,18 +59,47 @@ class Metrics(BaseModel):
     value: int
     unit: str
 
+class AdaptivePolling(BaseModel):
+    # Poll faster while the values change and slower while they are static, by step per poll,
+    # between min_factor and max_factor times the interval of the rate class
+    min_factor: float = 0.25
+    max_factor: float = 4.0
+    step: float = 2.0
+
 class PollingInterval(BaseModel):
     default_interval: float
     data_interval: float | None = None
     data_trigger: float | None = None
     process_trigger: float | None = None
+    # Intervals in seconds of the rate classes the variables can be assigned to
+    rate_classes: dict[str, float] = {}
+    adaptive: AdaptivePolling | None = None
+
+class BatchConfig(BaseModel):
+    # Publish the samples in columnar batches of this many samples, encoded "packed" or "delta"
+    samples: int = 100
+    encoding: str = "packed"
+
+class BurstConfig(BaseModel):
+    # While the data trigger is set, read the data blocks back to back instead of every data_interval, and
+    # publish the samples as one batch when the trigger ends, or every max_samples samples
+    max_samples: int = 10000
+
+class ReconnectConfig(BaseModel):
+    # Reconnect to the PLC within the service, with backoff from initial_delay up to max_delay seconds between
+    # the attempts. The service exits when the PLC has not been reachable for budget seconds.
+    initial_delay: float = 0.1
+    max_delay: float = 10.0
+    budget: float = 300.0
 
 class Triggers(BaseModel):
     trigger_type: str
     node_id: str
     device_id: str
     topic: str
-    source: dict
+    # The bit which is read for the trigger, not needed when the condition only uses the variables of the data
+    source: dict = {}
+    # An expression over the source and the variables of the data, see devices/S7Comm/conditions.py
     condition: str
 #S7comm specific models
 class S7commTriggers(BaseModel):
@@ -89,19 +120,55 @@ class S7commVariables(BaseModel):
     byte_offset: int
     bit_offset: int
     units: str
+    # Rate class from PollingInterval.rate_classes, the variables without one are polled at data_interval
+    rate_class: str | None = None
 
 class DataBlock(BaseModel):
     name: str
+    # "DB" for a data block, or "I", "Q" or "M" for the inputs, outputs or memory, where db_number is not used
+    area: str = "DB"
     db_number: int
     read_size: int
     byte_offset: int
     variables: list[S7commVariables]
 
+class RingBufferTimestamp(BaseModel):
+    # Timestamp of the PLC in every slot, an integer counter of resolution seconds per tick
+    byte_offset: int
+    data_type: str = "UDINT"
+    resolution: float = 1e-6
+
+class RingBuffer(BaseModel):
+    # Circular buffer in a data block which the PLC program fills at cycle rate. The program writes a sample
+    # into slot counter % slots and then increments the counter at index_offset, a count of all samples written.
+    name: str
+    db_number: int
+    index_offset: int
+    index_type: str = "UDINT"
+    slots_offset: int
+    slots: int
+    slot_size: int
+    timestamp: RingBufferTimestamp
+    # byte_offset of the variables is counted from the start of the slot
+    variables: list[S7commVariables]
+    # Seconds between the harvests
+    interval: float = 0.1
+    # Slots which are not read as the PLC may be writing them, slots // 10 by default
+    reserve: int | None = None
+
 class S7CommDeviceServiceConfig(BaseModel):
     device: Device
     polling: PollingInterval
     triggers: list[Triggers]
     data_block: DataBlock | None = None
+    # Further data blocks and areas, read together with data_block
+    data_blocks: list[DataBlock] = []
+    batch: BatchConfig | None = None
+    # Connections to the PLC for reading the data blocks in parallel, fewer are used when the PLC refuses them
+    connections: int = 1
+    reconnect: ReconnectConfig = ReconnectConfig()
+    burst: BurstConfig | None = None
+    ring_buffers: list[RingBuffer] = []
 
 #USB microphone models
 class USBtrigger(BaseModel):
@@ -119,6 +186,10 @@ class USBDevice(BaseModel):
     units: str | None = None
     samplerate: int
     channel: int
+    # Audio source: "portaudio" for the USB device, "wav" to play the WAV file in file, "generator" for a sine
+    source: str = "portaudio"
+    file: str | None = None
+    frequency: float | None = None
 
 class USBMicrophoneDevice(BaseModel):
     device: Device
@@ -129,3 +200,7 @@ class USBMicrophoneDevice(BaseModel):
 
 
 
+# Bulk provisioning of device services
+class BulkDeviceServices(BaseModel):
+    s7_devices: list[S7CommDeviceServiceConfig] = []
+    usb_microphones: list[USBMicrophoneDevice] = []
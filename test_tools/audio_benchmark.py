@@ -0,0 +1,158 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import resource
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from valkey_standin import ValkeyStandIn
+from data_saver_standin import DataSaverStandIn
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+logger = logging.getLogger(__name__)
+
+# Benchmark of the USB microphone pipeline: capture, WAV encoding and upload to the data saver. For every
+# combination of sample rate and channel count the service runs in a separate process with a synthetic audio
+# source, so that its CPU time and memory high-water mark can be measured. The data trigger is switched by the
+# benchmark to record segments of a fixed length.
+
+repository_dir = Path(__file__).resolve().parent.parent
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return round(1000 * sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))], 3)
+
+def timed(function, durations):
+    # Wraps the function, so that the duration of every call is appended to durations
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            durations.append(time.perf_counter() - start)
+    return wrapper
+
+def run_service(connection, args, samplerate, channels, valkey_port, saver_port):
+    # Runs in the child process
+    sys.path.insert(0, str(repository_dir))
+    sys.path.insert(0, str(repository_dir.joinpath("devices/USB")))
+    import valkey
+    import USB_microphone_service
+    from models.devicemodels import USBMicrophoneDevice
+
+    logging.getLogger().setLevel(logging.WARNING)
+    device_id = "benchmark_microphone"
+    device_config = USBMicrophoneDevice.model_validate({
+        "device": {"group_id": "benchmark", "node_id": "benchmark_node", "device_id": device_id,
+                   "protocol_type": "USB"},
+        "triggers": [{"trigger_type": "data_trigger", "node_id": "benchmark_node", "device_id": device_id,
+                      "topic": "", "source": {"topic": "benchmark_trigger"}, "condition": "True"}],
+        "USB_device": {"name": "benchmark", "data_type": "wav", "samplerate": samplerate, "channel": channels,
+                       "source": "wav" if args.wav else "generator", "file": args.wav},
+    })
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        reader = USB_microphone_service.PLCReader(device_config, valkey.Valkey(host="127.0.0.1", port=valkey_port),
+                                                  backend_ip="127.0.0.1", backend_port=saver_port,
+                                                  data_dir=Path(data_dir))
+        encode_times, upload_times = [], []
+        reader.encode_audio = timed(reader.encode_audio, encode_times)
+        reader.upload_audio = timed(reader.upload_audio, upload_times)
+        threading.Thread(target=reader.sample_microphone_data, daemon=True).start()
+
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        for _ in range(args.segments):
+            reader.trigger_event.set()
+            time.sleep(args.segment)
+            reader.trigger_event.clear()
+            time.sleep(args.pause)
+        # Wait for the last segment to be uploaded
+        deadline = time.perf_counter() + 30
+        while len(upload_times) < args.segments and time.perf_counter() < deadline:
+            time.sleep(0.01)
+        wall_time, cpu_time = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        saved_locally = len(list(Path(data_dir).rglob("*_" + device_id)))
+
+    encode_times.sort()
+    upload_times.sort()
+    connection.send({
+        "samplerate": samplerate,
+        "channels": channels,
+        "segments": args.segments,
+        "segment_s": args.segment,
+        "uploads": len(upload_times),
+        "saved_locally": saved_locally,
+        "overruns": reader.overruns,
+        "encode_p50_ms": percentile(encode_times, 0.50),
+        "upload_p50_ms": percentile(upload_times, 0.50),
+        "upload_p99_ms": percentile(upload_times, 0.99),
+        "upload_s": sum(upload_times),
+        "cpu_percent": round(100 * cpu_time / wall_time, 1),
+        "cpu_s_per_audio_s": round(cpu_time / (args.segments * args.segment), 4),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    })
+
+def run_step(args, samplerate, channels, valkey_port, data_saver):
+    uploads_before, bytes_before = data_saver.uploads, data_saver.bytes
+    connection, child_connection = multiprocessing.Pipe()
+    service = multiprocessing.get_context("spawn").Process(target=run_service,
+                                                           args=(child_connection, args, samplerate, channels,
+                                                                 valkey_port, data_saver.port),
+                                                           daemon=True)
+    service.start()
+    result = connection.recv()
+    service.join(5)
+
+    uploaded_bytes = data_saver.bytes - bytes_before
+    result["received_uploads"] = data_saver.uploads - uploads_before
+    result["uploaded_mb"] = round(uploaded_bytes / 2**20, 2)
+    # Throughput while uploading, based on the time spent in the uploads
+    upload_time = result.pop("upload_s")
+    result["upload_mb_per_s"] = round(uploaded_bytes / 2**20 / upload_time, 1) if upload_time else None
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of capture, encoding and upload in the USB microphone service")
+    parser.add_argument("--samplerates", default="16000,44100,48000", help="Comma separated sample rates in Hz")
+    parser.add_argument("--channels", default="1,2", help="Comma separated channel counts")
+    parser.add_argument("--segments", type=int, default=5, help="Number of recordings per step")
+    parser.add_argument("--segment", type=float, default=2, help="Seconds the data trigger is on per recording")
+    parser.add_argument("--pause", type=float, default=0.5, help="Seconds the data trigger is off between recordings")
+    parser.add_argument("--wav", help="Play this WAV file instead of using the signal generator")
+    parser.add_argument("--saver-delay-ms", type=float, default=0.0, help="Response delay of the data saver stand-in")
+    parser.add_argument("--json", help="Write the results to this file as JSON")
+    args = parser.parse_args()
+
+    valkey_standin = ValkeyStandIn().start()
+    data_saver = DataSaverStandIn(delay=args.saver_delay_ms / 1000).start()
+
+    results = []
+    for samplerate in [int(samplerate) for samplerate in args.samplerates.split(",")]:
+        for channels in [int(channels) for channels in args.channels.split(",")]:
+            logger.info(f"Recording {args.segments} segments of {args.segment}s at {samplerate} Hz with {channels} channels")
+            result = run_step(args, samplerate, channels, valkey_standin.port, data_saver)
+            logger.info(json.dumps(result))
+            results.append(result)
+
+    data_saver.stop()
+    valkey_standin.stop()
+
+    columns = ["samplerate", "channels", "uploads", "overruns", "encode_p50_ms", "upload_p50_ms",
+               "upload_mb_per_s", "cpu_percent", "max_rss_mb"]
+    print(" | ".join(columns))
+    for result in results:
+        print(" | ".join(str(result[column]) for column in columns))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
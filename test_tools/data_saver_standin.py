@@ -0,0 +1,91 @@
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+logger = logging.getLogger(__name__)
+
+# Stand-in for the data saver in the backend. It accepts the audio uploads of the USB microphone service,
+# counts them and throws the files away. A delay can be added to every response to emulate a slow backend.
+
+UPLOAD_PATH = "/api/data_saver/upload_audio"
+
+class DataSaverHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        remaining = length
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, 65536))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+
+        if self.path != UPLOAD_PATH:
+            self.send_error(404)
+            return
+
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        self.server.record_upload(length)
+        body = json.dumps({"status": "saved"}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class DataSaverStandIn(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, delay=0.0):
+        super().__init__((host, port), DataSaverHandler)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.uploads = 0
+        self.bytes = 0
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def record_upload(self, length):
+        with self.lock:
+            self.uploads += 1
+            self.bytes += length
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info(f"Data saver stand-in listening on {self.server_address[0]}:{self.port}")
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the data saver stand-in")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--delay-ms", type=float, default=0.0, help="Delay of every response")
+    args = parser.parse_args()
+
+    server = DataSaverStandIn(args.host, args.port, args.delay_ms / 1000).start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,196 @@
+import argparse
+import asyncio
+import importlib.util
+import json
+import logging
+import multiprocessing
+import sys
+import time
+from pathlib import Path
+
+repository_dir = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(repository_dir))
+
+import valkey
+from pymodbus.client import AsyncModbusTcpClient
+from models.devicemodels import ModbusDeviceServiceConfig
+from modbus_simulator import register_map
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+logger = logging.getLogger(__name__)
+logging.getLogger("pymodbus").setLevel(logging.CRITICAL)
+
+# Scaling benchmark of the Modbus service. For every combination of device and tag count, a farm of simulated
+# slaves and the Valkey stand-in are started in a separate process, and one poller of the Modbus service per
+# device runs in this process, as the pollers of several devices would share a gateway.
+
+def load_modbus_service():
+    # The Modbus service is a script, so it is loaded from its file instead of being imported as a package
+    path = repository_dir.joinpath("devices/modbus_tcp/modbus_tcp_servicev2.py")
+    spec = importlib.util.spec_from_file_location("modbus_tcp_servicev2", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def run_environment(connection, args, devices, addresses):
+    # Runs in the child process
+    from modbus_simulator import ModbusSlaveFarm
+    from valkey_standin import ValkeyStandIn
+
+    logging.getLogger().setLevel(logging.WARNING)
+    # Responses still being delayed when the pollers disconnect are logged as errors by pymodbus
+    logging.getLogger("pymodbus").setLevel(logging.CRITICAL)
+
+    async def serve():
+        farm = ModbusSlaveFarm(devices, addresses, args.base_port, delay=args.delay_ms / 1000,
+                               jitter=args.jitter_ms / 1000, change_fraction=args.change_fraction)
+        await farm.start()
+        valkey_standin = ValkeyStandIn().start()
+        connection.send(valkey_standin.port)
+        await asyncio.get_running_loop().run_in_executor(None, connection.recv)
+        connection.send(farm.requests)
+        await farm.stop()
+        valkey_standin.stop()
+
+    asyncio.run(serve())
+
+class InstrumentedClient(AsyncModbusTcpClient):
+    """Records the start time and duration of every read of holding registers"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reads = []
+
+    async def read_holding_registers(self, address, *, count=1, slave=1, no_response_expected=False):
+        read_start = time.perf_counter()
+        result = await super().read_holding_registers(address, count=count, slave=slave,
+                                                      no_response_expected=no_response_expected)
+        self.reads.append((read_start, time.perf_counter() - read_start))
+        return result
+
+def device_config(args, index, addresses):
+    return ModbusDeviceServiceConfig.model_validate({
+        "device": {"group_id": "benchmark", "node_id": "benchmark_node", "device_id": f"modbus_{index}",
+                   "protocol_type": "modbus_tcp", "ip": "127.0.0.1", "port": args.base_port + index,
+                   "unit_id": 1},
+        "polling": {"default_coil_interval": args.interval, "default_register_interval": args.interval},
+        "holding_registers": [{"name": f"register_{address}", "address": address, "data_type": "INT",
+                               "units": "bar"} for address in addresses],
+    })
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return round(1000 * sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))], 3)
+
+async def run_pollers(args, modbus_service, configs, valkey_port):
+    valkey_client = valkey.Valkey(host="127.0.0.1", port=valkey_port)
+    clients = []
+    for config in configs:
+        client = InstrumentedClient(config.device.ip, port=config.device.port)
+        if not await client.connect():
+            raise ConnectionError(f"Failed to connect to the simulated slave on port {config.device.port}")
+        clients.append(client)
+
+    tasks = [asyncio.create_task(modbus_service.begin_HR_polling(valkey_client, config.device, config.polling,
+                                                                 config.holding_registers, modbus_client=client))
+             for config, client in zip(configs, clients)]
+    await asyncio.sleep(args.warmup)
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    await asyncio.sleep(args.duration)
+    wall_end, cpu_time = time.perf_counter(), time.process_time() - cpu_start
+
+    failed = sum(task.done() for task in tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for client in clients:
+        client.close()
+    valkey_client.close()
+    return clients, failed, wall_start, wall_end, cpu_time
+
+def run_step(args, modbus_service, devices, tags):
+    addresses = register_map(tags, args.sparsity, seed=args.seed)
+    configs = [device_config(args, index, addresses) for index in range(devices)]
+    requests_per_cycle = len(modbus_service.plan_reads(addresses))
+
+    connection, child_connection = multiprocessing.Pipe()
+    environment = multiprocessing.get_context("spawn").Process(target=run_environment,
+                                                               args=(child_connection, args, devices, addresses),
+                                                               daemon=True)
+    environment.start()
+    valkey_port = connection.recv()
+    try:
+        clients, failed, wall_start, wall_end, cpu_time = asyncio.run(
+            run_pollers(args, modbus_service, configs, valkey_port))
+    finally:
+        connection.send("stop")
+        served_requests = connection.recv() if connection.poll(5) else None
+        environment.join(5)
+
+    wall_time = wall_end - wall_start
+    read_times, cycle_times, cycles = [], [], 0
+    for client in clients:
+        reads = [read for read in client.reads if wall_start <= read[0] < wall_end]
+        read_times.extend(duration for _, duration in reads)
+        # The requests of a poll are sent one after the other, so every requests_per_cycle reads are one poll
+        for index in range(0, len(reads) - requests_per_cycle + 1, requests_per_cycle):
+            first, last = reads[index], reads[index + requests_per_cycle - 1]
+            cycle_times.append(last[0] + last[1] - first[0])
+            cycles += 1
+    read_times.sort()
+    cycle_times.sort()
+    return {
+        "devices": devices,
+        "tags": tags,
+        "requests_per_cycle": requests_per_cycle,
+        "target_polls_per_s": round(devices / args.interval, 1),
+        "polls_per_s": round(cycles / wall_time, 1),
+        "requests_per_s": round(len(read_times) / wall_time, 1),
+        "served_requests": served_requests,
+        "read_p50_ms": percentile(read_times, 0.50),
+        "read_p99_ms": percentile(read_times, 0.99),
+        "poll_p50_ms": percentile(cycle_times, 0.50),
+        "poll_p99_ms": percentile(cycle_times, 0.99),
+        "failed_pollers": failed,
+        "cpu_percent": round(100 * cpu_time / wall_time, 1),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scaling benchmark of the Modbus service against simulated slaves")
+    parser.add_argument("--devices", default="1,10,100", help="Comma separated device counts, one step per count")
+    parser.add_argument("--tags", default="20,200", help="Comma separated holding register counts per device")
+    parser.add_argument("--sparsity", type=float, default=0.5, help="Probability of a gap after each run of registers")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--interval", type=float, default=0.1, help="default_register_interval in seconds")
+    parser.add_argument("--delay-ms", type=float, default=1.0, help="Response delay of the slaves")
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--change-fraction", type=float, default=0.1, help="Fraction of the registers changed per update")
+    parser.add_argument("--base-port", type=int, default=15020)
+    parser.add_argument("--warmup", type=float, default=1)
+    parser.add_argument("--duration", type=float, default=10, help="Seconds per step")
+    parser.add_argument("--json", help="Write the results to this file as JSON")
+    args = parser.parse_args()
+
+    modbus_service = load_modbus_service()
+    results = []
+    for devices in [int(devices) for devices in args.devices.split(",")]:
+        for tags in [int(tags) for tags in args.tags.split(",")]:
+            logger.info(f"Polling {devices} devices with {tags} holding registers each for {args.duration}s")
+            result = run_step(args, modbus_service, devices, tags)
+            logger.info(json.dumps(result))
+            results.append(result)
+
+    columns = ["devices", "tags", "requests_per_cycle", "target_polls_per_s", "polls_per_s",
+               "poll_p50_ms", "poll_p99_ms", "read_p99_ms", "cpu_percent"]
+    print(" | ".join(columns))
+    for result in results:
+        print(" | ".join(str(result[column]) for column in columns))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,129 @@
+import argparse
+import asyncio
+import logging
+import random
+import sys
+
+from pymodbus.datastore import ModbusSlaveContext, ModbusServerContext, ModbusSparseDataBlock
+from pymodbus.server import ModbusTcpServer
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+logger = logging.getLogger(__name__)
+logging.getLogger("pymodbus").setLevel(logging.WARNING)
+
+# Farm of simulated Modbus TCP slaves for scaling tests of the Modbus service. Every slave listens on its own
+# port, has a sparse holding register map with changing values and answers after a configurable delay.
+
+def register_map(tags, sparsity=0.5, max_run=10, max_gap=20, seed=None):
+    # 1-based holding register addresses as used in the device configs, in runs of contiguous registers.
+    # With a sparsity of 0 all registers are contiguous, with 1 every run is followed by a gap.
+    generator = random.Random(seed)
+    addresses = []
+    address = 1
+    while len(addresses) < tags:
+        run = min(generator.randint(1, max_run), tags - len(addresses))
+        addresses.extend(range(address, address + run))
+        address += run
+        if generator.random() < sparsity:
+            address += generator.randint(1, max_gap)
+    return addresses
+
+class DelayedSlaveContext(ModbusSlaveContext):
+    """Slave context answering every request after delay plus up to jitter seconds"""
+    def __init__(self, delay=0.0, jitter=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.delay = delay
+        self.jitter = jitter
+        self.requests = 0
+
+    async def async_getValues(self, fc_as_hex, address, count=1):
+        self.requests += 1
+        delay = self.delay + random.uniform(0, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return self.getValues(fc_as_hex, address, count)
+
+class ModbusSlaveFarm:
+    def __init__(self, devices, addresses, base_port=15020, host="127.0.0.1", unit_id=1,
+                 delay=0.0, jitter=0.0, update_interval=0.1, change_fraction=0.1):
+        self.host = host
+        self.base_port = base_port
+        self.unit_id = unit_id
+        self.addresses = addresses
+        self.update_interval = update_interval
+        self.change_fraction = change_fraction
+        self.slaves = []
+        self.servers = []
+        self.tasks = []
+        for _ in range(devices):
+            block = ModbusSparseDataBlock({address: random.randint(0, 65535) for address in addresses})
+            self.slaves.append(DelayedSlaveContext(delay, jitter, hr=block))
+
+    @property
+    def ports(self):
+        return [self.base_port + index for index in range(len(self.slaves))]
+
+    @property
+    def requests(self):
+        return sum(slave.requests for slave in self.slaves)
+
+    async def update_values(self):
+        # Change a fraction of the registers of every slave on each update
+        changes = max(1, int(len(self.addresses) * self.change_fraction))
+        while True:
+            for slave in self.slaves:
+                for address in random.sample(self.addresses, changes):
+                    slave.store["h"].setValues(address, [random.randint(0, 65535)])
+            await asyncio.sleep(self.update_interval)
+
+    async def start(self):
+        for slave, port in zip(self.slaves, self.ports):
+            server = ModbusTcpServer(ModbusServerContext(slaves={self.unit_id: slave}, single=False),
+                                     address=(self.host, port))
+            await server.serve_forever(background=True)
+            self.servers.append(server)
+        self.tasks.append(asyncio.create_task(self.update_values()))
+        logger.info(f"{len(self.slaves)} Modbus slaves with {len(self.addresses)} holding registers each "
+                    f"listening on ports {self.ports[0]}-{self.ports[-1]}")
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        for server in self.servers:
+            await server.shutdown()
+
+async def run_farm(args):
+    addresses = register_map(args.tags, args.sparsity, seed=args.seed)
+    farm = ModbusSlaveFarm(args.devices, addresses, args.base_port, args.host, args.unit_id,
+                           args.delay_ms / 1000, args.jitter_ms / 1000, args.update_interval, args.change_fraction)
+    await farm.start()
+    logger.info(f"Holding register addresses: {addresses}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await farm.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a farm of simulated Modbus TCP slaves")
+    parser.add_argument("--devices", type=int, default=10, help="Number of slaves, each on its own port")
+    parser.add_argument("--tags", type=int, default=50, help="Number of holding registers per slave")
+    parser.add_argument("--sparsity", type=float, default=0.5, help="Probability of a gap after each run of registers")
+    parser.add_argument("--seed", type=int, help="Seed of the register map, so that it can be reproduced")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--base-port", type=int, default=15020)
+    parser.add_argument("--unit-id", type=int, default=1)
+    parser.add_argument("--delay-ms", type=float, default=0.0, help="Response delay of the slaves")
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--update-interval", type=float, default=0.1, help="Seconds between value changes")
+    parser.add_argument("--change-fraction", type=float, default=0.1, help="Fraction of the registers changed per update")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(run_farm(args))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,181 @@
+import socket
+import socketserver
+import threading
+import argparse
+import logging
+import struct
+import sys
+import time
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+logger = logging.getLogger(__name__)
+
+# In-process stand-in for the MQTT broker in the backend. It implements the part of MQTT 3.1.1 used by the
+# MQTT publisher: CONNECT, PUBLISH with QoS 0 and 1, SUBSCRIBE, UNSUBSCRIBE, PINGREQ and DISCONNECT.
+# Everything is delivered to subscribers with QoS 0.
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+def packet(packet_type, body, flags=0):
+    return bytes([packet_type << 4 | flags]) + encode_length(len(body)) + body
+
+def read_string(data, offset):
+    length = struct.unpack_from("!H", data, offset)[0]
+    return data[offset + 2:offset + 2 + length], offset + 2 + length
+
+def topic_matches(topic_filter, topic):
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for index, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[index]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+class MQTTHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rfile = self.request.makefile("rb")
+        self.write_lock = threading.Lock()
+        # Replaced instead of changed, so that publishing threads can read them without a lock
+        self.subscriptions = frozenset()
+
+    def send(self, data):
+        with self.write_lock:
+            self.request.sendall(data)
+
+    def read_packet(self):
+        header = self.rfile.read(1)
+        if not header:
+            return None, None, None
+        length, multiplier = 0, 1
+        while True:
+            byte = self.rfile.read(1)[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header[0] >> 4, header[0] & 0x0F, self.rfile.read(length)
+
+    def handle(self):
+        self.server.add_client(self)
+        try:
+            while True:
+                packet_type, flags, body = self.read_packet()
+                if packet_type is None or packet_type == DISCONNECT:
+                    break
+                self.execute(packet_type, flags, body)
+        except (ConnectionError, OSError, IndexError):
+            pass
+        finally:
+            self.server.remove_client(self)
+
+    def execute(self, packet_type, flags, body):
+        if packet_type == CONNECT:
+            self.send(packet(CONNACK, b"\x00\x00"))
+        elif packet_type == PUBLISH:
+            qos = (flags >> 1) & 0x03
+            topic, offset = read_string(body, 0)
+            if qos:
+                packet_id = body[offset:offset + 2]
+                offset += 2
+                self.send(packet(PUBACK, packet_id))
+            self.server.publish(topic.decode("utf-8"), body[offset:])
+        elif packet_type == SUBSCRIBE:
+            packet_id, offset, granted = body[:2], 2, bytearray()
+            topic_filters = set()
+            while offset < len(body):
+                topic_filter, offset = read_string(body, offset)
+                offset += 1  # Requested QoS
+                topic_filters.add(topic_filter.decode("utf-8"))
+                granted.append(0)
+            self.subscriptions = self.subscriptions | topic_filters
+            self.send(packet(SUBACK, packet_id + bytes(granted)))
+        elif packet_type == UNSUBSCRIBE:
+            packet_id, offset = body[:2], 2
+            topic_filters = set()
+            while offset < len(body):
+                topic_filter, offset = read_string(body, offset)
+                topic_filters.add(topic_filter.decode("utf-8"))
+            self.subscriptions = self.subscriptions - topic_filters
+            self.send(packet(UNSUBACK, packet_id))
+        elif packet_type == PINGREQ:
+            self.send(packet(PINGRESP, b""))
+
+class MQTTStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0):
+        super().__init__((host, port), MQTTHandler)
+        self.lock = threading.Lock()
+        self.clients = set()
+        self.received = 0
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def add_client(self, client):
+        with self.lock:
+            self.clients.add(client)
+
+    def remove_client(self, client):
+        with self.lock:
+            self.clients.discard(client)
+
+    def publish(self, topic, payload):
+        with self.lock:
+            self.received += 1
+            clients = list(self.clients)
+        encoded_topic = topic.encode("utf-8")
+        message = packet(PUBLISH, struct.pack("!H", len(encoded_topic)) + encoded_topic + payload)
+        for client in clients:
+            if any(topic_matches(topic_filter, topic) for topic_filter in client.subscriptions):
+                try:
+                    client.send(message)
+                except OSError:
+                    self.remove_client(client)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info(f"MQTT broker stand-in listening on {self.server_address[0]}:{self.port}")
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the MQTT broker stand-in as a local broker")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1883)
+    args = parser.parse_args()
+
+    server = MQTTStandIn(args.host, args.port).start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,382 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+repository_dir = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(repository_dir))
+sys.path.insert(0, str(repository_dir.joinpath("devices/S7Comm")))
+
+import valkey
+import yaml
+import S7Comm_service
+from connection_pool import open_connections
+from snap7.type import Areas
+from models.devicemodels import S7CommDeviceServiceConfig
+from common.metrics import bus_published_bytes
+from ring_buffer import ring_buffer_lost_samples
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+logger = logging.getLogger(__name__)
+
+# Benchmark of PLCReader against the simulated S7 PLC. The simulator and the Valkey stand-in run in a
+# separate process, so that the CPU time measured here is the CPU time of the S7Comm service alone.
+
+DATA_DB = 1
+TRIGGER_DB = 2
+RING_DB = 100
+
+def run_environment(connection, args):
+    # Runs in the child process
+    from s7_simulator import SimulatedS7PLC
+    from valkey_standin import ValkeyStandIn
+
+    logging.getLogger().setLevel(logging.WARNING)
+    layout = variable_layout(args)
+    block_sizes = {}
+    for db_number, byte_offset in layout:
+        block_sizes[db_number] = max(block_sizes.get(db_number, 0), byte_offset + 4)
+    plc = SimulatedS7PLC(args.port, {**block_sizes, TRIGGER_DB: 2},
+                         latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000, loss=args.loss,
+                         max_connections=args.max_connections)
+    # The last variables are static
+    changing_variables = args.variables - int(args.static_fraction * args.variables)
+    for index, (db_number, byte_offset) in enumerate(layout[:changing_variables]):
+        plc.add_real_signal(db_number, byte_offset, period=1 + index / 10)
+    # Process bit M2.6 and data trigger bit DB2.0.0
+    plc.add_bit_pattern("MK", 0, 2, 6)
+    plc.add_bit_pattern("DB", TRIGGER_DB, 0, 0, args.stroke_on, args.stroke_off)
+    if args.ring_rate:
+        plc.add_ring_buffer(RING_DB, 0, 4, args.ring_slots, args.ring_rate, args.ring_channels)
+    plc.start()
+    valkey_standin = ValkeyStandIn().start()
+    connection.send(valkey_standin.port)
+
+    while True:
+        command, value = connection.recv()
+        if command == "disconnect":
+            plc.proxy.disconnect(value)
+        elif command == "stop":
+            break
+    plc.stop()
+    valkey_standin.stop()
+
+def data_db_numbers(args):
+    # DATA_DB and further data blocks after the trigger block
+    return [DATA_DB] + [TRIGGER_DB + block for block in range(1, args.blocks)]
+
+def variable_layout(args):
+    # The data block and byte offset of every variable. The variables are spread over the blocks in turn, and
+    # are spacing bytes apart within a block.
+    db_numbers = data_db_numbers(args)
+    return [(db_numbers[index % len(db_numbers)], args.spacing * (index // len(db_numbers)))
+            for index in range(args.variables)]
+
+def device_config(args):
+    # The first variables are in the slow rate class
+    slow_variables = int(args.slow_fraction * args.variables)
+    layout = variable_layout(args)
+    device = {"group_id": "benchmark", "node_id": "benchmark_node", "device_id": "simulated_plc",
+              "protocol_type": "S7Comm", "ip": "127.0.0.1", "port": args.port, "rack": 0, "slot": 1}
+    return S7CommDeviceServiceConfig.model_validate({
+        "device": device,
+        "polling": {"default_interval": args.interval, "data_interval": args.interval,
+                    "data_trigger": 0.05, "process_trigger": 0.1,
+                    "rate_classes": {"slow": args.slow_interval},
+                    "adaptive": {} if args.adaptive else None},
+        "triggers": [
+            {"trigger_type": "process_trigger", "node_id": device["node_id"], "device_id": device["device_id"],
+             "topic": "", "condition": "True",
+             "source": {"variable_type": "Memory bit", "db_number": 0, "byte_offset": 2, "bit_offset": 6,
+                        "bool_index": 6}},
+            {"trigger_type": "data_trigger", "node_id": device["node_id"], "device_id": device["device_id"],
+             "topic": "", "condition": args.trigger_condition,
+             "source": {"db_number": TRIGGER_DB, "byte_offset": 0, "bit_offset": 0}},
+        ],
+        "data_blocks": [{"name": f"benchmark_{db_number}", "db_number": db_number, "read_size": 0, "byte_offset": 0,
+                         "variables": [{"name": f"variable_{index}", "data_type": "REAL",
+                                        "byte_offset": byte_offset, "bit_offset": 0, "units": "bar",
+                                        "rate_class": "slow" if index < slow_variables else None}
+                                       for index, (variable_db, byte_offset) in enumerate(layout)
+                                       if variable_db == db_number]}
+                        for db_number in data_db_numbers(args)],
+        "batch": {"samples": args.batch, "encoding": args.batch_encoding} if args.batch else None,
+        "connections": args.connections,
+        "reconnect": {"budget": args.reconnect_budget},
+        "burst": {"max_samples": args.burst} if args.burst else None,
+        "ring_buffers": [{"name": "vibration", "db_number": RING_DB, "index_offset": 0, "slots_offset": 4,
+                          "slots": args.ring_slots, "slot_size": 4 + 4 * args.ring_channels,
+                          "timestamp": {"byte_offset": 0, "data_type": "UDINT", "resolution": 1e-6},
+                          "variables": [{"name": f"vibration_{channel}", "data_type": "REAL",
+                                         "byte_offset": 4 + 4 * channel, "bit_offset": 0, "units": "g"}
+                                        for channel in range(args.ring_channels)],
+                          "interval": args.ring_interval}] if args.ring_rate else [],
+    })
+
+class InstrumentedClient:
+    """Wraps the snap7 client and records the start time, duration and size of every read request of the data,
+    and of the ring buffer separately. The clients of further connections record into the reads of the first one."""
+    def __init__(self, client, first=None):
+        self.client = client
+        self.lock = threading.Lock() if first is None else first.lock
+        self.reads = [] if first is None else first.reads
+        self.ring_reads = [] if first is None else first.ring_reads
+        # Start times of the polls of the fastest rate class
+        self.polls = []
+        # (harvest time, sample timestamps) of the harvests of the ring buffer
+        self.harvests = []
+        # (publish time, samples, duration) of the published bursts
+        self.bursts = []
+
+    def record(self, read_start, size, db_number):
+        with self.lock:
+            (self.ring_reads if db_number == RING_DB else self.reads).append(
+                (read_start, time.perf_counter() - read_start, size))
+
+    def read_area(self, area, db_number, start, size):
+        read_start = time.perf_counter()
+        data = self.client.read_area(area, db_number, start, size)
+        if area == Areas.DB and db_number != TRIGGER_DB:
+            self.record(read_start, size, db_number)
+        return data
+
+    def read_multi_vars(self, items):
+        read_start = time.perf_counter()
+        result = self.client.read_multi_vars(items)
+        self.record(read_start, sum(item.Amount for item in items), items[0].DBNumber)
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def reads_between(self, start, end):
+        with self.lock:
+            return [read for read in self.reads if start <= read[0] < end]
+
+def start_reader(config, valkey_client, config_path=None):
+    client = InstrumentedClient(S7Comm_service.connect_to_plc(config, retries=100, delay=0.1))
+    extra_clients = [InstrumentedClient(extra_client, client)
+                     for extra_client in open_connections(config, config.connections - 1)]
+    reader = S7Comm_service.PLCReader(config, client, valkey_client, extra_clients, config_path)
+    # Every poll of the fastest rate class starts with its first request
+    first_request = reader.read_groups[0].requests[0]
+    read = first_request.read
+    def read_and_record(plc_client):
+        client.polls.append(time.perf_counter())
+        return read(plc_client)
+    first_request.read = read_and_record
+    for harvester in reader.harvesters:
+        harvest = harvester.harvest
+        def harvest_and_record(plc_client, harvest=harvest):
+            samples = harvest(plc_client)
+            if samples is not None:
+                client.harvests.append((time.time(), time.perf_counter(), samples[0]))
+            return samples
+        harvester.harvest = harvest_and_record
+    publish_burst = reader.publish_burst
+    def publish_and_record(encoder, capture):
+        client.bursts.append((time.perf_counter(), capture.count,
+                              capture.timestamps[capture.count - 1] - capture.timestamps[0]))
+        publish_burst(encoder, capture)
+    reader.publish_burst = publish_and_record
+    threading.Thread(target=reader.start_sampling, daemon=True).start()
+    return reader, client
+
+def published_bytes():
+    return sum(child.value for child in list(bus_published_bytes.children.values()))
+
+def milliseconds(value):
+    return round(value * 1000, 3) if value is not None else None
+
+def measure_ring_buffer(harvests, ring_reads, duration):
+    # Samples per second, their spacing in the PLC timestamps and the lag of the newest sample at its harvest
+    timestamps = [timestamp for _, _, harvest_timestamps in harvests for timestamp in harvest_timestamps]
+    spacings = [later - earlier for earlier, later in zip(timestamps, timestamps[1:])]
+    lags = [harvest_time - harvest_timestamps[-1] for harvest_time, _, harvest_timestamps in harvests]
+    return {
+        "ring_samples_per_s": round(len(timestamps) / duration, 1),
+        "ring_requests_per_s": round(len(ring_reads) / duration, 1),
+        "ring_read_kb_per_s": round(sum(read[2] for read in ring_reads) / duration / 1024, 1),
+        "ring_lost_samples": int(sum(child.value for child in list(ring_buffer_lost_samples.children.values()))),
+        "ring_spacing_mean_ms": milliseconds(statistics.fmean(spacings)) if spacings else None,
+        "ring_spacing_max_ms": milliseconds(max(spacings)) if spacings else None,
+        "ring_harvest_lag_ms": milliseconds(statistics.fmean(lags)) if lags else None,
+    }
+
+def measure_bursts(bursts):
+    # Samples per burst and the sample rate within the bursts
+    samples = sum(count for _, count, _ in bursts)
+    duration = sum(burst_duration for _, _, burst_duration in bursts)
+    return {
+        "bursts": len(bursts),
+        "burst_samples_mean": round(samples / len(bursts), 1) if bursts else None,
+        "burst_rate_hz": round((samples - len(bursts)) / duration, 1) if duration else None,
+    }
+
+def measure(args, reader, client):
+    wall_start, cpu_start, bytes_start = time.perf_counter(), time.process_time(), published_bytes()
+    time.sleep(args.duration)
+    wall_end, cpu_time = time.perf_counter(), time.process_time() - cpu_start
+    bytes_per_s = (published_bytes() - bytes_start) / (wall_end - wall_start)
+    harvests = [harvest for harvest in client.harvests if wall_start <= harvest[1] < wall_end]
+    ring_reads = [read for read in client.ring_reads if wall_start <= read[0] < wall_end]
+    bursts = [burst for burst in client.bursts if wall_start <= burst[0] < wall_end]
+
+    reads = client.reads_between(wall_start, wall_end)
+    polls = [poll for poll in client.polls if wall_start <= poll < wall_end]
+    intervals = [later - earlier for earlier, later in zip(polls, polls[1:])]
+    durations = sorted(read[1] for read in reads)
+    return {
+        "variables": args.variables,
+        "blocks": args.blocks,
+        "connections": len(reader.connection_pool),
+        "target_interval_ms": milliseconds(args.interval),
+        "reads": len(reads),
+        "requests_per_poll": round(len(reads) / len(polls), 2) if polls else None,
+        "sample_rate_hz": round(len(polls) / (wall_end - wall_start), 1),
+        "interval_mean_ms": milliseconds(statistics.fmean(intervals)) if intervals else None,
+        "jitter_stdev_ms": milliseconds(statistics.pstdev(intervals)) if intervals else None,
+        "interval_p99_ms": milliseconds(sorted(intervals)[int(0.99 * (len(intervals) - 1))]) if intervals else None,
+        "read_p50_ms": milliseconds(durations[len(durations) // 2]) if durations else None,
+        "read_p99_ms": milliseconds(durations[int(0.99 * (len(durations) - 1))]) if durations else None,
+        "read_kb_per_s": round(sum(read[2] for read in reads) / (wall_end - wall_start) / 1024, 1),
+        "published_kb_per_s": round(bytes_per_s / 1024, 1),
+        "cpu_percent": round(100 * cpu_time / (wall_end - wall_start), 1),
+        **(measure_ring_buffer(harvests, ring_reads, wall_end - wall_start) if args.ring_rate else {}),
+        **(measure_bursts(bursts) if args.burst else {}),
+    }
+
+def write_config(config, config_path):
+    with open(config_path, "w") as f:
+        yaml.safe_dump(config.model_dump(), f)
+
+def measure_reload(args, config, config_path, reader, client):
+    # Halve data_interval in the config file, and measure the time until the reader runs with it and the longest
+    # gap between the reads of the data around the reload
+    reloaded = config.model_copy(update={"polling": config.polling.model_copy(
+        update={"data_interval": args.interval / 2})})
+    reconnects = reader.reconnector.reconnects.value
+    change_time = time.perf_counter()
+    write_config(reloaded, config_path)
+    while reader.device_config != reloaded and time.perf_counter() < change_time + 10:
+        time.sleep(0.005)
+    reload_time = time.perf_counter() - change_time
+    time.sleep(1)
+    read_starts = [read[0] for read in client.reads_between(change_time - 1, time.perf_counter())]
+    gaps = [later - earlier for earlier, later in zip(read_starts, read_starts[1:])]
+    return {
+        "reload_s": round(reload_time, 3) if reader.device_config == reloaded else None,
+        "reload_max_gap_ms": milliseconds(max(gaps)) if gaps else None,
+        "reload_reconnects": int(reader.reconnector.reconnects.value - reconnects),
+    }
+
+def measure_reconnect(args, connection, config, valkey_client, reader, client):
+    # Drop the connection to the PLC and measure the time until the data block is read again, and whether the
+    # reader reconnected by itself or the service had to be restarted
+    fault_time = time.perf_counter()
+    connection.send(("disconnect", args.outage))
+    deadline = fault_time + args.reconnect_timeout
+    restarted = False
+    while time.perf_counter() < deadline:
+        if client.reads_between(fault_time, float("inf")):
+            return time.perf_counter() - fault_time, restarted, reader, client
+        if reader.stop_event.is_set():
+            # The service has exited, which is followed by a restart of the container
+            logger.info("The reader has stopped, starting a new one as after a container restart")
+            reader.connection_pool.close()
+            reader, client = start_reader(config, valkey_client)
+            restarted = True
+        time.sleep(0.005)
+    return None, restarted, reader, client
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark PLCReader against a simulated S7 PLC")
+    parser.add_argument("--port", type=int, default=1102)
+    parser.add_argument("--variables", type=int, default=50, help="Number of REAL variables in the data blocks")
+    parser.add_argument("--blocks", type=int, default=1, help="Number of data blocks the variables are spread over")
+    parser.add_argument("--spacing", type=int, default=4, help="Bytes between the variables within a data block")
+    parser.add_argument("--interval", type=float, default=0.01, help="data_interval in seconds")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--latency-ms", type=float, default=1.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--loss", type=float, default=0.0)
+    parser.add_argument("--outage", type=float, default=0.5, help="Seconds the PLC is unreachable in the reconnect test")
+    parser.add_argument("--reconnect-timeout", type=float, default=60)
+    parser.add_argument("--reconnect-budget", type=float, default=300,
+                        help="Seconds the reader tries to reconnect before the service exits")
+    parser.add_argument("--no-reconnect", action="store_true", help="Skip the reconnect test")
+    parser.add_argument("--reload", action="store_true",
+                        help="Halve data_interval in the config file after the measurement and measure the reload")
+    parser.add_argument("--slow-fraction", type=float, default=0.0,
+                        help="Fraction of the variables in a slow rate class")
+    parser.add_argument("--slow-interval", type=float, default=1.0, help="Interval of the slow rate class")
+    parser.add_argument("--adaptive", action="store_true", help="Turn on the adaptive polling")
+    parser.add_argument("--static-fraction", type=float, default=0.0,
+                        help="Fraction of the variables whose values do not change")
+    parser.add_argument("--connections", type=int, default=1, help="Connections to the PLC for reading the data")
+    parser.add_argument("--max-connections", type=int, default=0,
+                        help="Connections the simulated PLC accepts, 0 for no limit")
+    parser.add_argument("--ring-rate", type=int, default=0,
+                        help="Samples per second of a ring buffer in the simulated PLC, which is harvested")
+    parser.add_argument("--ring-slots", type=int, default=2000)
+    parser.add_argument("--ring-channels", type=int, default=2, help="REAL values per sample of the ring buffer")
+    parser.add_argument("--ring-interval", type=float, default=0.1, help="Seconds between the harvests")
+    parser.add_argument("--trigger-condition", default="True",
+                        help="Condition of the data trigger, e.g. 'HYSTERESIS(variable_0, 5, 0)'")
+    parser.add_argument("--burst", type=int, default=0,
+                        help="Capture bursts of up to this many samples while the data trigger is set")
+    parser.add_argument("--stroke-on", type=float, default=1.0, help="Seconds the data trigger is on")
+    parser.add_argument("--stroke-off", type=float, default=0.0,
+                        help="Seconds the data trigger is off between the strokes, 0 for always on")
+    parser.add_argument("--batch", type=int, default=0, help="Publish columnar batches of this many samples")
+    parser.add_argument("--batch-encoding", default="packed", choices=["packed", "delta"])
+    parser.add_argument("--json", help="Write the results to this file as JSON")
+    args = parser.parse_args()
+
+    connection, child_connection = multiprocessing.Pipe()
+    environment = multiprocessing.get_context("spawn").Process(target=run_environment,
+                                                               args=(child_connection, args), daemon=True)
+    environment.start()
+    valkey_port = connection.recv()
+
+    config = device_config(args)
+    valkey_client = valkey.Valkey(host="127.0.0.1", port=valkey_port)
+    config_path = None
+    if args.reload:
+        # The reader watches the config file for the reload test
+        config_path = Path(tempfile.mkdtemp()).joinpath("simulated_plc.yaml")
+        write_config(config, config_path)
+    reader, client = start_reader(config, valkey_client, config_path)
+
+    # Let the triggers start the sampling before measuring
+    time.sleep(1)
+    result = measure(args, reader, client)
+    if args.reload:
+        result.update(measure_reload(args, config, config_path, reader, client))
+
+    if not args.no_reconnect:
+        reconnect_time, restarted, reader, client = measure_reconnect(args, connection, config, valkey_client,
+                                                                      reader, client)
+        result["outage_s"] = args.outage
+        result["reconnect_s"] = round(reconnect_time, 3) if reconnect_time is not None else None
+        result["restarted"] = restarted
+
+    reader.stop_event.set()
+    connection.send(("stop", None))
+    environment.join(5)
+
+    print(json.dumps(result, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
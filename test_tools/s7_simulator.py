@@ -0,0 +1,324 @@
+import argparse
+import logging
+import math
+import random
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+
+import snap7
+from snap7.type import SrvArea, WordLen
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+logger = logging.getLogger(__name__)
+
+# Simulated S7 PLC built on the snap7 server. The data blocks and the M area are filled by scripted
+# bit patterns and signals, and a proxy in front of the server injects latency, packet loss and disconnects.
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+class BitPattern:
+    """A bit which is on for `on` seconds and off for `off` seconds, always on when off is 0"""
+    def __init__(self, area, db_number, byte_offset, bit_offset, on=1.0, off=0.0):
+        self.area = area
+        self.db_number = db_number
+        self.byte_offset = byte_offset
+        self.bit_offset = bit_offset
+        self.on = on
+        self.off = off
+
+    def value(self, elapsed):
+        if not self.off:
+            return True
+        return elapsed % (self.on + self.off) < self.on
+
+class RealSignal:
+    """A REAL following a sine wave with noise, so that the value changes on every update"""
+    def __init__(self, db_number, byte_offset, amplitude=10.0, period=1.0, offset=0.0, noise=0.01):
+        self.db_number = db_number
+        self.byte_offset = byte_offset
+        self.amplitude = amplitude
+        self.period = period
+        self.offset = offset
+        self.noise = noise
+
+    def value(self, elapsed):
+        return (self.offset + self.amplitude * math.sin(2 * math.pi * elapsed / self.period)
+                + random.uniform(-self.noise, self.noise))
+
+class RingBuffer:
+    """A ring buffer filled at rate samples per second, as by a PLC program. A slot holds the time of the sample
+    in microseconds (UDINT) and then channels REALs, the counter of the samples written is a UDINT at index_offset."""
+    def __init__(self, db_number, index_offset, slots_offset, slots, rate, channels=1):
+        self.db_number = db_number
+        self.index_offset = index_offset
+        self.slots_offset = slots_offset
+        self.slots = slots
+        self.rate = rate
+        self.channels = channels
+        self.slot_struct = struct.Struct(f">I{channels}f")
+        self.count = 0
+
+    @property
+    def size(self):
+        return self.slots_offset + self.slots * self.slot_struct.size
+
+    def fill(self, data, elapsed):
+        # Writes the samples which are due up to elapsed seconds
+        while self.count < elapsed * self.rate:
+            sample_time = self.count / self.rate
+            values = [math.sin(2 * math.pi * 50 * (channel + 1) * sample_time)
+                      for channel in range(self.channels)]
+            self.slot_struct.pack_into(data, self.slots_offset + (self.count % self.slots) * self.slot_struct.size,
+                                       round(sample_time * 1_000_000) % (1 << 32), *values)
+            self.count += 1
+        struct.pack_into(">I", data, self.index_offset, self.count % (1 << 32))
+
+class FaultInjectingProxy:
+    """TCP proxy between the clients and the snap7 server.
+
+    Every response is delayed by latency (plus jitter). With the probability of loss a response is held back
+    for retransmit_delay, which is how a lost segment shows on a TCP connection. disconnect() drops all
+    connections and refuses new ones for the given outage. With max_connections the connections beyond it are
+    refused, like a CPU which has no connection resources left.
+    """
+    def __init__(self, listen_port, server_port, latency=0.0, jitter=0.0, loss=0.0, retransmit_delay=0.2,
+                 max_connections=0):
+        self.listen_port = listen_port
+        self.server_port = server_port
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.retransmit_delay = retransmit_delay
+        self.max_connections = max_connections
+        self.lock = threading.Lock()
+        self.connections = set()
+        self.refuse_until = 0.0
+        self.stop_event = threading.Event()
+        self.listener = None
+
+    def response_delay(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if self.loss and random.random() < self.loss:
+            delay += self.retransmit_delay
+        return delay
+
+    def pump(self, source, destination, delayed):
+        try:
+            while not self.stop_event.is_set():
+                data = source.recv(65536)
+                if not data:
+                    break
+                if delayed:
+                    delay = self.response_delay()
+                    if delay > 0:
+                        time.sleep(delay)
+                destination.sendall(data)
+        except OSError:
+            pass
+        finally:
+            self.close_pair(source, destination)
+
+    def close_pair(self, *sockets):
+        with self.lock:
+            for connection in sockets:
+                self.connections.discard(connection)
+        for connection in sockets:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            connection.close()
+
+    def accept_connections(self):
+        while not self.stop_event.is_set():
+            try:
+                readable, _, _ = select.select([self.listener], [], [], 0.2)
+                if not readable:
+                    continue
+                client_socket, _ = self.listener.accept()
+            except (OSError, ValueError):
+                # The listener was closed by stop()
+                break
+            if time.time() < self.refuse_until:
+                client_socket.close()
+                continue
+            with self.lock:
+                # Every connection is a pair of sockets
+                full = self.max_connections and len(self.connections) // 2 >= self.max_connections
+            if full:
+                logger.info(f"Refusing a connection, {self.max_connections} are open")
+                client_socket.close()
+                continue
+            try:
+                server_socket = socket.create_connection(("127.0.0.1", self.server_port))
+            except OSError:
+                client_socket.close()
+                continue
+            for connection in (client_socket, server_socket):
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.lock:
+                self.connections.update((client_socket, server_socket))
+            threading.Thread(target=self.pump, args=(client_socket, server_socket, False), daemon=True).start()
+            threading.Thread(target=self.pump, args=(server_socket, client_socket, True), daemon=True).start()
+
+    def disconnect(self, outage=0.0):
+        logger.info(f"Dropping all PLC connections, refusing new ones for {outage}s")
+        self.refuse_until = time.time() + outage
+        with self.lock:
+            connections = list(self.connections)
+        self.close_pair(*connections)
+
+    def start(self):
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("0.0.0.0", self.listen_port))
+        self.listener.listen()
+        threading.Thread(target=self.accept_connections, daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.disconnect()
+        self.listener.close()
+
+class SimulatedS7PLC:
+    def __init__(self, port=1102, data_blocks=None, memory_size=64, update_interval=0.005,
+                 latency=0.0, jitter=0.0, loss=0.0, retransmit_delay=0.2, disconnect_every=0.0, outage=1.0,
+                 max_connections=0):
+        self.port = port
+        self.update_interval = update_interval
+        self.disconnect_every = disconnect_every
+        self.outage = outage
+        self.server_port = free_port()
+        self.server = snap7.server.Server(log=False)
+        # The areas have to stay referenced for as long as the server is running
+        self.areas = {}
+        for db_number, size in (data_blocks or {1: 100}).items():
+            self.areas[("DB", db_number)] = (WordLen.Byte.ctype * size)()
+            self.server.register_area(SrvArea.DB, db_number, self.areas[("DB", db_number)])
+        self.areas[("MK", 0)] = (WordLen.Byte.ctype * memory_size)()
+        self.server.register_area(SrvArea.MK, 0, self.areas[("MK", 0)])
+        self.bit_patterns = []
+        self.signals = []
+        self.ring_buffers = []
+        self.proxy = FaultInjectingProxy(port, self.server_port, latency, jitter, loss, retransmit_delay,
+                                         max_connections)
+        self.stop_event = threading.Event()
+
+    def add_bit_pattern(self, area, db_number, byte_offset, bit_offset, on=1.0, off=0.0):
+        self.bit_patterns.append(BitPattern(area, db_number, byte_offset, bit_offset, on, off))
+
+    def add_real_signal(self, db_number, byte_offset, amplitude=10.0, period=1.0, offset=0.0, noise=0.01):
+        self.signals.append(RealSignal(db_number, byte_offset, amplitude, period, offset, noise))
+
+    def add_ring_buffer(self, db_number, index_offset, slots_offset, slots, rate, channels=1):
+        # Has to be added before start(), the data block is created for it when it does not exist
+        ring_buffer = RingBuffer(db_number, index_offset, slots_offset, slots, rate, channels)
+        if ("DB", db_number) not in self.areas:
+            self.areas[("DB", db_number)] = (WordLen.Byte.ctype * ring_buffer.size)()
+            self.server.register_area(SrvArea.DB, db_number, self.areas[("DB", db_number)])
+        self.ring_buffers.append(ring_buffer)
+        return ring_buffer
+
+    def update_areas(self):
+        start_time = time.time()
+        next_disconnect = start_time + self.disconnect_every if self.disconnect_every else None
+        server_areas = {"DB": SrvArea.DB, "MK": SrvArea.MK}
+        while not self.stop_event.is_set():
+            elapsed = time.time() - start_time
+            for (area, index), data in self.areas.items():
+                self.server.lock_area(server_areas[area], index)
+                try:
+                    for signal in self.signals:
+                        if area == "DB" and signal.db_number == index:
+                            struct.pack_into(">f", data, signal.byte_offset, signal.value(elapsed))
+                    for ring_buffer in self.ring_buffers:
+                        if area == "DB" and ring_buffer.db_number == index:
+                            ring_buffer.fill(data, elapsed)
+                    for pattern in self.bit_patterns:
+                        if pattern.area == area and (area == "MK" or pattern.db_number == index):
+                            mask = 1 << pattern.bit_offset
+                            if pattern.value(elapsed):
+                                data[pattern.byte_offset] |= mask
+                            else:
+                                data[pattern.byte_offset] &= ~mask & 0xFF
+                finally:
+                    self.server.unlock_area(server_areas[area], index)
+
+            if next_disconnect and time.time() >= next_disconnect:
+                self.proxy.disconnect(self.outage)
+                next_disconnect += self.disconnect_every
+            self.stop_event.wait(self.update_interval)
+
+    def start(self):
+        self.server.start(tcp_port=self.server_port)
+        self.proxy.start()
+        threading.Thread(target=self.update_areas, daemon=True).start()
+        logger.info(f"Simulated S7 PLC listening on port {self.port}")
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        self.proxy.stop()
+        self.server.stop()
+        self.server.destroy()
+
+def parse_bit(address):
+    # M2.6 or DB2.0.0
+    if address.upper().startswith("DB"):
+        db_number, byte_offset, bit_offset = address[2:].split(".")
+        return "DB", int(db_number), int(byte_offset), int(bit_offset)
+    byte_offset, bit_offset = address[1:].split(".")
+    return "MK", 0, int(byte_offset), int(bit_offset)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a simulated S7 PLC")
+    parser.add_argument("--port", type=int, default=1102)
+    parser.add_argument("--db", default="1:400", help="Data block with REAL signals as number:size")
+    parser.add_argument("--bit", action="append", default=[],
+                        help="Bit pattern as address:on:off, e.g. M2.6:10:5 or DB2.0.0:1:1, repeatable")
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--loss", type=float, default=0.0, help="Probability that a response is delayed as if lost")
+    parser.add_argument("--disconnect-every", type=float, default=0.0, help="Seconds between forced disconnects")
+    parser.add_argument("--outage", type=float, default=1.0, help="Seconds new connections are refused after a disconnect")
+    parser.add_argument("--ring-buffer", help="Ring buffer in DB 10 as slots:rate:channels, e.g. 2000:1000:2")
+    parser.add_argument("--max-connections", type=int, default=0, help="Connections accepted at a time, 0 for no limit")
+    args = parser.parse_args()
+
+    db_number, size = (int(value) for value in args.db.split(":"))
+    data_blocks = {db_number: size}
+    bits = [parse_bit(bit.split(":")[0]) + tuple(float(value) for value in bit.split(":")[1:]) for bit in args.bit]
+    for area, bit_db_number, *_ in bits:
+        if area == "DB" and bit_db_number not in data_blocks:
+            data_blocks[bit_db_number] = 16
+
+    plc = SimulatedS7PLC(args.port, data_blocks, latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000,
+                         loss=args.loss, disconnect_every=args.disconnect_every, outage=args.outage,
+                         max_connections=args.max_connections)
+    for offset in range(0, size - 3, 4):
+        plc.add_real_signal(db_number, offset, period=1 + offset / 40)
+    for bit in bits:
+        plc.add_bit_pattern(*bit)
+    if args.ring_buffer:
+        slots, rate, channels = (int(value) for value in args.ring_buffer.split(":"))
+        # Counter at DBB0, slots from DBB4 on
+        plc.add_ring_buffer(10, 0, 4, slots, rate, channels)
+
+    plc.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        plc.stop()
@@ -0,0 +1,244 @@
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from pathlib import Path
+
+import paho.mqtt.client as mqtt
+import valkey
+
+from valkey_standin import ValkeyStandIn
+from mqtt_standin import MQTTStandIn
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+logger = logging.getLogger(__name__)
+
+# End-to-end benchmark of the data path on the gateway:
+# synthetic device services -> Valkey -> MQTT publisher -> MQTT broker -> subscriber.
+# Valkey and the broker are in-process stand-ins unless --valkey/--broker point to real servers.
+# CPU and RSS are measured for this process, so they include the stand-ins when those are used.
+
+repository_dir = Path(__file__).resolve().parent.parent
+# For the local dependencies of the services
+sys.path.insert(0, str(repository_dir))
+
+def load_mqtt_publisher():
+    # The MQTT publisher is a script, so it is loaded from its file instead of being imported as a package
+    path = repository_dir.joinpath("applications/MQTT/mqtt_publisher_service.py")
+    spec = importlib.util.spec_from_file_location("mqtt_publisher_service", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def parse_address(address, default_port):
+    host, _, port = address.partition(":")
+    return host or "127.0.0.1", int(port or default_port)
+
+def build_metrics(payload_size):
+    # Metrics shaped like the DDATA messages of the S7Comm service, until the payload has the requested size
+    metrics = []
+    while len(json.dumps({"time": time.time(), "metrics": metrics})) < payload_size:
+        metrics.append({"name": f"variable_{len(metrics)}",
+                        "value": 1.2345678,
+                        "timestamp": time.time(),
+                        "datatype": "REAL",
+                        "units": "bar"})
+    return metrics
+
+def message_time(payload):
+    # The payload starts with '{"time": <publish time>,' which is parsed without decoding the whole message
+    return float(payload[9:payload.index(b",")])
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return None
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+class DeviceLoad:
+    """Publishes DDATA messages for a number of synthetic devices at a fixed rate per device"""
+    def __init__(self, valkey_host, valkey_port, devices, rate, metrics):
+        self.valkey_host = valkey_host
+        self.valkey_port = valkey_port
+        self.devices = devices
+        self.rate = rate
+        self.metrics = metrics
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.published = 0
+        self.threads = []
+
+    def publish_device(self, device_index):
+        valkey_client = valkey.Valkey(host=self.valkey_host, port=self.valkey_port)
+        topic = f"spBv1.0/benchmark/DDATA/benchmark_node/device_{device_index}"
+        interval = 1 / self.rate
+        # Spread the devices over the interval instead of publishing in bursts
+        next_publish = time.perf_counter() + interval * device_index / self.devices
+        published = 0
+        while not self.stop_event.is_set():
+            delay = next_publish - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            valkey_client.publish(topic, json.dumps({"time": time.time(), "metrics": self.metrics}))
+            published += 1
+            next_publish += interval
+        with self.lock:
+            self.published += published
+        valkey_client.close()
+
+    def start(self):
+        for device_index in range(self.devices):
+            thread = threading.Thread(target=self.publish_device, args=(device_index,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+
+class Receiver:
+    """MQTT subscriber recording the end-to-end latency of every message"""
+    def __init__(self, broker_host, broker_port):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.bytes = 0
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, "benchmark_receiver")
+        self.client.on_message = self.on_message
+        self.client.connect(broker_host, broker_port)
+        self.client.subscribe("spBv1.0/benchmark/#")
+        self.client.loop_start()
+
+    def on_message(self, client, userdata, message):
+        latency = time.time() - message_time(message.payload)
+        with self.lock:
+            self.latencies.append(latency)
+            self.bytes += len(message.payload)
+
+    def reset(self):
+        with self.lock:
+            latencies, received_bytes = self.latencies, self.bytes
+            self.latencies, self.bytes = [], 0
+        return latencies, received_bytes
+
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+def start_bridge(valkey_host, valkey_port, broker_host, broker_port):
+    mqtt_publisher = load_mqtt_publisher()
+    valkey_client = valkey.Valkey(host=valkey_host, port=valkey_port)
+    mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, "benchmark_bridge")
+    mqtt_client.connect(broker_host, broker_port)
+    mqtt_client.loop_start()
+    thread = threading.Thread(target=mqtt_publisher.receive_and_publish_messages,
+                              args=(valkey_client, mqtt_client), daemon=True)
+    thread.start()
+    return mqtt_client
+
+def run_step(args, rate, metrics, receiver, valkey_host, valkey_port):
+    load = DeviceLoad(valkey_host, valkey_port, args.devices, rate, metrics)
+    receiver.reset()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    load.start()
+    time.sleep(args.duration)
+    load.stop()
+    wall_time, cpu_time = time.perf_counter() - wall_start, time.process_time() - cpu_start
+
+    # Give the messages in flight time to arrive
+    drain_deadline = time.time() + args.drain
+    while time.time() < drain_deadline:
+        with receiver.lock:
+            if len(receiver.latencies) >= load.published:
+                break
+        time.sleep(0.05)
+
+    latencies, received_bytes = receiver.reset()
+    latencies.sort()
+    return {
+        "devices": args.devices,
+        "rate_per_device": rate,
+        "payload_bytes": len(json.dumps({"time": time.time(), "metrics": metrics})),
+        "published": load.published,
+        "received": len(latencies),
+        "lost": load.published - len(latencies),
+        "published_msgs_per_s": round(load.published / wall_time, 1),
+        "received_msgs_per_s": round(len(latencies) / wall_time, 1),
+        "received_bytes_per_s": round(received_bytes / wall_time),
+        "latency_p50_ms": round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+        "latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        "latency_max_ms": round(latencies[-1] * 1000, 3) if latencies else None,
+        "cpu_percent": round(100 * cpu_time / wall_time, 1),
+        "rss_mb": round(rss_bytes() / 2**20, 1) if rss_bytes() else None,
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end throughput and latency benchmark of the bus and MQTT publisher")
+    parser.add_argument("--valkey", help="host:port of a running Valkey server, the in-process stand-in is used if omitted")
+    parser.add_argument("--broker", help="host:port of a running MQTT broker, the in-process stand-in is used if omitted")
+    parser.add_argument("--devices", type=int, default=10, help="Number of synthetic device services")
+    parser.add_argument("--rates", default="1,10,50", help="Comma separated messages per second per device, one step per rate")
+    parser.add_argument("--payload-size", type=int, default=1000, help="Approximate payload size in bytes")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds per step")
+    parser.add_argument("--drain", type=float, default=5, help="Seconds to wait for messages in flight after each step")
+    parser.add_argument("--json", help="Write the results to this file as JSON")
+    args = parser.parse_args()
+
+    standins = []
+    if args.valkey:
+        valkey_host, valkey_port = parse_address(args.valkey, 6379)
+    else:
+        valkey_standin = ValkeyStandIn().start()
+        standins.append(valkey_standin)
+        valkey_host, valkey_port = "127.0.0.1", valkey_standin.port
+
+    if args.broker:
+        broker_host, broker_port = parse_address(args.broker, 1883)
+    else:
+        broker_standin = MQTTStandIn().start()
+        standins.append(broker_standin)
+        broker_host, broker_port = "127.0.0.1", broker_standin.port
+
+    receiver = Receiver(broker_host, broker_port)
+    bridge_client = start_bridge(valkey_host, valkey_port, broker_host, broker_port)
+    time.sleep(0.5)
+
+    metrics = build_metrics(args.payload_size)
+    results = []
+    for rate in [float(rate) for rate in args.rates.split(",")]:
+        logger.info(f"Running {args.devices} devices at {rate} msgs/s each for {args.duration}s")
+        result = run_step(args, rate, metrics, receiver, valkey_host, valkey_port)
+        logger.info(json.dumps(result))
+        results.append(result)
+
+    receiver.stop()
+    bridge_client.loop_stop()
+    for standin in standins:
+        standin.stop()
+
+    columns = ["rate_per_device", "published_msgs_per_s", "received_msgs_per_s", "lost",
+               "latency_p50_ms", "latency_p99_ms", "cpu_percent", "rss_mb"]
+    print(" | ".join(columns))
+    for result in results:
+        print(" | ".join(str(result[column]) for column in columns))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,163 @@
+import socket
+import socketserver
+import threading
+import fnmatch
+import argparse
+import logging
+import sys
+import time
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+logger = logging.getLogger(__name__)
+
+# In-process stand-in for the internal message bus. It speaks enough of the RESP protocol for the
+# valkey client used by the services: PING, PUBLISH, (P)SUBSCRIBE, (P)UNSUBSCRIBE and the connection setup.
+
+def encode(value):
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, str):
+        value = value.encode()
+    if isinstance(value, bytes):
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+    if isinstance(value, list):
+        return b"*%d\r\n" % len(value) + b"".join(encode(item) for item in value)
+    raise TypeError(f"Can not encode {type(value)}")
+
+class ValkeyHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.write_lock = threading.Lock()
+        # Replaced instead of changed, so that publishing threads can read them without a lock
+        self.channels = frozenset()
+        self.patterns = frozenset()
+
+    def send(self, data):
+        with self.write_lock:
+            self.wfile.write(data)
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            # Inline command, e.g. from telnet
+            return line.split()
+        arguments = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            arguments.append(self.rfile.read(length + 2)[:-2])
+        return arguments
+
+    def subscription_count(self):
+        return len(self.channels) + len(self.patterns)
+
+    def handle(self):
+        self.server.add_client(self)
+        try:
+            while True:
+                command = self.read_command()
+                if command is None:
+                    break
+                if not command:
+                    continue
+                self.execute(command[0].upper(), command[1:])
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            self.server.remove_client(self)
+
+    def execute(self, name, arguments):
+        if name == b"PING":
+            self.send(encode(arguments[0]) if arguments else b"+PONG\r\n")
+        elif name == b"PUBLISH":
+            self.send(encode(self.server.publish(arguments[0], arguments[1])))
+        elif name in (b"SUBSCRIBE", b"PSUBSCRIBE"):
+            attribute = "channels" if name == b"SUBSCRIBE" else "patterns"
+            for channel in arguments:
+                setattr(self, attribute, getattr(self, attribute) | {channel})
+                self.send(encode([name.lower(), channel, self.subscription_count()]))
+        elif name in (b"UNSUBSCRIBE", b"PUNSUBSCRIBE"):
+            attribute = "channels" if name == b"UNSUBSCRIBE" else "patterns"
+            for channel in arguments or list(getattr(self, attribute)):
+                setattr(self, attribute, getattr(self, attribute) - {channel})
+                self.send(encode([name.lower(), channel, self.subscription_count()]))
+        elif name == b"ECHO":
+            self.send(encode(arguments[0]))
+        elif name in (b"CLIENT", b"SELECT", b"AUTH"):
+            self.send(b"+OK\r\n")
+        else:
+            self.send(b"-ERR unknown command '%s'\r\n" % name)
+
+class ValkeyStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0):
+        super().__init__((host, port), ValkeyHandler)
+        self.lock = threading.Lock()
+        self.clients = set()
+        self.published = 0
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def add_client(self, client):
+        with self.lock:
+            self.clients.add(client)
+
+    def remove_client(self, client):
+        with self.lock:
+            self.clients.discard(client)
+
+    def publish(self, channel, data):
+        with self.lock:
+            self.published += 1
+            clients = list(self.clients)
+        receivers = 0
+        channel_text = channel.decode("utf-8", errors="replace")
+        for client in clients:
+            try:
+                if channel in client.channels:
+                    client.send(encode([b"message", channel, data]))
+                    receivers += 1
+                for pattern in client.patterns:
+                    if fnmatch.fnmatchcase(channel_text, pattern.decode("utf-8", errors="replace")):
+                        client.send(encode([b"pmessage", pattern, channel, data]))
+                        receivers += 1
+            except (ConnectionError, ValueError):
+                self.remove_client(client)
+        return receivers
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info(f"Valkey stand-in listening on {self.server_address[0]}:{self.port}")
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the Valkey stand-in as a local message bus")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    args = parser.parse_args()
+
+    server = ValkeyStandIn(args.host, args.port).start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()